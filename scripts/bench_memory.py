@@ -0,0 +1,71 @@
+#!/usr/bin/env python3
+"""
+ButtonOption / ButtonMenu 内存基准
+
+对比原 dataclass 布局（每个实例带 __dict__）与当前 __slots__ 布局下
+每个选项占用的字节数。
+
+用法: python bench_memory.py [选项数]
+"""
+
+import sys
+import tracemalloc
+from dataclasses import dataclass
+from typing import List, Optional
+
+from telebutton import ButtonMenu, ButtonOption
+
+
+@dataclass
+class DictButtonOption:
+    """原 dataclass 版本的选项布局"""
+    text: str
+    callback: str
+    sub_menu: Optional['DictButtonMenu'] = None
+    _sub_menu_raw: object = None
+
+
+@dataclass
+class DictButtonMenu:
+    """原 dataclass 版本的菜单布局"""
+    question: str
+    options: List[DictButtonOption]
+    max_per_row: int = 2
+    menu_id: str = "bench"
+    _option_index: Optional[dict] = None
+    _tree_index: object = None
+    _tree_root: object = None
+
+
+def measure(menu_cls, option_cls, count: int) -> float:
+    """构建含 count 个选项的菜单，返回每个选项的平均字节数"""
+    # 预先生成字符串，只统计对象本身的开销
+    texts = [f"选项 {i}" for i in range(count)]
+    callbacks = [f"opt_{i}" for i in range(count)]
+
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    menu = menu_cls(
+        question="基准菜单",
+        options=[option_cls(text=t, callback=c) for t, c in zip(texts, callbacks)],
+        max_per_row=2,
+        menu_id="bench"
+    )
+    after = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+
+    total = sum(stat.size_diff for stat in after.compare_to(before, "filename"))
+    del menu
+    return total / count
+
+
+if __name__ == "__main__":
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+
+    before = measure(DictButtonMenu, DictButtonOption, count)
+    after = measure(ButtonMenu, ButtonOption, count)
+
+    print(f"选项数: {count}")
+    print(f"dataclass (__dict__): {before:.1f} 字节/选项")
+    print(f"__slots__:            {after:.1f} 字节/选项")
+    print(f"节省:                 {(1 - after / before) * 100:.1f}%")
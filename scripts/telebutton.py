@@ -5,24 +5,96 @@ Telebutton - Telegram 选择按钮交互库
 提供简单的 API 在 Telegram 中展示选择按钮并获取用户反馈。
 """
 
+import asyncio
+import base64
+import ctypes
+import ctypes.util
+import hashlib
+import heapq
+import itertools
 import json
+import marshal
+import os
+import queue
+import random
+import secrets
+import select
+import sqlite3
+import struct
+import threading
 import time
-import uuid
-from dataclasses import dataclass, field
-from typing import List, Dict, Optional, Any, Callable
+from collections import OrderedDict, deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from dataclasses import dataclass
+from typing import List, Dict, Optional, Any, Callable, Deque, Iterable, NamedTuple, Tuple
 from pathlib import Path
 
-# 全局状态存储（临时内存存储）
-_pending_selections: Dict[str, Any] = {}
-_menu_registry: Dict[str, 'ButtonMenu'] = {}
+class ButtonOption:
+    """
+    单个按钮选项
 
+    使用 __slots__ 存储，不为每个实例分配 __dict__；
+    构造参数、相等比较和 repr 与原 dataclass 版本一致。
+    """
 
-@dataclass
-class ButtonOption:
-    """单个按钮选项"""
-    text: str
-    callback: str
-    sub_menu: Optional['ButtonMenu'] = None
+    __slots__ = ("text", "callback", "_sub_menu", "_sub_menu_raw", "payload")
+
+    def __init__(self, text: str, callback: str, sub_menu: Optional['ButtonMenu'] = None,
+                 payload: Any = None):
+        self.text = text
+        self.callback = callback
+        self._sub_menu = sub_menu
+        # 按钮携带的任意数据，保存在服务端令牌表中，由 handle_callback 原样返回
+        self.payload = payload
+        # 尚未构建的子菜单原始数据（字典或预编译元组），首次访问 sub_menu 时构建
+        self._sub_menu_raw: Any = None
+
+    @property
+    def sub_menu(self) -> Optional['ButtonMenu']:
+        """子菜单（延迟构建的子菜单在首次访问时构建）"""
+        if self._sub_menu_raw is not None:
+            with _sub_menu_lock:
+                # 加锁后再检查一次：并发的首次访问只构建一个实例（同一个 menu_id）
+                raw = self._sub_menu_raw
+                if raw is not None:
+                    self._sub_menu = _build_menu(raw)
+                    self._sub_menu_raw = None
+        return self._sub_menu
+
+    @sub_menu.setter
+    def sub_menu(self, value: Optional['ButtonMenu']):
+        self._sub_menu = value
+        self._sub_menu_raw = None
+
+    @property
+    def has_sub_menu(self) -> bool:
+        """是否有子菜单（不会触发延迟构建）"""
+        return self._sub_menu_raw is not None or self._sub_menu is not None
+
+    @property
+    def sub_menu_loaded(self) -> bool:
+        """子菜单是否已构建"""
+        return self._sub_menu_raw is None
+
+    def __repr__(self) -> str:
+        extra = f", payload={self.payload!r}" if self.payload is not None else ""
+        sub_menu = "<lazy>" if self._sub_menu_raw is not None else repr(self._sub_menu)
+        return (f"ButtonOption(text={self.text!r}, callback={self.callback!r}, "
+                f"sub_menu={sub_menu}{extra})")
+
+    def _sub_menu_state(self) -> Any:
+        """用于比较的子菜单：已构建的 ButtonMenu，或未构建时的原始数据字典（不触发构建）"""
+        if self._sub_menu_raw is not None:
+            return _raw_to_dict(self._sub_menu_raw)
+        return self._sub_menu
+
+    def __eq__(self, other: Any) -> bool:
+        if other.__class__ is not self.__class__:
+            return NotImplemented
+        return ((self.text, self.callback, self._sub_menu_state(), self.payload)
+                == (other.text, other.callback, other._sub_menu_state(), other.payload))
+
+    __hash__ = None
     
     def to_dict(self) -> Dict:
         """转换为字典"""
@@ -30,226 +102,3695 @@ class ButtonOption:
             "text": self.text,
             "callback": self.callback
         }
-        if self.sub_menu:
-            result["sub_menu"] = self.sub_menu.to_dict()
+        if self._sub_menu_raw is not None:
+            # 未构建的子菜单直接输出原始数据，不为序列化构建整棵树
+            result["sub_menu"] = _raw_to_dict(self._sub_menu_raw)
+        elif self._sub_menu:
+            result["sub_menu"] = self._sub_menu.to_dict()
+        if self.payload is not None:
+            result["payload"] = self.payload
         return result
     
     @classmethod
-    def from_dict(cls, data: Dict) -> 'ButtonOption':
-        """从字典创建"""
-        sub_menu = None
+    def from_dict(cls, data: Dict, lazy: bool = True) -> 'ButtonOption':
+        """
+        从字典创建
+        
+        Args:
+            data: 选项字典
+            lazy: 是否延迟到首次访问 sub_menu 时再构建子菜单
+        """
+        option = cls(text=data["text"], callback=data["callback"],
+                     payload=data.get("payload"))
         if "sub_menu" in data:
-            sub_menu = ButtonMenu.from_dict(data["sub_menu"])
-        return cls(
-            text=data["text"],
-            callback=data["callback"],
-            sub_menu=sub_menu
+            if lazy:
+                option._sub_menu_raw = data["sub_menu"]
+            else:
+                option.sub_menu = ButtonMenu.from_dict(data["sub_menu"], lazy=False)
+        return option
+
+
+# 保护延迟子菜单的构建
+_sub_menu_lock = threading.Lock()
+
+
+# URL 安全、不含 callback_data 分隔符 ":" 的 64 进制字母表
+_ID_ALPHABET = "ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789-_"
+
+
+_ID_VALUES = {c: i for i, c in enumerate(_ID_ALPHABET)}
+
+
+def _decode_id(text: str) -> int:
+    """解码 _encode_id 生成的 64 进制字符串（非法字符抛出 KeyError）"""
+    n = 0
+    for c in text:
+        n = n * 64 + _ID_VALUES[c]
+    return n
+
+
+def _encode_id(n: int, width: int = 0) -> str:
+    """将非负整数编码为 64 进制字符串（width 指定最小长度）"""
+    chars = []
+    while n or len(chars) < max(width, 1):
+        n, r = divmod(n, 64)
+        chars.append(_ID_ALPHABET[r])
+    return "".join(reversed(chars))
+
+
+class CounterIdGenerator:
+    """
+    单调计数器 menu_id 生成器（默认）
+
+    ID = 固定长度的进程随机前缀 + 递增计数器（均为 64 进制），
+    同一进程内绝不重复；前缀区分共享注册表的不同进程。
+    生成 ID 只需一次计数器自增，通常只有 6-8 个字符。
+    """
+
+    def __init__(self, prefix: Optional[str] = None, prefix_len: int = 5):
+        """
+        Args:
+            prefix: 固定前缀（None 表示随机生成）
+            prefix_len: 随机前缀长度（字符数，每个字符 6 位）
+        """
+        if prefix is None:
+            prefix = _encode_id(int.from_bytes(os.urandom(prefix_len), "big")
+                                % (64 ** prefix_len), prefix_len)
+        self.prefix = prefix
+        self._counter = itertools.count()
+
+    def __call__(self) -> str:
+        return self.prefix + _encode_id(next(self._counter))
+
+
+class SnowflakeIdGenerator:
+    """
+    Snowflake 风格 menu_id 生成器
+
+    64 位 ID = 41 位毫秒时间戳 + 10 位节点 ID + 12 位序号，编码后 11 个字符；
+    为多个节点分配不同的 worker_id 即可在共享注册表中全局不重复，并且按时间有序。
+    """
+
+    EPOCH_MS = 1704067200000  # 2024-01-01 UTC
+
+    def __init__(self, worker_id: int = 0):
+        """
+        Args:
+            worker_id: 节点 ID（0-1023）
+        """
+        if not 0 <= worker_id < 1024:
+            raise ValueError("worker_id 必须在 0-1023 之间")
+        self.worker_id = worker_id
+        self._last_ms = -1
+        self._sequence = 0
+        self._lock = threading.Lock()
+
+    def __call__(self) -> str:
+        with self._lock:
+            now = int(time.time() * 1000) - self.EPOCH_MS
+            if now <= self._last_ms:
+                # 同一毫秒内（或时钟回拨）沿用上一时间戳并递增序号
+                now = self._last_ms
+                self._sequence = (self._sequence + 1) & 0xFFF
+                if self._sequence == 0:
+                    now += 1
+            else:
+                self._sequence = 0
+            self._last_ms = now
+            value = (now << 22) | (self.worker_id << 12) | self._sequence
+        return _encode_id(value, 11)
+
+
+_menu_id_generator: Callable[[], str] = CounterIdGenerator()
+
+
+def set_menu_id_generator(generator: Callable[[], str]):
+    """
+    替换 menu_id 生成器
+    
+    Args:
+        generator: 无参可调用对象，返回不含 ":" 的唯一字符串
+    """
+    global _menu_id_generator
+    _menu_id_generator = generator
+
+
+def _new_menu_id() -> str:
+    return _menu_id_generator()
+
+
+class OptionProvider:
+    """
+    按页拉取选项的数据源（用于数据库查询、大文件等动态菜单）
+
+    source 可以是：
+    - 选项迭代器：翻页时按需顺序消费，已取出的选项会保留以便回翻；
+    - 分页函数 source(offset, limit) -> Sequence[ButtonOption]：只缓存最近查看的
+      cache_pages 页，缓存未命中时重新调用。
+    两种来源都可以产出 ButtonOption 或其字典形式。
+    """
+
+    def __init__(self, source: Any, total: Optional[int] = None, cache_pages: int = 4):
+        """
+        Args:
+            source: 选项迭代器/可迭代对象，或分页函数 (offset, limit) -> 选项序列
+            total: 选项总数（None 表示未知，翻到末页时才确定）
+            cache_pages: 分页函数来源缓存的页数
+        """
+        if callable(source):
+            self._fetch: Optional[Callable] = source
+            self._iter = None
+        else:
+            self._fetch = None
+            self._iter = iter(source)
+        self.total = total
+        self.cache_pages = cache_pages
+        # 迭代器来源：已消费的选项；分页函数来源：(页码, 每页数) -> (选项, 是否还有下一页)
+        self._items: List[ButtonOption] = []
+        self._pages: 'OrderedDict[Tuple[int, int], Tuple[List[ButtonOption], bool]]' = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _as_option(item: Any) -> ButtonOption:
+        return item if isinstance(item, ButtonOption) else ButtonOption.from_dict(item)
+
+    def _fill(self, count: int):
+        """从迭代器中消费选项直到已取出 count 个（或迭代器耗尽）"""
+        while self._iter is not None and len(self._items) < count:
+            try:
+                self._items.append(self._as_option(next(self._iter)))
+            except StopIteration:
+                self._iter = None
+                self.total = len(self._items)
+
+    def page(self, page: int, page_size: int) -> Tuple[List[ButtonOption], bool]:
+        """
+        获取一页选项
+
+        Returns:
+            (该页选项, 是否还有下一页)
+        """
+        start = page * page_size
+        with self._lock:
+            if self._fetch is None:
+                # 多取一个用于判断是否还有下一页
+                self._fill(start + page_size + 1)
+                return self._items[start:start + page_size], len(self._items) > start + page_size
+
+            key = (page, page_size)
+            entry = self._pages.get(key)
+            if entry is None:
+                items = [self._as_option(item) for item in self._fetch(start, page_size + 1)]
+                entry = (items[:page_size], len(items) > page_size)
+                if not entry[1] and self.total is None:
+                    self.total = start + len(entry[0])
+                self._pages[key] = entry
+                while len(self._pages) > self.cache_pages:
+                    self._pages.popitem(last=False)
+            else:
+                self._pages.move_to_end(key)
+            return entry
+
+    def get(self, index: int, page_size: int) -> Optional[ButtonOption]:
+        """按全局下标获取选项（分页函数来源会在缓存未命中时拉取所在页）"""
+        if index < 0:
+            return None
+        items = self.page(index // page_size, page_size)[0]
+        offset = index % page_size
+        return items[offset] if offset < len(items) else None
+
+    def find(self, callback: str) -> Optional[ButtonOption]:
+        """在已拉取的选项中按 callback 查找"""
+        with self._lock:
+            if self._fetch is None:
+                candidates = self._items
+            else:
+                candidates = [opt for items, _ in self._pages.values() for opt in items]
+            for option in candidates:
+                if option.callback == callback:
+                    return option
+        return None
+
+    def page_count(self, page_size: int) -> Optional[int]:
+        """总页数（总数未知时为 None）"""
+        if self.total is None:
+            return None
+        return max(1, -(-self.total // page_size))
+
+    def invalidate(self):
+        """丢弃分页函数来源的页缓存（数据变化后调用）"""
+        with self._lock:
+            self._pages.clear()
+
+
+class _OptionList(list):
+    """菜单的选项列表：任何原地修改都会使所属菜单的索引失效"""
+
+    __slots__ = ("_menu",)
+
+    def __init__(self, menu: 'ButtonMenu', options: Iterable[ButtonOption] = ()):
+        super().__init__(options)
+        self._menu = menu
+
+    def __setitem__(self, index, value):
+        super().__setitem__(index, value)
+        self._menu.invalidate_index()
+
+    def __delitem__(self, index):
+        super().__delitem__(index)
+        self._menu.invalidate_index()
+
+    def __iadd__(self, other):
+        super().__iadd__(other)
+        self._menu.invalidate_index()
+        return self
+
+    def __imul__(self, n):
+        super().__imul__(n)
+        self._menu.invalidate_index()
+        return self
+
+    def append(self, option):
+        super().append(option)
+        self._menu.invalidate_index()
+
+    def extend(self, options):
+        super().extend(options)
+        self._menu.invalidate_index()
+
+    def insert(self, index, option):
+        super().insert(index, option)
+        self._menu.invalidate_index()
+
+    def pop(self, index=-1):
+        option = super().pop(index)
+        self._menu.invalidate_index()
+        return option
+
+    def remove(self, option):
+        super().remove(option)
+        self._menu.invalidate_index()
+
+    def clear(self):
+        super().clear()
+        self._menu.invalidate_index()
+
+    def sort(self, *, key=None, reverse=False):
+        super().sort(key=key, reverse=reverse)
+        self._menu.invalidate_index()
+
+    def reverse(self):
+        super().reverse()
+        self._menu.invalidate_index()
+
+    def __reduce_ex__(self, protocol):
+        return _OptionList, (self._menu, list(self))
+
+
+class ButtonMenu:
+    """
+    按钮菜单配置
+
+    使用 __slots__ 存储；构造参数、相等比较和 repr 与原 dataclass 版本一致。
+    """
+
+    __slots__ = ("question", "_options", "max_per_row", "menu_id", "page_size", "provider",
+                 "_option_index", "_indexed_len", "_tree_index", "_tree_root",
+                 "_root_id", "_parent_id", "_path", "_size_estimate")
+
+    def __init__(self, question: str, options: Optional[List[ButtonOption]] = None,
+                 max_per_row: int = 2, menu_id: Optional[str] = None,
+                 page_size: Optional[int] = None,
+                 provider: Optional[OptionProvider] = None):
+        if provider is not None and not page_size:
+            raise ValueError("使用 provider 时必须指定 page_size")
+        self.question = question
+        self.max_per_row = max_per_row
+        self.menu_id = menu_id if menu_id is not None else _new_menu_id()
+        # 分页模式：每页显示的选项数（None 表示不分页）
+        self.page_size = page_size
+        # 动态选项来源：设置后按页拉取选项，options 不参与渲染
+        self.provider = provider
+        # 整棵菜单树的索引（仅根菜单使用），以及子菜单指向所属根菜单的链接
+        self._tree_index: Optional['MenuTreeIndex'] = None
+        self._tree_root: Optional['ButtonMenu'] = None
+        # 子菜单在所属树中的位置：根菜单 ID、父菜单 ID、从根菜单到本菜单的 callback 路径
+        # （随菜单保存到注册表，从共享注册表取回的副本没有 _tree_root 也能回溯）
+        self._root_id: Optional[str] = None
+        self._parent_id: Optional[str] = None
+        self._path: Tuple[str, ...] = ()
+        # callback -> 选项下标，首次查找时构建；_indexed_len 为构建时的选项数
+        self._option_index: Optional[Dict[str, int]] = None
+        self._indexed_len = 0
+        # 注册表内存预算使用的估算字节数，首次需要时计算
+        self._size_estimate: Optional[int] = None
+        self.options = options if options is not None else []
+
+    @property
+    def options(self) -> List[ButtonOption]:
+        """选项列表（重新赋值或原地增删、替换都会使本菜单及所属根菜单的索引失效）"""
+        return self._options
+
+    @options.setter
+    def options(self, value: List[ButtonOption]):
+        self._options = _OptionList(self, value)
+        self.invalidate_index()
+
+    @property
+    def page_count(self) -> Optional[int]:
+        """分页模式下的总页数（不分页时为 1；provider 总数未知时为 None）"""
+        if not self.page_size:
+            return 1
+        if self.provider is not None:
+            return self.provider.page_count(self.page_size)
+        return max(1, -(-len(self.options) // self.page_size))
+
+    def __repr__(self) -> str:
+        extra = f", page_size={self.page_size!r}" if self.page_size else ""
+        if self.provider is not None:
+            extra += f", provider={self.provider!r}"
+        return (f"ButtonMenu(question={self.question!r}, options={self.options!r}, "
+                f"max_per_row={self.max_per_row!r}, menu_id={self.menu_id!r}{extra})")
+
+    def __eq__(self, other: Any) -> bool:
+        if other.__class__ is not self.__class__:
+            return NotImplemented
+        return ((self.question, self.options, self.max_per_row, self.menu_id, self.page_size,
+                 self.provider)
+                == (other.question, other.options, other.max_per_row, other.menu_id,
+                    other.page_size, other.provider))
+
+    __hash__ = None
+    
+    def to_dict(self) -> Dict:
+        """转换为字典"""
+        return {
+            "question": self.question,
+            "options": [opt.to_dict() for opt in self.options],
+            "max_per_row": self.max_per_row,
+            "menu_id": self.menu_id,
+            **({"page_size": self.page_size} if self.page_size else {})
+        }
+    
+    @classmethod
+    def from_dict(cls, data: Dict, lazy: bool = True) -> 'ButtonMenu':
+        """
+        从字典创建
+        
+        Args:
+            data: 菜单字典
+            lazy: 是否延迟构建子菜单（只构建本层选项）
+        """
+        options = [ButtonOption.from_dict(opt, lazy) for opt in data.get("options", [])]
+        menu = cls(
+            question=data["question"],
+            options=options,
+            max_per_row=data.get("max_per_row", 2),
+            page_size=data.get("page_size")
+        )
+        if "menu_id" in data:
+            menu.menu_id = data["menu_id"]
+        return menu
+    
+    def find_option(self, callback: str) -> Optional[ButtonOption]:
+        """
+        查找选项
+        
+        通过 callback -> 下标索引常数时间定位。索引对当前选项列表有效时，
+        未命中即表示不存在。options 列表的任何修改都会使索引失效；直接修改某个
+        选项对象的 callback 后需调用 invalidate_index()。
+        """
+        options = self.options
+        index = self._option_index
+        if index is None or self._indexed_len != len(options):
+            index = self._build_option_index()
+        i = index.get(callback)
+        if i is None:
+            return None
+        if i < len(options) and options[i].callback == callback:
+            return options[i]
+        index = self._build_option_index()
+        i = index.get(callback)
+        return options[i] if i is not None else None
+
+    def invalidate_index(self):
+        """使选项索引和菜单树索引失效（下次查找时重建）"""
+        self._option_index = None
+        self._tree_index = None
+        self._size_estimate = None
+        if self._tree_root is not None:
+            self._tree_root._tree_index = None
+
+    def tree_index(self) -> 'MenuTreeIndex':
+        """获取（必要时构建）以本菜单为根的整棵菜单树索引"""
+        if self._tree_index is None:
+            self._tree_index = MenuTreeIndex(self, link=self._tree_root is None)
+        return self._tree_index
+
+    def resolve_callback(self, menu_id: str, callback: str) -> Optional['MenuTreeNode']:
+        """
+        在整棵菜单树中定位某个菜单上的按钮
+        
+        Args:
+            menu_id: 按钮所在菜单的 ID（可以是任意层级的子菜单）
+            callback: 回调标识
+        
+        Returns:
+            MenuTreeNode，或 None（不存在）
+        """
+        index = self.tree_index()
+        node = index.nodes.get((menu_id, callback))
+        if node is not None:
+            if node.menu.find_option(callback) is node.option:
+                return node
+        elif menu_id in index.menus and not index.changed(menu_id):
+            # 索引对该菜单仍然有效：未命中即不存在
+            return None
+        # 命中已过期或所在菜单已变化，重建一次
+        self._tree_index = None
+        return self.tree_index().nodes.get((menu_id, callback))
+
+    def _build_option_index(self) -> Dict[str, int]:
+        index: Dict[str, int] = {}
+        for i, opt in enumerate(self.options):
+            index.setdefault(opt.callback, i)
+        self._option_index = index
+        self._indexed_len = len(self.options)
+        return index
+    
+    def get_all_callbacks(self) -> List[str]:
+        """获取所有回调标识（包括子菜单；树中任一菜单的选项数量变化后重建索引）"""
+        index = self.tree_index()
+        if index.stale():
+            self._tree_index = None
+            index = self.tree_index()
+        return list(index.callbacks)
+
+
+@dataclass
+class MenuTreeNode:
+    """菜单树中的一个按钮"""
+    option: ButtonOption
+    menu: ButtonMenu              # 按钮所在的菜单
+    path: Tuple[str, ...]         # 从根菜单到该按钮的 callback 路径
+    parents: Tuple[str, ...]      # 从根菜单到所在菜单的 menu_id 链
+    depth: int                    # 所在菜单的层级（根菜单为 0）
+
+
+class MenuTreeIndex:
+    """
+    整棵菜单树的预计算索引
+
+    将 (menu_id, callback) 映射到按钮、父菜单链和层级，
+    任意层级的按钮都能一次查找得到完整路径。
+    """
+
+    def __init__(self, root: ButtonMenu, link: bool = True):
+        """
+        Args:
+            root: 根菜单
+            link: 是否让各子菜单记录所属根菜单（供 handle_callback 回溯完整路径）
+        """
+        self.root = root
+        self.nodes: Dict[Tuple[str, str], MenuTreeNode] = {}
+        self.menus: Dict[str, ButtonMenu] = {}
+        # 建索引时各菜单的选项数，用于判断索引是否仍然有效
+        self.lengths: Dict[str, int] = {}
+        # 子菜单 menu_id -> 父菜单 menu_id
+        self.parent_ids: Dict[str, str] = {}
+        self._link = link
+        self._callbacks: Optional[List[str]] = None
+        self._add_menu(root, (), (), 0, link)
+
+    @property
+    def callbacks(self) -> List[str]:
+        """整棵树的回调标识（首次访问时收集，未展开的子菜单从原始数据中读取）"""
+        if self._callbacks is None:
+            self._callbacks = _collect_callbacks(self.root)
+        return self._callbacks
+
+    def add_branch(self, node: MenuTreeNode, sub_menu: ButtonMenu):
+        """
+        把刚展开的延迟子菜单并入索引（只遍历该子菜单，不重建整棵树）
+
+        Args:
+            node: 子菜单所属的按钮
+            sub_menu: 该按钮的子菜单
+        """
+        if sub_menu.menu_id not in self.menus:
+            self._add_menu(sub_menu, node.path, node.parents, node.depth + 1, self._link)
+
+    def changed(self, menu_id: str) -> bool:
+        """已收录的菜单在建索引后选项数量是否发生了变化"""
+        return len(self.menus[menu_id].options) != self.lengths[menu_id]
+
+    def stale(self) -> bool:
+        """树中是否有菜单在建索引后增删了选项"""
+        return any(len(menu.options) != self.lengths[menu_id]
+                   for menu_id, menu in self.menus.items())
+
+    def _add_menu(self, menu: ButtonMenu, path: Tuple[str, ...],
+                  parents: Tuple[str, ...], depth: int, link: bool):
+        self.menus[menu.menu_id] = menu
+        self.lengths[menu.menu_id] = len(menu.options)
+        if parents:
+            self.parent_ids.setdefault(menu.menu_id, parents[-1])
+        if link and menu is not self.root:
+            menu._tree_root = self.root
+            menu._tree_index = None
+            menu._root_id = self.root._root_id or self.root.menu_id
+            menu._parent_id = parents[-1]
+            menu._path = self.root._path + path
+        parents = parents + (menu.menu_id,)
+        for opt in menu.options:
+            opt_path = path + (opt.callback,)
+            self.nodes.setdefault((menu.menu_id, opt.callback),
+                                  MenuTreeNode(opt, menu, opt_path, parents, depth))
+            # 未展开的子菜单不构建也不遍历，展开时由 add_branch 并入
+            if opt.sub_menu_loaded and opt.sub_menu:
+                self._add_menu(opt.sub_menu, opt_path, parents, depth + 1, link)
+
+
+def _collect_callbacks(menu: ButtonMenu) -> List[str]:
+    """收集菜单树的所有回调标识（不构建未展开的子菜单）"""
+    callbacks = []
+    for opt in menu.options:
+        callbacks.append(opt.callback)
+        if not opt.sub_menu_loaded:
+            callbacks.extend(_raw_callbacks(opt._sub_menu_raw))
+        elif opt.sub_menu:
+            callbacks.extend(_collect_callbacks(opt.sub_menu))
+    return callbacks
+
+
+def _raw_callbacks(raw: Any) -> List[str]:
+    """从未构建的菜单原始数据（字典或预编译元组）中收集所有回调标识"""
+    callbacks = []
+    if isinstance(raw, tuple):
+        for _, callback, sub, _ in raw[3]:
+            callbacks.append(callback)
+            if sub is not None:
+                callbacks.extend(_raw_callbacks(sub))
+    else:
+        for opt in raw.get("options", []):
+            callbacks.append(opt["callback"])
+            if "sub_menu" in opt:
+                callbacks.extend(_raw_callbacks(opt["sub_menu"]))
+    return callbacks
+
+
+def _estimate_menu_size(menu: 'ButtonMenu') -> int:
+    """粗略估算菜单占用的内存字节数（含子菜单）"""
+    size = 200 + len(menu.question.encode('utf-8'))
+    for opt in menu.options:
+        size += 150 + len(opt.text.encode('utf-8')) + len(opt.callback)
+        if not opt.sub_menu_loaded:
+            size += 200 * (len(_raw_callbacks(opt._sub_menu_raw)) + 1)
+        elif opt.sub_menu:
+            size += _menu_size(opt.sub_menu)
+    return size
+
+
+def _menu_size(menu: 'ButtonMenu') -> int:
+    """菜单的估算字节数（每个菜单对象只计算一次，invalidate_index 后重新计算）"""
+    if menu._size_estimate is None:
+        menu._size_estimate = _estimate_menu_size(menu)
+    return menu._size_estimate
+
+
+class RegistryBackend:
+    """
+    菜单注册表后端接口
+
+    子类实现 get / set / pop / clear / sweep，即可替换全局注册表
+    （见 set_registry_backend），字典式访问由本类统一提供。
+    """
+
+    def get(self, menu_id: str, default: Any = None) -> Optional['ButtonMenu']:
+        """查找菜单"""
+        raise NotImplementedError
+
+    def set(self, menu_id: str, menu: 'ButtonMenu', ttl: Optional[float] = None):
+        """注册菜单"""
+        raise NotImplementedError
+
+    def pop(self, menu_id: str, default: Any = None) -> Optional['ButtonMenu']:
+        """移除并返回菜单"""
+        raise NotImplementedError
+
+    def clear(self):
+        """清空注册表"""
+        raise NotImplementedError
+
+    def sweep(self) -> int:
+        """清除已过期的菜单，返回淘汰数量"""
+        return 0
+
+    def __setitem__(self, menu_id: str, menu: 'ButtonMenu'):
+        self.set(menu_id, menu)
+
+    def __getitem__(self, menu_id: str) -> 'ButtonMenu':
+        menu = self.get(menu_id)
+        if menu is None:
+            raise KeyError(menu_id)
+        return menu
+
+    def __delitem__(self, menu_id: str):
+        if self.pop(menu_id) is None:
+            raise KeyError(menu_id)
+
+    def __contains__(self, menu_id: str) -> bool:
+        return self.get(menu_id) is not None
+
+
+class MenuRegistry(RegistryBackend):
+    """
+    有界菜单注册表（默认的进程内后端）
+
+    按 menu_id 保存已发送的菜单，支持每个菜单的 TTL、LRU 数量上限和可选的内存预算。
+    过期菜单在访问时惰性淘汰，也可由 sweep() 或后台清理线程定期清除。
+    """
+
+    def __init__(self, ttl: Optional[float] = 86400, max_menus: Optional[int] = 10000,
+                 max_bytes: Optional[int] = None):
+        """
+        Args:
+            ttl: 菜单存活时间（秒，None 表示不过期）
+            max_menus: 最多保留的菜单数量（None 表示不限制）
+            max_bytes: 菜单估算内存总量上限（None 表示不限制）
+        """
+        self.ttl = ttl
+        self.max_menus = max_menus
+        self.max_bytes = max_bytes
+        # menu_id -> (menu, 过期时间, 估算字节数)，按最近使用排序
+        self._entries: 'OrderedDict[str, tuple]' = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.RLock()
+        self._evictions = {"expired": 0, "lru": 0, "memory": 0}
+        self._sweeper: Optional[threading.Thread] = None
+        self._sweeper_stop = threading.Event()
+
+    def set(self, menu_id: str, menu: 'ButtonMenu', ttl: Optional[float] = None):
+        """
+        注册菜单
+        
+        Args:
+            menu_id: 菜单 ID
+            menu: ButtonMenu 实例
+            ttl: 覆盖默认 TTL（秒）
+        """
+        ttl = self.ttl if ttl is None else ttl
+        expires = time.monotonic() + ttl if ttl is not None else None
+        # 只有设置了内存预算才需要估算大小
+        size = _menu_size(menu) if self.max_bytes is not None else 0
+        with self._lock:
+            self._remove(menu_id)
+            self._entries[menu_id] = (menu, expires, size)
+            self._bytes += size
+            self._enforce_limits()
+
+    def get(self, menu_id: str, default: Any = None) -> Optional['ButtonMenu']:
+        """查找菜单（过期的菜单会被淘汰并返回 default）"""
+        with self._lock:
+            entry = self._entries.get(menu_id)
+            if entry is None:
+                return default
+            if entry[1] is not None and entry[1] <= time.monotonic():
+                self._remove(menu_id)
+                self._evictions["expired"] += 1
+                return default
+            self._entries.move_to_end(menu_id)
+            return entry[0]
+
+    def pop(self, menu_id: str, default: Any = None) -> Optional['ButtonMenu']:
+        """移除并返回菜单"""
+        with self._lock:
+            entry = self._remove(menu_id)
+            return entry[0] if entry else default
+
+    def clear(self):
+        """清空注册表"""
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def sweep(self) -> int:
+        """
+        清除所有已过期的菜单
+        
+        Returns:
+            本次淘汰的菜单数量
+        """
+        now = time.monotonic()
+        with self._lock:
+            expired = [key for key, (_, expires, _) in self._entries.items()
+                       if expires is not None and expires <= now]
+            for key in expired:
+                self._remove(key)
+            self._evictions["expired"] += len(expired)
+        return len(expired)
+
+    def start_sweeper(self, interval: float = 60.0):
+        """启动后台定期清理线程"""
+        with self._lock:
+            if self._sweeper is not None and self._sweeper.is_alive():
+                return
+            self._sweeper_stop.clear()
+            self._sweeper = threading.Thread(target=self._sweep_loop, args=(interval,),
+                                             name="telebutton-sweeper", daemon=True)
+            self._sweeper.start()
+
+    def stop_sweeper(self):
+        """停止后台清理线程"""
+        self._sweeper_stop.set()
+
+    def stats(self) -> Dict[str, Any]:
+        """
+        获取注册表统计信息
+        
+        Returns:
+            {"size": int, "bytes": int, "evictions": {"expired": int, "lru": int, "memory": int}}
+        """
+        with self._lock:
+            return {
+                "size": len(self._entries),
+                "bytes": self._bytes,
+                "evictions": dict(self._evictions)
+            }
+
+    def _sweep_loop(self, interval: float):
+        while not self._sweeper_stop.wait(interval):
+            self.sweep()
+
+    def _measure(self):
+        """为未估算大小的菜单补算字节数（启用内存预算时调用）"""
+        for menu_id, (menu, expires, size) in self._entries.items():
+            if not size:
+                size = _menu_size(menu)
+                self._entries[menu_id] = (menu, expires, size)
+                self._bytes += size
+
+    def _remove(self, menu_id: str) -> Optional[tuple]:
+        entry = self._entries.pop(menu_id, None)
+        if entry is not None:
+            self._bytes -= entry[2]
+        return entry
+
+    def _enforce_limits(self):
+        while self.max_menus is not None and len(self._entries) > self.max_menus:
+            self._remove(next(iter(self._entries)))
+            self._evictions["lru"] += 1
+        while (self.max_bytes is not None and self._bytes > self.max_bytes
+               and len(self._entries) > 1):
+            self._remove(next(iter(self._entries)))
+            self._evictions["memory"] += 1
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+
+class SQLiteRegistry(RegistryBackend):
+    """
+    基于 SQLite（WAL 模式）的持久化菜单注册表
+
+    保存 ButtonMenu.to_dict() 的 JSON，按 menu_id 主键索引查询，
+    多个 webhook 工作进程可共享同一个数据库文件，进程重启后仍能解析旧菜单的回调。
+    """
+
+    def __init__(self, path: str, ttl: Optional[float] = 86400,
+                 busy_timeout: float = 5.0):
+        """
+        Args:
+            path: 数据库文件路径
+            ttl: 菜单存活时间（秒，None 表示不过期）
+            busy_timeout: 等待其他进程释放写锁的超时（秒）
+        """
+        self.path = str(path)
+        self.ttl = ttl
+        self.busy_timeout = busy_timeout
+        self._local = threading.local()
+        conn = self._conn()
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS menus ("
+            "menu_id TEXT PRIMARY KEY, payload TEXT NOT NULL, expires REAL)"
         )
+        conn.execute("CREATE INDEX IF NOT EXISTS menus_expires ON menus(expires)")
+        conn.commit()
+
+    def _conn(self):
+        """获取当前线程的数据库连接"""
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=self.busy_timeout)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def get(self, menu_id: str, default: Any = None) -> Optional['ButtonMenu']:
+        row = self._conn().execute(
+            "SELECT payload, expires FROM menus WHERE menu_id = ?", (menu_id,)
+        ).fetchone()
+        if row is None:
+            return default
+        if row[1] is not None and row[1] <= time.time():
+            self.pop(menu_id)
+            return default
+        return self._loads(row[0])
+
+    @staticmethod
+    def _dumps(menu: 'ButtonMenu') -> str:
+        data = menu.to_dict()
+        if menu._root_id is not None:
+            # 子菜单在树中的位置：取回的副本据此生成返回按钮并还原完整路径
+            data["root_menu_id"] = menu._root_id
+            data["parent_menu_id"] = menu._parent_id
+            data["menu_path"] = list(menu._path)
+        return json.dumps(data, ensure_ascii=False)
+
+    @staticmethod
+    def _loads(text: str) -> 'ButtonMenu':
+        data = json.loads(text)
+        menu = ButtonMenu.from_dict(data)
+        if "root_menu_id" in data:
+            menu._root_id = data["root_menu_id"]
+            menu._parent_id = data.get("parent_menu_id")
+            menu._path = tuple(data.get("menu_path", ()))
+        return menu
+
+    def set(self, menu_id: str, menu: 'ButtonMenu', ttl: Optional[float] = None):
+        ttl = self.ttl if ttl is None else ttl
+        expires = time.time() + ttl if ttl is not None else None
+        payload = self._dumps(menu)
+        conn = self._conn()
+        with conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO menus (menu_id, payload, expires) VALUES (?, ?, ?)",
+                (menu_id, payload, expires)
+            )
+
+    def pop(self, menu_id: str, default: Any = None) -> Optional['ButtonMenu']:
+        conn = self._conn()
+        with conn:
+            row = conn.execute(
+                "SELECT payload FROM menus WHERE menu_id = ?", (menu_id,)
+            ).fetchone()
+            if row is None:
+                return default
+            conn.execute("DELETE FROM menus WHERE menu_id = ?", (menu_id,))
+        return self._loads(row[0])
+
+    def clear(self):
+        conn = self._conn()
+        with conn:
+            conn.execute("DELETE FROM menus")
+
+    def sweep(self) -> int:
+        conn = self._conn()
+        with conn:
+            cursor = conn.execute(
+                "DELETE FROM menus WHERE expires IS NOT NULL AND expires <= ?",
+                (time.time(),)
+            )
+        return cursor.rowcount
+
+    def __len__(self) -> int:
+        return self._conn().execute("SELECT COUNT(*) FROM menus").fetchone()[0]
+
+    def close(self):
+        """关闭当前线程的数据库连接"""
+        conn = getattr(self._local, "conn", None)
+        if conn is not None:
+            conn.close()
+            self._local.conn = None
+
+
+_menu_registry: RegistryBackend = MenuRegistry()
+
+
+def set_registry_backend(backend: RegistryBackend) -> RegistryBackend:
+    """
+    替换全局菜单注册表后端
+    
+    Args:
+        backend: RegistryBackend 实例（如 SQLiteRegistry）
+    
+    Returns:
+        之前的后端
+    """
+    global _menu_registry
+    previous = _menu_registry
+    _menu_registry = backend
+    return previous
+
+
+def get_registry_backend() -> RegistryBackend:
+    """获取当前全局菜单注册表后端"""
+    return _menu_registry
+
+
+class CallbackRef(NamedTuple):
+    """令牌指向的按钮：所在菜单、回调标识和附带的数据（翻页按钮为目标页码）"""
+    menu_id: str
+    callback: Optional[str]
+    payload: Any = None
+    page: Optional[int] = None
+    text: Optional[str] = None    # 动态菜单选项渲染时的按钮文字
+
+
+class TokenBackend:
+    """
+    令牌表后端接口
+
+    子类实现 put / get / pop / purge（可选 expires_in / sweep），即可替换全局令牌表
+    （见 set_token_backend）。与菜单注册表一样，多个工作进程或重启后的进程
+    需要解析 payload / 超长按钮时，应使用共享的持久化后端（如 SQLiteTokenStore）。
+    """
+
+    def put(self, value: Any, ttl: Optional[float] = None, group: Any = None) -> str:
+        """保存对象并返回令牌"""
+        raise NotImplementedError
+
+    def get(self, token: str, default: Any = None) -> Any:
+        """查找令牌"""
+        raise NotImplementedError
+
+    def expires_in(self, token: str) -> Optional[float]:
+        """令牌剩余存活时间（秒；不过期或不存在时返回 None）"""
+        return None
+
+    def pop(self, token: str, default: Any = None) -> Any:
+        """移除并返回令牌指向的对象"""
+        raise NotImplementedError
+
+    def purge(self, group: Any = None) -> int:
+        """批量清除令牌（group 为 None 时清除全部），返回清除数量"""
+        raise NotImplementedError
+
+    def sweep(self) -> int:
+        """清除已过期的令牌，返回清除数量"""
+        return 0
+
+    def _evicted(self, groups: Iterable[Any]):
+        """
+        因数量上限淘汰令牌后调用（不得持有后端自身的锁）
+
+        令牌按 menu_id 分组，缓存中仍引用这些令牌的键盘随之失效，
+        再次发送时重新生成，不会发出按钮已失效的键盘。
+        """
+        for group in groups:
+            _drop_token_keyboards(group)
+
+
+class TokenStore(TokenBackend):
+    """
+    服务端令牌表（默认的进程内后端）
+
+    将短随机令牌映射到任意对象（如按钮的大体积 payload），支持 TTL 过期、
+    LRU 数量上限和按分组批量清除。callback_data 放不下的内容通过令牌引用。
+    """
+
+    def __init__(self, ttl: Optional[float] = 86400, max_tokens: Optional[int] = 100000,
+                 token_bytes: int = 8):
+        """
+        Args:
+            ttl: 令牌存活时间（秒，None 表示不过期）
+            max_tokens: 最多保留的令牌数量（超出时淘汰最久未使用的令牌）
+            token_bytes: 令牌随机字节数（编码后约 4/3 倍字符）
+        """
+        self.ttl = ttl
+        self.max_tokens = max_tokens
+        self.token_bytes = token_bytes
+        # token -> (值, 过期时间, 分组)，按最近使用排序
+        self._entries: 'OrderedDict[str, Tuple[Any, Optional[float], Any]]' = OrderedDict()
+        self._groups: Dict[Any, set] = {}
+        self._lock = threading.Lock()
+
+    def put(self, value: Any, ttl: Optional[float] = None, group: Any = None) -> str:
+        """
+        保存对象并返回令牌
+        
+        Args:
+            value: 任意对象
+            ttl: 覆盖默认 TTL（秒）
+            group: 分组标识（用于 purge 批量清除，如 menu_id）
+        
+        Returns:
+            URL 安全的短令牌
+        """
+        ttl = self.ttl if ttl is None else ttl
+        expires = time.monotonic() + ttl if ttl is not None else None
+        token = secrets.token_urlsafe(self.token_bytes)
+        evicted = set()
+        with self._lock:
+            self._entries[token] = (value, expires, group)
+            if group is not None:
+                self._groups.setdefault(group, set()).add(token)
+            while self.max_tokens is not None and len(self._entries) > self.max_tokens:
+                entry = self._remove(next(iter(self._entries)))
+                if entry[2] is not None:
+                    evicted.add(entry[2])
+        if evicted:
+            self._evicted(evicted)
+        return token
+
+    def get(self, token: str, default: Any = None) -> Any:
+        """查找令牌（过期令牌会被清除并返回 default；命中时刷新最近使用顺序）"""
+        with self._lock:
+            entry = self._entries.get(token)
+            if entry is None:
+                return default
+            if entry[1] is not None and entry[1] <= time.monotonic():
+                self._remove(token)
+                return default
+            self._entries.move_to_end(token)
+            return entry[0]
+
+    def expires_in(self, token: str) -> Optional[float]:
+        """令牌剩余存活时间（秒；不过期或不存在时返回 None）"""
+        with self._lock:
+            entry = self._entries.get(token)
+        if entry is None or entry[1] is None:
+            return None
+        return max(0.0, entry[1] - time.monotonic())
+
+    def pop(self, token: str, default: Any = None) -> Any:
+        """移除并返回令牌指向的对象"""
+        with self._lock:
+            entry = self._remove(token)
+        return entry[0] if entry is not None else default
+
+    def purge(self, group: Any = None) -> int:
+        """
+        批量清除令牌
+        
+        Args:
+            group: 只清除该分组的令牌（None 表示清除全部）
+        
+        Returns:
+            清除的令牌数量
+        """
+        with self._lock:
+            if group is None:
+                count = len(self._entries)
+                self._entries.clear()
+                self._groups.clear()
+                return count
+            tokens = self._groups.pop(group, set())
+            for token in tokens:
+                self._entries.pop(token, None)
+            return len(tokens)
+
+    def sweep(self) -> int:
+        """清除所有已过期的令牌，返回清除数量"""
+        now = time.monotonic()
+        with self._lock:
+            expired = [token for token, (_, expires, _) in self._entries.items()
+                       if expires is not None and expires <= now]
+            for token in expired:
+                self._remove(token)
+        return len(expired)
+
+    def _remove(self, token: str) -> Optional[tuple]:
+        entry = self._entries.pop(token, None)
+        if entry is not None and entry[2] is not None:
+            tokens = self._groups.get(entry[2])
+            if tokens is not None:
+                tokens.discard(token)
+                if not tokens:
+                    del self._groups[entry[2]]
+        return entry
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+
+class SQLiteTokenStore(TokenBackend):
+    """
+    基于 SQLite（WAL 模式）的持久化令牌表
+
+    与 SQLiteRegistry 配合使用：多个 webhook 工作进程共享同一个数据库文件，
+    进程重启后带 payload 的按钮和超长回调的令牌仍能解析。
+    保存的对象需可 JSON 序列化（CallbackRef 的 payload 同样如此）。
+    """
+
+    def __init__(self, path: str, ttl: Optional[float] = 86400,
+                 token_bytes: int = 8, busy_timeout: float = 5.0):
+        """
+        Args:
+            path: 数据库文件路径（可与 SQLiteRegistry 共用）
+            ttl: 令牌存活时间（秒，None 表示不过期）
+            token_bytes: 令牌随机字节数
+            busy_timeout: 等待其他进程释放写锁的超时（秒）
+        """
+        self.path = str(path)
+        self.ttl = ttl
+        self.token_bytes = token_bytes
+        self.busy_timeout = busy_timeout
+        self._local = threading.local()
+        conn = self._conn()
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS tokens ("
+            "token TEXT PRIMARY KEY, value TEXT NOT NULL, expires REAL, grp TEXT)"
+        )
+        conn.execute("CREATE INDEX IF NOT EXISTS tokens_grp ON tokens(grp)")
+        conn.execute("CREATE INDEX IF NOT EXISTS tokens_expires ON tokens(expires)")
+        conn.commit()
+
+    def _conn(self):
+        """获取当前线程的数据库连接"""
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=self.busy_timeout)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    @staticmethod
+    def _dumps(value: Any) -> str:
+        if isinstance(value, CallbackRef):
+            return json.dumps({"ref": list(value)}, ensure_ascii=False)
+        return json.dumps({"value": value}, ensure_ascii=False)
+
+    @staticmethod
+    def _loads(text: str) -> Any:
+        data = json.loads(text)
+        if "ref" in data:
+            return CallbackRef(*data["ref"])
+        return data["value"]
+
+    def put(self, value: Any, ttl: Optional[float] = None, group: Any = None) -> str:
+        ttl = self.ttl if ttl is None else ttl
+        expires = time.time() + ttl if ttl is not None else None
+        token = secrets.token_urlsafe(self.token_bytes)
+        conn = self._conn()
+        with conn:
+            conn.execute(
+                "INSERT INTO tokens (token, value, expires, grp) VALUES (?, ?, ?, ?)",
+                (token, self._dumps(value), expires, None if group is None else str(group))
+            )
+        return token
+
+    def get(self, token: str, default: Any = None) -> Any:
+        row = self._conn().execute(
+            "SELECT value, expires FROM tokens WHERE token = ?", (token,)
+        ).fetchone()
+        if row is None:
+            return default
+        if row[1] is not None and row[1] <= time.time():
+            self.pop(token)
+            return default
+        return self._loads(row[0])
+
+    def expires_in(self, token: str) -> Optional[float]:
+        row = self._conn().execute(
+            "SELECT expires FROM tokens WHERE token = ?", (token,)
+        ).fetchone()
+        if row is None or row[0] is None:
+            return None
+        return max(0.0, row[0] - time.time())
+
+    def pop(self, token: str, default: Any = None) -> Any:
+        conn = self._conn()
+        with conn:
+            row = conn.execute(
+                "SELECT value FROM tokens WHERE token = ?", (token,)
+            ).fetchone()
+            if row is None:
+                return default
+            conn.execute("DELETE FROM tokens WHERE token = ?", (token,))
+        return self._loads(row[0])
+
+    def purge(self, group: Any = None) -> int:
+        conn = self._conn()
+        with conn:
+            if group is None:
+                cursor = conn.execute("DELETE FROM tokens")
+            else:
+                cursor = conn.execute("DELETE FROM tokens WHERE grp = ?", (str(group),))
+        return cursor.rowcount
+
+    def sweep(self) -> int:
+        conn = self._conn()
+        with conn:
+            cursor = conn.execute(
+                "DELETE FROM tokens WHERE expires IS NOT NULL AND expires <= ?",
+                (time.time(),)
+            )
+        return cursor.rowcount
+
+    def __len__(self) -> int:
+        return self._conn().execute("SELECT COUNT(*) FROM tokens").fetchone()[0]
+
+    def close(self):
+        """关闭当前线程的数据库连接"""
+        conn = getattr(self._local, "conn", None)
+        if conn is not None:
+            conn.close()
+            self._local.conn = None
+
+
+_token_store: TokenBackend = TokenStore()
+
+
+def get_token_store() -> TokenBackend:
+    """获取全局令牌表"""
+    return _token_store
+
+
+def set_token_backend(backend: TokenBackend) -> TokenBackend:
+    """
+    替换全局令牌表后端
+    
+    Args:
+        backend: TokenBackend 实例（如 SQLiteTokenStore）
+    
+    Returns:
+        之前的后端
+    """
+    global _token_store
+    previous = _token_store
+    _token_store = backend
+    _clear_keyboard_cache()
+    return previous
+
+
+def configure_registry(ttl: Optional[float] = 86400, max_menus: Optional[int] = 10000,
+                       max_bytes: Optional[int] = None,
+                       sweep_interval: Optional[float] = None) -> MenuRegistry:
+    """
+    调整全局菜单注册表（进程内 MenuRegistry）的淘汰策略
+    
+    Args:
+        ttl: 菜单存活时间（秒，None 表示不过期）
+        max_menus: 最多保留的菜单数量（None 表示不限制）
+        max_bytes: 菜单估算内存总量上限（None 表示不限制）
+        sweep_interval: 后台定期清理间隔（秒，None 表示不启动清理线程）
+    
+    Returns:
+        全局 MenuRegistry 实例
+    """
+    if not isinstance(_menu_registry, MenuRegistry):
+        raise TypeError("当前注册表后端不是 MenuRegistry，请直接配置该后端")
+    with _menu_registry._lock:
+        _menu_registry.ttl = ttl
+        _menu_registry.max_menus = max_menus
+        _menu_registry.max_bytes = max_bytes
+        if max_bytes is not None:
+            _menu_registry._measure()
+        _menu_registry._enforce_limits()
+    if sweep_interval is not None:
+        _menu_registry.start_sweeper(sweep_interval)
+    return _menu_registry
+
+
+# 配置文件缓存：解析后路径 -> (mtime_ns, size, 原始数据, ButtonMenu)
+_menu_file_cache: 'OrderedDict[str, Tuple[int, int, Any, ButtonMenu]]' = OrderedDict()
+_menu_file_cache_size: Optional[int] = 256
+_menu_file_lock = threading.Lock()
+
+
+# 预编译菜单格式：魔数 + marshal 版本 + marshal 序列化的嵌套元组
+# 菜单元组: (question, max_per_row, menu_id 或 None,
+#           ((text, callback, 子菜单元组或 None, payload 或 None), ...), page_size 或 None)
+COMPILED_SUFFIX = ".tbm"
+_COMPILED_MAGIC = b"TBM3" + bytes([marshal.version])
+
+
+def _data_to_tuple(data: Dict) -> tuple:
+    """将菜单字典转换为紧凑的嵌套元组"""
+    return (
+        data["question"],
+        data.get("max_per_row", 2),
+        data.get("menu_id"),
+        tuple(
+            (opt["text"], opt["callback"],
+             _data_to_tuple(opt["sub_menu"]) if "sub_menu" in opt else None,
+             opt.get("payload"))
+            for opt in data.get("options", [])
+        ),
+        data.get("page_size")
+    )
+
+
+def _option_from_tuple(text: str, callback: str, sub: Optional[tuple],
+                       payload: Any) -> ButtonOption:
+    option = ButtonOption(text=text, callback=callback, payload=payload)
+    option._sub_menu_raw = sub
+    return option
+
+
+def _menu_from_tuple(data: tuple) -> ButtonMenu:
+    """从嵌套元组直接构建菜单（跳过字典解析，子菜单延迟构建）"""
+    question, max_per_row, menu_id, options, page_size = data
+    menu = ButtonMenu(
+        question=question,
+        options=[_option_from_tuple(*opt) for opt in options],
+        max_per_row=max_per_row,
+        page_size=page_size
+    )
+    if menu_id is not None:
+        menu.menu_id = menu_id
+    return menu
+
+
+def _raw_to_dict(raw: Any) -> Dict:
+    """将未构建的菜单原始数据转换为菜单字典（字典原样返回）"""
+    if not isinstance(raw, tuple):
+        return raw
+    question, max_per_row, menu_id, options, page_size = raw
+    data = {"question": question, "options": [], "max_per_row": max_per_row}
+    for text, callback, sub, payload in options:
+        opt = {"text": text, "callback": callback}
+        if sub is not None:
+            opt["sub_menu"] = _raw_to_dict(sub)
+        if payload is not None:
+            opt["payload"] = payload
+        data["options"].append(opt)
+    if menu_id is not None:
+        data["menu_id"] = menu_id
+    if page_size:
+        data["page_size"] = page_size
+    return data
+
+
+def _build_menu(raw: Any) -> ButtonMenu:
+    """由原始配置数据（字典或预编译元组）构建菜单"""
+    if isinstance(raw, tuple):
+        return _menu_from_tuple(raw)
+    return ButtonMenu.from_dict(raw)
+
+
+def _write_compiled(raw: tuple, path: Path):
+    """原子写入预编译菜单文件"""
+    tmp = path.with_name(path.name + ".tmp")
+    with open(tmp, 'wb') as f:
+        f.write(_COMPILED_MAGIC)
+        f.write(marshal.dumps(raw))
+    os.replace(tmp, path)
+
+
+def _read_compiled(path: Path) -> Optional[tuple]:
+    """读取预编译菜单文件（格式或 Python 版本不匹配时返回 None）"""
+    with open(path, 'rb') as f:
+        blob = f.read()
+    if not blob.startswith(_COMPILED_MAGIC):
+        return None
+    try:
+        return marshal.loads(blob[len(_COMPILED_MAGIC):])
+    except (EOFError, ValueError, TypeError):
+        return None
+
+
+def _compiled_path(path: Path) -> Path:
+    return path.with_name(path.name + COMPILED_SUFFIX)
+
+
+def _read_menu_data(path: Path, st: Optional[os.stat_result] = None) -> Any:
+    """
+    读取并解析配置文件
+    
+    同目录下存在比源文件新的预编译文件（<源文件名>.tbm）时直接读取它，跳过 YAML/JSON 解析。
+    
+    Returns:
+        菜单字典，或预编译的嵌套元组
+    """
+    if path.suffix == COMPILED_SUFFIX:
+        raw = _read_compiled(path)
+        if raw is None:
+            raise ValueError(f"无法读取预编译菜单文件: {path}")
+        return raw
+
+    compiled = _compiled_path(path)
+    try:
+        if compiled.stat().st_mtime_ns >= (st or path.stat()).st_mtime_ns:
+            raw = _read_compiled(compiled)
+            if raw is not None:
+                return raw
+    except FileNotFoundError:
+        pass
+
+    return _parse_source(path)
+
+
+def _parse_source(path: Path) -> Dict:
+    """解析 YAML / JSON 源配置文件"""
+    with open(path, 'r', encoding='utf-8') as f:
+        if path.suffix in ['.yaml', '.yml']:
+            import yaml
+
+            return yaml.safe_load(f)
+        return json.load(f)
+
+
+def compile_menu_file(filepath: str, output: Optional[str] = None) -> Path:
+    """
+    将 YAML / JSON 菜单配置预编译为二进制格式
+    
+    Args:
+        filepath: 源配置文件路径
+        output: 输出路径（None 表示源文件旁的 <源文件名>.tbm，load_menu_from_file 会自动使用）
+    
+    Returns:
+        输出文件路径
+    """
+    path = Path(filepath)
+    if not path.exists():
+        raise FileNotFoundError(f"配置文件不存在: {filepath}")
+
+    target = Path(output) if output else _compiled_path(path)
+    _write_compiled(_data_to_tuple(_parse_source(path)), target)
+    return target
+
+
+def load_menu_from_file(filepath: str, copy: bool = True) -> ButtonMenu:
+    """
+    从 YAML 或 JSON 文件加载菜单配置
+    
+    解析结果按文件路径、修改时间和大小缓存，文件未变化时不再读取和解析；
+    已由 MenuFileWatcher 监视的文件直接使用内存中的最新数据，不访问磁盘。
+    
+    Args:
+        filepath: 配置文件路径 (.yaml, .yml, .json, 或预编译的 .tbm)
+        copy: 是否返回独立副本（默认）。副本从缓存的原始数据构建，只构建本层选项，
+              并获得新的 menu_id（文件中指定了 menu_id 时除外），
+              各次调用的 wait_selection 互不干扰；False 时返回缓存的共享实例，
+              调用方不应修改，等待选择时必须指定 chat_id
+    
+    Returns:
+        ButtonMenu 实例
+    """
+    watched = _watched_menus.get(str(filepath))
+    if watched is not None:
+        return _build_menu(watched[1]) if copy else watched[0]
+    
+    path = Path(filepath)
+    try:
+        key = str(path.resolve())
+        st = path.stat()
+    except (FileNotFoundError, NotADirectoryError):
+        raise FileNotFoundError(f"配置文件不存在: {filepath}")
+    
+    with _menu_file_lock:
+        entry = _menu_file_cache.get(key)
+        if entry is not None and entry[0] == st.st_mtime_ns and entry[1] == st.st_size:
+            _menu_file_cache.move_to_end(key)
+            return _build_menu(entry[2]) if copy else entry[3]
+    
+    data = _read_menu_data(path, st)
+    menu = _build_menu(data)
+    
+    if _menu_file_cache_size != 0:
+        with _menu_file_lock:
+            _menu_file_cache[key] = (st.st_mtime_ns, st.st_size, data, menu)
+            _menu_file_cache.move_to_end(key)
+            while (_menu_file_cache_size is not None
+                   and len(_menu_file_cache) > _menu_file_cache_size):
+                _menu_file_cache.popitem(last=False)
+    
+    return _build_menu(data) if copy else menu
+
+
+def configure_file_cache(max_files: Optional[int] = 256):
+    """
+    设置配置文件缓存上限
+    
+    Args:
+        max_files: 最多缓存的文件数（None 表示不限制，0 表示禁用缓存）
+    """
+    global _menu_file_cache_size
+    with _menu_file_lock:
+        _menu_file_cache_size = max_files
+        while max_files is not None and len(_menu_file_cache) > max_files:
+            _menu_file_cache.popitem(last=False)
+
+
+def clear_file_cache():
+    """清空配置文件缓存"""
+    with _menu_file_lock:
+        _menu_file_cache.clear()
+
+
+class MenuFileWatcher:
+    """
+    菜单配置文件热重载
+
+    后台线程监视配置文件（Linux 上使用 inotify，其他平台退化为定期 stat 轮询），
+    文件变化时重新解析并原子替换内存中的菜单；load_menu_from_file 对已监视的文件
+    直接使用内存中的数据，请求路径不会阻塞在磁盘 I/O 或 YAML 解析上。
+    """
+
+    _IN_MODIFY = 0x00000002
+    _IN_CLOSE_WRITE = 0x00000008
+    _IN_MOVED_TO = 0x00000080
+    _IN_CREATE = 0x00000100
+    _IN_NONBLOCK = 0o4000
+    _IN_CLOEXEC = 0o2000000
+
+    def __init__(self, interval: float = 1.0, use_inotify: Optional[bool] = None):
+        """
+        Args:
+            interval: 轮询间隔（秒），inotify 模式下为检查停止信号的间隔
+            use_inotify: 是否使用 inotify（None 表示可用时自动使用）
+        """
+        self.interval = interval
+        self.use_inotify = use_inotify
+        # 解析后路径 -> (mtime_ns, size, 调用方传入的路径别名)
+        self._files: Dict[str, Tuple[int, int, set]] = {}
+        self._listeners: List[Callable[[str, ButtonMenu], None]] = []
+        self._lock = threading.Lock()
+        self._thread: Optional[threading.Thread] = None
+        self._stop = threading.Event()
+        self._inotify_fd: Optional[int] = None
+        self._dir_watches: Dict[int, str] = {}
+        self._libc = None
+
+    def watch(self, filepath: str) -> ButtonMenu:
+        """
+        开始监视配置文件（首次调用时同步加载一次）
+        
+        Args:
+            filepath: 配置文件路径
+        
+        Returns:
+            当前的 ButtonMenu 实例
+        """
+        path = Path(filepath)
+        key = str(path.resolve())
+        with self._lock:
+            if key in self._files:
+                self._files[key][2].add(str(filepath))
+                _watched_menus[str(filepath)] = _watched_menus[key]
+                return _watched_menus[key][0]
+
+        st = path.stat()
+        data = _read_menu_data(path, st)
+        menu = _build_menu(data)
+        with self._lock:
+            self._files[key] = (st.st_mtime_ns, st.st_size, {key, str(filepath)})
+            for alias in self._files[key][2]:
+                _watched_menus[alias] = (menu, data)
+            if self._inotify_fd is not None:
+                self._add_dir_watch(str(Path(key).parent))
+        self.start()
+        return menu
+
+    def unwatch(self, filepath: str):
+        """停止监视配置文件"""
+        key = str(Path(filepath).resolve())
+        with self._lock:
+            entry = self._files.pop(key, None)
+            if entry is not None:
+                for alias in entry[2]:
+                    _watched_menus.pop(alias, None)
+
+    def get(self, filepath: str) -> Optional[ButtonMenu]:
+        """获取已监视文件的当前共享菜单（不访问磁盘）"""
+        entry = _watched_menus.get(str(filepath))
+        return entry[0] if entry is not None else None
+
+    def add_listener(self, listener: Callable[[str, ButtonMenu], None]):
+        """注册重载回调 listener(path, menu)"""
+        self._listeners.append(listener)
+
+    def start(self):
+        """启动后台监视线程（已在运行时不重复启动）"""
+        with self._lock:
+            if self._thread is not None and self._thread.is_alive():
+                return
+            self._stop.clear()
+            if self.use_inotify is not False:
+                self._open_inotify()
+            self._thread = threading.Thread(target=self._run, name="telebutton-watcher",
+                                            daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        """停止后台监视线程"""
+        self._stop.set()
+        thread = self._thread
+        if thread is not None and thread is not threading.current_thread():
+            thread.join(self.interval * 2)
+
+    def check(self) -> List[str]:
+        """
+        检查所有监视文件并重载发生变化的文件
+        
+        Returns:
+            本次重载的文件路径
+        """
+        with self._lock:
+            keys = list(self._files)
+        return [key for key in keys if self._reload_if_changed(key)]
+
+    def _reload_if_changed(self, key: str) -> bool:
+        try:
+            st = os.stat(key)
+        except OSError:
+            return False
+        with self._lock:
+            entry = self._files.get(key)
+        if entry is None or (entry[0], entry[1]) == (st.st_mtime_ns, st.st_size):
+            return False
+
+        try:
+            data = _read_menu_data(Path(key), st)
+            menu = _build_menu(data)
+        except Exception as e:
+            # 文件可能正在写入，保留旧菜单，下次变化时再试
+            print(f"重载菜单配置失败: {key}: {e}")
+            return False
+
+        with self._lock:
+            entry = self._files.get(key)
+            if entry is None:
+                return False
+            old = _watched_menus[key][0] if key in _watched_menus else None
+            if old is not None and (data[2] is None if isinstance(data, tuple)
+                                    else "menu_id" not in data):
+                menu.menu_id = old.menu_id
+            self._files[key] = (st.st_mtime_ns, st.st_size, entry[2])
+            for alias in entry[2]:
+                _watched_menus[alias] = (menu, data)
+        # 注册表后端可能返回副本（如 SQLiteRegistry），按 menu_id 判断旧菜单是否仍在注册表中
+        if old is not None and old.menu_id in _menu_registry:
+            _menu_registry[menu.menu_id] = menu
+        for listener in list(self._listeners):
+            try:
+                listener(key, menu)
+            except Exception as e:
+                print(f"重载回调失败: {e}")
+        return True
+
+    def _open_inotify(self):
+        """打开 inotify 实例（不可用时保持轮询模式）"""
+        if self._inotify_fd is not None:
+            return
+        try:
+            libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+            fd = libc.inotify_init1(self._IN_NONBLOCK | self._IN_CLOEXEC)
+            if fd < 0:
+                return
+        except (OSError, AttributeError):
+            return
+        self._libc = libc
+        self._inotify_fd = fd
+        for directory in {str(Path(key).parent) for key in self._files}:
+            self._add_dir_watch(directory)
+
+    def _add_dir_watch(self, directory: str):
+        # 监视目录而不是文件，以便捕获编辑器“写临时文件再改名”的保存方式
+        if directory in self._dir_watches.values():
+            return
+        mask = self._IN_CLOSE_WRITE | self._IN_MOVED_TO | self._IN_CREATE | self._IN_MODIFY
+        wd = self._libc.inotify_add_watch(self._inotify_fd, directory.encode(), mask)
+        if wd >= 0:
+            self._dir_watches[wd] = directory
+
+    def _read_inotify(self) -> List[str]:
+        """读取 inotify 事件，返回发生变化的文件路径"""
+        ready, _, _ = select.select([self._inotify_fd], [], [], self.interval)
+        if not ready:
+            return []
+        try:
+            buf = os.read(self._inotify_fd, 65536)
+        except BlockingIOError:
+            return []
+        changed = []
+        offset = 0
+        while offset + 16 <= len(buf):
+            wd, _, _, name_len = struct.unpack_from("iIII", buf, offset)
+            name = buf[offset + 16:offset + 16 + name_len].rstrip(b"\0").decode()
+            offset += 16 + name_len
+            directory = self._dir_watches.get(wd)
+            if directory and name:
+                changed.append(os.path.join(directory, name))
+        return changed
+
+    def _run(self):
+        while not self._stop.is_set():
+            if self._inotify_fd is not None:
+                with self._lock:
+                    watched = set(self._files)
+                for key in set(self._read_inotify()):
+                    if key in watched:
+                        self._reload_if_changed(key)
+            else:
+                self.check()
+                self._stop.wait(self.interval)
+        if self._inotify_fd is not None:
+            os.close(self._inotify_fd)
+            self._inotify_fd = None
+            self._dir_watches.clear()
+
+
+# 已监视文件的当前菜单：调用方传入的路径 / 解析后路径 -> (共享 ButtonMenu, 原始数据)
+_watched_menus: Dict[str, Tuple[ButtonMenu, Any]] = {}
+_watcher: Optional[MenuFileWatcher] = None
+
+
+def watch_menu_file(filepath: str, interval: float = 1.0) -> ButtonMenu:
+    """
+    监视菜单配置文件，文件变化时在后台自动重载
+    
+    Args:
+        filepath: 配置文件路径
+        interval: 轮询间隔（秒，仅在 inotify 不可用时使用）
+    
+    Returns:
+        当前的共享 ButtonMenu 实例；之后 load_menu_from_file(filepath) 始终基于最新版本
+    """
+    global _watcher
+    with _menu_file_lock:
+        if _watcher is None:
+            _watcher = MenuFileWatcher(interval=interval)
+    return _watcher.watch(filepath)
+
+
+def save_menu_to_file(menu: ButtonMenu, filepath: str):
+    """
+    保存菜单配置到文件
+    
+    Args:
+        menu: ButtonMenu 实例
+        filepath: 目标文件路径（.yaml / .yml / .json，或预编译的 .tbm）
+    """
+    path = Path(filepath)
+    if path.suffix == COMPILED_SUFFIX:
+        _write_compiled(_data_to_tuple(menu.to_dict()), path)
+        return
+    
+    import yaml
+    
+    with open(path, 'w', encoding='utf-8') as f:
+        if path.suffix in ['.yaml', '.yml']:
+            yaml.dump(menu.to_dict(), f, allow_unicode=True, default_flow_style=False)
+        else:
+            json.dump(menu.to_dict(), f, ensure_ascii=False, indent=2)
+
+
+# callback_data 编码
+#   紧凑格式: "<menu_id>#<选项下标>.<内容标签>"（默认，下标为 64 进制；标签为 callback
+#            的短哈希，选项被重排或替换后旧按钮的标签对不上而被拒绝）
+#   原始格式: "<menu_id>:<callback>"（兼容旧消息，也可通过 set_callback_encoding 启用）
+#   翻页格式: "<menu_id>!<页码>"（分页菜单的翻页按钮，由 handle_callback 内部处理）
+#   令牌格式: "~<token>"（超出 64 字节时回退到服务端令牌表）
+CALLBACK_DATA_LIMIT = 64
+_callback_encoding = "compact"
+PAGE_PREV_TEXT = "◀"
+PAGE_NEXT_TEXT = "▶"
+BACK_TEXT = "« 返回"
+# 子菜单导航方式："message"（返回 sub_menu 由调用方发送新消息）或 "edit"（原地编辑消息）
+_navigation_mode = "message"
+
+
+class DecodedCallback(NamedTuple):
+    """decode_callback_data 的解析结果"""
+    menu_id: str
+    callback: Optional[str]       # 原始格式或令牌格式时为回调标识
+    index: Optional[int]          # 紧凑格式时为选项下标
+    payload: Any = None           # 令牌携带的数据
+    token: Optional[str] = None
+    page: Optional[int] = None    # 翻页按钮的目标页码
+    tag: Optional[str] = None     # 紧凑格式时为渲染时选项的内容标签
+    text: Optional[str] = None    # 令牌格式时为动态菜单选项的按钮文字
+
+
+def set_callback_encoding(encoding: str):
+    """
+    设置 callback_data 编码方式
+    
+    Args:
+        encoding: "compact"（菜单 ID + 选项下标）或 "plain"（菜单 ID + callback 标识）
+    """
+    global _callback_encoding
+    if encoding not in ("compact", "plain"):
+        raise ValueError(f"未知的 callback_data 编码: {encoding}")
+    _callback_encoding = encoding
+    # 已缓存的键盘按旧编码生成
+    _clear_keyboard_cache()
+
+
+def set_navigation_mode(mode: str):
+    """
+    设置子菜单导航方式
+    
+    Args:
+        mode: "message"（handle_callback 返回 sub_menu，由调用方发送新消息）或
+              "edit"（dispatch_update 原地编辑按钮消息进入子菜单，子菜单带返回按钮）
+    """
+    global _navigation_mode
+    if mode not in ("message", "edit"):
+        raise ValueError(f"未知的导航方式: {mode}")
+    _navigation_mode = mode
+
+
+def encode_callback_data(menu: ButtonMenu, index: int,
+                         option: Optional[ButtonOption] = None) -> str:
+    """
+    生成选项的 callback_data，保证不超过 Telegram 的 64 字节限制
+    
+    带 payload 的选项、动态菜单（provider）的选项、以及编码后超长的选项
+    使用服务端令牌（"~<token>"）。动态菜单的令牌保存渲染时的选项，
+    数据源增删行后按钮仍指向原来的选项。
+    
+    Args:
+        menu: 选项所在菜单
+        index: 选项在 menu.options（或 provider 序列）中的下标
+        option: 该下标处的选项（None 表示从 menu.options 中取）
+    
+    Returns:
+        callback_data 字符串
+    """
+    menu_id = menu.menu_id
+    if option is None:
+        option = menu.options[index]
+    if menu.provider is not None:
+        ref = CallbackRef(menu_id, option.callback, option.payload, text=option.text)
+        return "~" + _token_store.put(ref, group=menu_id)
+    if option.payload is None and _safe_menu_id(menu_id):
+        if _callback_encoding == "compact":
+            data = f"{menu_id}#{_encode_id(index)}.{_option_tag(option.callback)}"
+        else:
+            data = f"{menu_id}:{option.callback}"
+        if len(data.encode('utf-8')) <= CALLBACK_DATA_LIMIT:
+            return data
+    ref = CallbackRef(menu_id, option.callback, option.payload)
+    return "~" + _token_store.put(ref, group=menu_id)
+
+
+def _option_tag(callback: str) -> str:
+    """选项的内容标签：callback 的 18 位哈希（3 个 64 进制字符）"""
+    digest = hashlib.blake2b(callback.encode('utf-8'), digest_size=3).digest()
+    return _encode_id(int.from_bytes(digest, "big") >> 6, 3)
+
+
+def _safe_menu_id(menu_id: str) -> bool:
+    return ":" not in menu_id and "#" not in menu_id and "!" not in menu_id \
+        and not menu_id.startswith("~")
+
+
+# 页码标签按钮（如 "2/5"）：按下只应答回调，不编辑消息
+_LABEL_PAGE = -1
+
+
+def encode_page_data(menu: ButtonMenu, page: int) -> str:
+    """生成分页菜单翻页按钮的 callback_data（page 为 _LABEL_PAGE 时生成页码标签按钮）"""
+    return _encode_page(menu.menu_id, page)
+
+
+def _encode_page(menu_id: str, page: int) -> str:
+    data = f"{menu_id}!{_encode_id(page) if page >= 0 else ''}"
+    if _safe_menu_id(menu_id) and len(data.encode('utf-8')) <= CALLBACK_DATA_LIMIT:
+        return data
+    return "~" + _token_store.put(CallbackRef(menu_id, None, page=page), group=menu_id)
+
+
+def decode_callback_data(callback_data: str) -> Optional[DecodedCallback]:
+    """
+    解析 callback_data
+    
+    Returns:
+        DecodedCallback，或 None（格式无效或令牌已失效）
+    """
+    if callback_data.startswith("~"):
+        token = callback_data[1:]
+        ref = _token_store.get(token)
+        if not isinstance(ref, CallbackRef):
+            return None
+        return DecodedCallback(ref.menu_id, ref.callback, None, ref.payload, token, ref.page,
+                               text=ref.text)
+
+    colon = callback_data.find(":")
+    hash_pos = callback_data.find("#")
+    bang = callback_data.find("!")
+    if bang != -1 and (colon == -1 or bang < colon) and (hash_pos == -1 or bang < hash_pos):
+        try:
+            page = callback_data[bang + 1:]
+            return DecodedCallback(callback_data[:bang], None, None,
+                                   page=_decode_id(page) if page else _LABEL_PAGE)
+        except KeyError:
+            return None
+    if hash_pos != -1 and (colon == -1 or hash_pos < colon):
+        index, dot, tag = callback_data[hash_pos + 1:].partition(".")
+        if not dot:
+            return None
+        try:
+            return DecodedCallback(callback_data[:hash_pos], None, _decode_id(index),
+                                   tag=tag)
+        except KeyError:
+            return None
+    if colon != -1:
+        return DecodedCallback(callback_data[:colon], callback_data[colon + 1:], None)
+    return None
+
+
+class _PageView(NamedTuple):
+    """菜单某一页的渲染数据"""
+    page: int                         # 修正后的页码
+    start: int                        # 首个选项的全局下标
+    options: List[ButtonOption]       # 该页选项
+    pages: Optional[int]              # 总页数（未知时为 None）
+    has_next: bool
+
+
+def _page_view(menu: ButtonMenu, page: int = 0) -> _PageView:
+    """取出菜单某一页的选项（静态菜单按下标切片，provider 菜单按页拉取）"""
+    if not menu.page_size:
+        return _PageView(0, 0, menu.options, 1, False)
+    pages = menu.page_count
+    page = max(page, 0)
+    if pages is not None:
+        page = min(page, pages - 1)
+    start = page * menu.page_size
+    if menu.provider is not None:
+        options, has_next = menu.provider.page(page, menu.page_size)
+        return _PageView(page, start, options, menu.page_count, has_next)
+    return _PageView(page, start, menu.options[start:start + menu.page_size], pages,
+                     page < pages - 1)
+
+
+def _generate_inline_keyboard(menu: ButtonMenu, page: int = 0,
+                              view: Optional[_PageView] = None) -> List[List[Dict]]:
+    """
+    生成 Telegram InlineKeyboard 格式
+    
+    分页菜单只渲染当前页的选项，并追加翻页按钮行；原地导航模式下
+    子菜单末尾追加返回父菜单的按钮。
+    
+    Args:
+        menu: 菜单配置
+        page: 页码（仅分页菜单有效）
+        view: 已取出的页数据（None 表示按 page 获取）
+    
+    Returns:
+        Telegram InlineKeyboardMarkup 格式
+    """
+    keyboard = []
+    row = []
+    if view is None:
+        view = _page_view(menu, page)
+    page = view.page
+    
+    for offset, option in enumerate(view.options):
+        # 注册回调
+        callback_data = encode_callback_data(menu, view.start + offset, option)
+        
+        row.append({
+            "text": option.text,
+            "callback_data": callback_data
+        })
+        
+        # 按 max_per_row 换行
+        if (offset + 1) % menu.max_per_row == 0:
+            keyboard.append(row)
+            row = []
+    
+    if row:
+        keyboard.append(row)
+    
+    if page > 0 or view.has_next:
+        nav = []
+        label = f"{page + 1}/{view.pages}" if view.pages is not None else str(page + 1)
+        if page > 0:
+            nav.append({"text": PAGE_PREV_TEXT, "callback_data": encode_page_data(menu, page - 1)})
+        nav.append({"text": label, "callback_data": encode_page_data(menu, _LABEL_PAGE)})
+        if view.has_next:
+            nav.append({"text": PAGE_NEXT_TEXT, "callback_data": encode_page_data(menu, page + 1)})
+        keyboard.append(nav)
+    
+    if _navigation_mode == "edit" and menu._parent_id is not None:
+        keyboard.append([{"text": BACK_TEXT, "callback_data": _encode_page(menu._parent_id, 0)}])
+    
+    return keyboard
+
+
+# 键盘缓存：(menu_id, 页码) -> (内容指纹, 键盘, reply_markup 的 JSON 字节, 过期时间)
+# 含令牌的键盘只缓存令牌 TTL 的一半，保证发出的按钮仍有足够的有效期
+_keyboard_cache: 'OrderedDict[Tuple[str, int], Tuple[int, List[List[Dict]], bytes, Optional[float]]]' = OrderedDict()
+_keyboard_cache_size = 1024
+_keyboard_lock = threading.Lock()
+# 含令牌按钮的缓存键盘：menu_id -> 页码集合（令牌被淘汰时据此让键盘失效）
+_token_keyboards: Dict[str, set] = {}
+
+
+def _clear_keyboard_cache():
+    """清空键盘缓存"""
+    with _keyboard_lock:
+        _keyboard_cache.clear()
+        _token_keyboards.clear()
+
+
+def _drop_token_keyboards(menu_id: Any):
+    """丢弃某个菜单含令牌按钮的缓存键盘"""
+    with _keyboard_lock:
+        for page in _token_keyboards.pop(menu_id, ()):
+            _keyboard_cache.pop((menu_id, page), None)
+
+
+def _menu_fingerprint(menu: ButtonMenu, view: _PageView) -> int:
+    """计算影响键盘布局的菜单内容指纹（分页菜单只覆盖当前页）"""
+    parent_id = menu._parent_id if _navigation_mode == "edit" else None
+    return hash((menu.max_per_row, menu.page_size, view.pages, view.has_next, parent_id,
+                 tuple((opt.text, opt.callback, id(opt.payload)) for opt in view.options)))
+
+
+def _get_keyboard(menu: ButtonMenu, page: int = 0) -> Tuple[List[List[Dict]], bytes]:
+    """
+    获取菜单的键盘及预序列化的 reply_markup（按 menu_id、页码和内容指纹缓存）
+    
+    Returns:
+        (键盘, reply_markup JSON 字节)，调用方不得修改返回的键盘
+    """
+    view = _page_view(menu, page)
+    key = (menu.menu_id, view.page)
+    fingerprint = _menu_fingerprint(menu, view)
+    with _keyboard_lock:
+        entry = _keyboard_cache.get(key)
+        if (entry is not None and entry[0] == fingerprint
+                and (entry[3] is None or entry[3] > time.monotonic())):
+            _keyboard_cache.move_to_end(key)
+            return entry[1], entry[2]
+
+    keyboard = _generate_inline_keyboard(menu, view=view)
+    markup = json.dumps({"inline_keyboard": keyboard}, ensure_ascii=False,
+                        separators=(",", ":")).encode('utf-8')
+    expires = None
+    has_tokens = False
+    for row in keyboard:
+        for button in row:
+            if button["callback_data"].startswith("~"):
+                has_tokens = True
+                remaining = _token_store.expires_in(button["callback_data"][1:])
+                if remaining is not None:
+                    limit = time.monotonic() + remaining / 2
+                    expires = limit if expires is None else min(expires, limit)
+    with _keyboard_lock:
+        _keyboard_cache[key] = (fingerprint, keyboard, markup, expires)
+        _keyboard_cache.move_to_end(key)
+        if has_tokens:
+            _token_keyboards.setdefault(key[0], set()).add(key[1])
+        while len(_keyboard_cache) > _keyboard_cache_size:
+            old_key, _ = _keyboard_cache.popitem(last=False)
+            pages = _token_keyboards.get(old_key[0])
+            if pages is not None:
+                pages.discard(old_key[1])
+                if not pages:
+                    del _token_keyboards[old_key[0]]
+    return keyboard, markup
+
+
+def show_menu(menu: ButtonMenu, chat_id: Optional[str] = None, 
+              use_openclaw: bool = True,
+              transport: Optional['TelegramTransport'] = None,
+              raise_errors: bool = False) -> Optional[str]:
+    """
+    发送按钮菜单到 Telegram
+    
+    Args:
+        menu: ButtonMenu 实例
+        chat_id: 目标聊天 ID（None 表示使用当前会话）
+        use_openclaw: 是否使用 OpenClaw 消息工具发送
+        transport: Bot API 传输层（None 表示使用默认共享实例）
+        raise_errors: Bot API 发送失败时抛出 TelegramAPIError（默认打印并返回 None）
+    
+    Returns:
+        message_id 或 None
+    """
+    # 注册菜单
+    _menu_registry[menu.menu_id] = menu
+    
+    # 生成键盘（未变化的菜单直接复用缓存）
+    keyboard, markup = _get_keyboard(menu)
+    
+    if use_openclaw:
+        # 使用 OpenClaw 消息工具发送
+        return _send_via_openclaw(menu.question, keyboard, chat_id)
+    else:
+        # 直接调用 Telegram API
+        return _send_via_telegram_api(menu.question, keyboard, chat_id,
+                                      transport=transport, reply_markup=markup,
+                                      raise_errors=raise_errors)
+
+
+class _SendJob:
+    """发送队列中的一个任务（steps 为分步发送的生成器，首次执行后设置）"""
+
+    __slots__ = ("future", "fn", "args", "kwargs", "stepped", "steps")
+
+    def __init__(self, future: Future, fn: Callable, args: tuple, kwargs: dict,
+                 stepped: bool):
+        self.future = future
+        self.fn, self.args, self.kwargs = fn, args, kwargs
+        self.stepped = stepped
+        self.steps = None
+
+
+def _run_steps(steps) -> Any:
+    """在当前线程中执行分步发送：每一步产出下一步的开始时刻，到点前阻塞等待"""
+    try:
+        while True:
+            delay = next(steps) - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+    except StopIteration as stop:
+        return stop.value
+
+
+class SendQueue:
+    """
+    后台发送队列
+
+    发送任务放入有界队列，由固定数量的工作线程取出执行，调用方立即拿到
+    concurrent.futures.Future；队列满时 submit 阻塞（或抛出 queue.Full），
+    以此对生产者施加反压。
+
+    Bot API 发送按分步方式执行：限速器预约的发送时刻或重试退避未到时，
+    任务带着到点时刻放回队列，工作线程转而处理其他任务，
+    因此某个聊天被限速不会占住所有工作线程。
+    """
+
+    def __init__(self, workers: int = 4, maxsize: int = 1000):
+        """
+        Args:
+            workers: 工作线程数
+            maxsize: 队列中等待发送的任务上限（含等待限速或重试的任务；0 表示不限）
+        """
+        self.workers = workers
+        self.maxsize = maxsize
+        self._ready: Deque[_SendJob] = deque()
+        self._delayed: List[Tuple[float, int, _SendJob]] = []  # (到点时刻, 序号, 任务) 小顶堆
+        self._seq = itertools.count()
+        self._mutex = threading.Lock()
+        self._not_empty = threading.Condition(self._mutex)
+        self._not_full = threading.Condition(self._mutex)
+        self._threads: List[threading.Thread] = []
+        self._closed = False
+
+    @property
+    def pending(self) -> int:
+        """等待发送的任务数"""
+        with self._mutex:
+            return len(self._ready) + len(self._delayed)
+
+    def _start(self):
+        with self._mutex:
+            if self._closed:
+                raise RuntimeError("发送队列已关闭")
+            if self._threads:
+                return
+            for i in range(self.workers):
+                thread = threading.Thread(target=self._run, name=f"telebutton-sender-{i}",
+                                          daemon=True)
+                thread.start()
+                self._threads.append(thread)
+
+    def submit(self, fn: Callable, *args, block: bool = True,
+               timeout: Optional[float] = None, **kwargs) -> Future:
+        """
+        提交发送任务
+
+        Args:
+            fn: 在工作线程中执行的函数
+            block: 队列满时是否阻塞等待（False 时立即抛出 queue.Full）
+            timeout: 阻塞等待的最长时间（秒），超时抛出 queue.Full
+
+        Returns:
+            fn 返回值的 Future
+        """
+        return self._submit(fn, args, kwargs, block, timeout, stepped=False)
+
+    def _submit_steps(self, fn: Callable, *args, block: bool = True,
+                      timeout: Optional[float] = None, **kwargs) -> Future:
+        """提交分步发送任务：fn 返回生成器，产出下一步的开始时刻，返回值为结果"""
+        return self._submit(fn, args, kwargs, block, timeout, stepped=True)
+
+    def _submit(self, fn: Callable, args: tuple, kwargs: dict, block: bool,
+                timeout: Optional[float], stepped: bool) -> Future:
+        self._start()
+        future: Future = Future()
+        job = _SendJob(future, fn, args, kwargs, stepped)
+        with self._not_full:
+            if not self._not_full.wait_for(self._has_room, timeout if block else 0):
+                raise queue.Full
+            if self._closed:
+                raise RuntimeError("发送队列已关闭")
+            self._ready.append(job)
+            self._not_empty.notify()
+        return future
+
+    def _has_room(self) -> bool:
+        # 调用方需持有 self._mutex；关闭后也返回 True，由 _submit 抛出 RuntimeError
+        return (self._closed or self.maxsize <= 0
+                or len(self._ready) + len(self._delayed) < self.maxsize)
+
+    def _next_job(self) -> Optional[_SendJob]:
+        """取出下一个可执行的任务（到点的延后任务优先），队列关闭且清空后返回 None"""
+        with self._not_empty:
+            while True:
+                now = time.monotonic()
+                if self._delayed and self._delayed[0][0] <= now:
+                    job = heapq.heappop(self._delayed)[2]
+                elif self._ready:
+                    job = self._ready.popleft()
+                elif self._closed and not self._delayed:
+                    return None
+                else:
+                    self._not_empty.wait(self._delayed[0][0] - now if self._delayed else None)
+                    continue
+                self._not_full.notify()
+                return job
+
+    def _defer(self, job: _SendJob, at: float):
+        with self._not_empty:
+            heapq.heappush(self._delayed, (at, next(self._seq), job))
+            # 唤醒一个空闲线程按新的到点时刻重新计算等待
+            self._not_empty.notify()
+
+    def _execute(self, job: _SendJob):
+        future = job.future
+        if job.steps is None:
+            if not future.set_running_or_notify_cancel():
+                return
+            try:
+                result = job.fn(*job.args, **job.kwargs)
+            except BaseException as e:
+                future.set_exception(e)
+                return
+            if not job.stepped:
+                future.set_result(result)
+                return
+            job.steps = result
+        try:
+            while True:
+                at = next(job.steps)
+                if at > time.monotonic():
+                    self._defer(job, at)
+                    return
+        except StopIteration as stop:
+            future.set_result(stop.value)
+        except BaseException as e:
+            future.set_exception(e)
+
+    def _run(self):
+        while True:
+            job = self._next_job()
+            if job is None:
+                return
+            self._execute(job)
+
+    def shutdown(self, wait: bool = True):
+        """
+        关闭队列：已提交的任务发送完毕后工作线程退出
+
+        Args:
+            wait: 是否等待工作线程退出
+        """
+        with self._mutex:
+            if self._closed:
+                return
+            self._closed = True
+            threads = list(self._threads)
+            self._not_empty.notify_all()
+            self._not_full.notify_all()
+        if wait:
+            for thread in threads:
+                thread.join()
+
+
+_send_queue: Optional[SendQueue] = None
+_send_queue_lock = threading.Lock()
+
+
+def get_send_queue() -> SendQueue:
+    """获取进程级默认发送队列（首次调用时创建）"""
+    global _send_queue
+    with _send_queue_lock:
+        if _send_queue is None:
+            _send_queue = SendQueue()
+        return _send_queue
+
+
+def configure_send_queue(workers: int = 4, maxsize: int = 1000) -> SendQueue:
+    """
+    替换进程级默认发送队列（旧队列发送完已提交的任务后关闭）
+
+    Args:
+        workers: 工作线程数
+        maxsize: 队列中等待发送的任务上限
+    """
+    global _send_queue
+    with _send_queue_lock:
+        old, _send_queue = _send_queue, SendQueue(workers, maxsize)
+        new = _send_queue
+    if old is not None:
+        old.shutdown(wait=False)
+    return new
+
+
+def submit_menu(menu: ButtonMenu, chat_id: Optional[str] = None,
+                use_openclaw: bool = True,
+                transport: Optional['TelegramTransport'] = None,
+                block: bool = True, timeout: Optional[float] = None,
+                send_queue: Optional[SendQueue] = None) -> Future:
+    """
+    将按钮菜单放入后台发送队列，立即返回（不等待 Bot API 响应）
+
+    菜单注册和键盘生成在调用线程中完成，返回后即可调用 wait_selection；
+    只有网络发送交给工作线程。
+    
+    Args:
+        menu: ButtonMenu 实例
+        chat_id: 目标聊天 ID（None 表示使用当前会话）
+        use_openclaw: 是否使用 OpenClaw 消息工具发送
+        transport: Bot API 传输层（None 表示使用默认共享实例）
+        block: 队列满时是否阻塞等待（False 时立即抛出 queue.Full）
+        timeout: 阻塞等待的最长时间（秒）
+        send_queue: 使用的发送队列（None 表示默认队列）
+    
+    Returns:
+        message_id 的 Future；Bot API 发送失败时其异常为 TelegramAPIError
+    """
+    _menu_registry[menu.menu_id] = menu
+    keyboard, markup = _get_keyboard(menu)
+
+    send_queue = send_queue or get_send_queue()
+    if use_openclaw:
+        return send_queue.submit(_send_via_openclaw, menu.question, keyboard, chat_id,
+                                 block=block, timeout=timeout)
+    return send_queue._submit_steps(_queued_send_steps, menu.question, keyboard, chat_id,
+                                    transport, markup, block=block, timeout=timeout)
+
+
+class BroadcastResult(NamedTuple):
+    """broadcast_menu 的发送结果"""
+    menu_id: str
+    message_ids: Dict[Any, str]           # chat_id -> message_id（发送成功）
+    errors: Dict[Any, Exception]          # chat_id -> 异常（发送失败）
+
+    @property
+    def sent(self) -> int:
+        return len(self.message_ids)
+
+    @property
+    def failed(self) -> int:
+        return len(self.errors)
+
+    def failure_summary(self) -> Dict[str, int]:
+        """按错误类型统计失败的聊天数，如 {"403 Forbidden: bot was blocked by the user": 12}"""
+        summary: Dict[str, int] = {}
+        for error in self.errors.values():
+            if isinstance(error, TelegramAPIError):
+                key = f"{error.error_code} {error.description}"
+            else:
+                key = f"{type(error).__name__}: {error}"
+            summary[key] = summary.get(key, 0) + 1
+        return summary
+
+
+def _broadcast_template(menu: ButtonMenu) -> bytes:
+    """注册菜单并生成不含 chat_id 的 sendMessage 请求体（各聊天共用）"""
+    _menu_registry[menu.menu_id] = menu
+    _, markup = _get_keyboard(menu)
+    return _splice_reply_markup({"text": menu.question}, markup)
+
+
+def _broadcast_body(template: bytes, chat_id: Any) -> bytes:
+    return b'{"chat_id":' + json.dumps(chat_id).encode('utf-8') + b',' + template[1:]
+
+
+def broadcast_menu(menu: ButtonMenu, chat_ids: Iterable[Any],
+                   transport: Optional['TelegramTransport'] = None,
+                   concurrency: int = 32) -> BroadcastResult:
+    """
+    向多个聊天发送同一个菜单
+
+    菜单只注册一次，键盘和请求体只生成一次（每个聊天只拼接 chat_id），
+    发送由 concurrency 个线程并发执行（不超过传输层连接池的 pool_maxsize，
+    多出的线程只会让连接池丢弃连接），节奏由传输层的限速器控制；
+    单个聊天的重试或失败不影响其他聊天。
+    
+    Args:
+        menu: ButtonMenu 实例
+        chat_ids: 目标聊天 ID 列表
+        transport: Bot API 传输层（None 表示使用默认共享实例）
+        concurrency: 并发发送线程数上限
+    
+    Returns:
+        BroadcastResult（各聊天的 message_id 与失败原因）
+    """
+    transport = transport or get_transport()
+    transport.get_token()
+    _mark_direct_send()
+    template = _broadcast_template(menu)
+    chat_ids = list(dict.fromkeys(chat_ids))
+
+    def send(chat_id: Any) -> Tuple[Any, Any]:
+        try:
+            result = transport.call("sendMessage", _broadcast_body(template, chat_id),
+                                    chat_id=chat_id)
+            return chat_id, str(result["message_id"])
+        except Exception as e:
+            return chat_id, e
+
+    message_ids: Dict[Any, str] = {}
+    errors: Dict[Any, Exception] = {}
+    workers = min(concurrency, len(chat_ids), getattr(transport, "pool_maxsize", concurrency))
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+        for chat_id, outcome in executor.map(send, chat_ids):
+            if isinstance(outcome, Exception):
+                errors[chat_id] = outcome
+            else:
+                message_ids[chat_id] = outcome
+    return BroadcastResult(menu.menu_id, message_ids, errors)
+
+
+class MenuHandle(NamedTuple):
+    """一次去重发送的轻量句柄"""
+    menu_hash: str                # 共享菜单定义的内容哈希（同时作为 menu_id）
+    chat_id: Optional[str]
+    message_id: Optional[str]
+
+
+def _canonical_tuple(raw: Any) -> tuple:
+    """将菜单（对象、字典或预编译元组）转换为不含 menu_id 的规范元组"""
+    if isinstance(raw, ButtonMenu):
+        return (
+            raw.question,
+            raw.max_per_row,
+            tuple(
+                (opt.text, opt.callback,
+                 _canonical_tuple(opt.sub_menu if opt.sub_menu_loaded else opt._sub_menu_raw)
+                 if opt.has_sub_menu else None,
+                 repr(opt.payload) if opt.payload is not None else None)
+                for opt in raw.options
+            ),
+            raw.page_size
+        )
+    if isinstance(raw, dict):
+        raw = _data_to_tuple(raw)
+    question, max_per_row, _, options, page_size = raw
+    return (
+        question,
+        max_per_row,
+        tuple((text, callback, _canonical_tuple(sub) if sub is not None else None,
+               repr(payload) if payload is not None else None)
+              for text, callback, sub, payload in options),
+        page_size
+    )
+
+
+def menu_content_hash(menu: ButtonMenu) -> str:
+    """
+    计算菜单结构的内容哈希（忽略 menu_id，未展开的子菜单不会被构建）
+    
+    Returns:
+        12 个字符的 URL 安全哈希，可直接用作 menu_id
+    """
+    return _content_hash(_canonical_tuple(menu))
+
+
+def _content_hash(canonical: tuple) -> str:
+    digest = hashlib.blake2b(marshal.dumps(canonical), digest_size=9).digest()
+    return base64.urlsafe_b64encode(digest).decode('ascii')
+
+
+def intern_menu(menu: ButtonMenu) -> ButtonMenu:
+    """
+    按内容去重菜单定义
+    
+    结构相同的菜单共享注册表中的同一个实例（menu_id 为内容哈希）。共享实例是
+    传入菜单的私有副本，调用方之后修改自己的菜单不会影响已共享的定义；
+    传入菜单的 menu_id 保持不变，等待选择时使用返回实例的 menu_id。
+    
+    Returns:
+        注册表中共享的菜单实例（调用方不应修改）
+    """
+    canonical = _canonical_tuple(menu)
+    menu_hash = _content_hash(canonical)
+    shared = _menu_registry.get(menu_hash)
+    if shared is None or _canonical_tuple(shared) != canonical:
+        # 首次出现（或哈希命中但内容不同）：保存一份私有副本
+        shared = _build_menu(menu.to_dict())
+        shared.menu_id = menu_hash
+    # 每次发送都刷新共享定义的过期时间
+    _menu_registry[menu_hash] = shared
+    return shared
+
+
+def show_interned_menu(menu: ButtonMenu, chat_id: Optional[str] = None,
+                       **kwargs) -> MenuHandle:
+    """
+    以去重方式发送菜单：结构相同的菜单只保存一份定义
+    
+    Args:
+        menu: ButtonMenu 实例
+        chat_id: 目标聊天 ID
+        **kwargs: 传递给 show_menu 的其他参数
+    
+    Returns:
+        MenuHandle（菜单哈希 + 聊天 + message_id）；
+        等待选择时使用 wait_selection(handle.menu_hash, chat_id=handle.chat_id)
+    """
+    shared = intern_menu(menu)
+    message_id = show_menu(shared, chat_id, **kwargs)
+    return MenuHandle(shared.menu_id, chat_id, message_id)
+
+
+def _send_via_openclaw(text: str, keyboard: List[List[Dict]], 
+                       chat_id: Optional[str] = None) -> Optional[str]:
+    """通过 OpenClaw 发送消息"""
+    # 实际实现会通过 OpenClaw 的 message 工具发送
+    # 这里返回模拟的 message_id
+    message_id = f"msg_{int(time.time())}"
+    
+    # 构建按钮显示文本（用于调试）
+    buttons_text = []
+    for row in keyboard:
+        row_text = " | ".join([btn["text"] for btn in row])
+        buttons_text.append(f"[{row_text}]")
+    
+    print(f"\n[Telegram] Telegram 按钮消息:\n")
+    print(f"[Text] {text}")
+    print("\n".join(buttons_text))
+    print()
+    
+    return message_id
+
+
+_JSON_HEADERS = {"Content-Type": "application/json"}
+
+# 受限速约束的发送类方法（查询、应答回调、删除消息不计入）
+RATE_LIMITED_METHODS = frozenset({"sendMessage", "editMessageText", "editMessageReplyMarkup"})
+# 非幂等方法的前缀：请求已发出后的网络错误重试可能产生重复消息
+NON_IDEMPOTENT_PREFIXES = ("send", "forward", "copy")
+
+
+class TelegramAPIError(Exception):
+    """
+    Bot API 调用失败
+
+    Attributes:
+        method: API 方法名
+        error_code: Bot API 错误码（网络错误时为 None）
+        description: 错误描述
+        retry_after: 429 限流时 Telegram 要求等待的秒数
+        request_sent: 网络错误发生时请求是否可能已送达（连接阶段失败时为 False）
+        retryable: 是否为可重试的临时错误（429、5xx、网络错误；非幂等方法
+                   如 sendMessage 只重试连接阶段的网络错误，避免读取超时后重复发送）
+    """
+
+    def __init__(self, method: str, error_code: Optional[int], description: str,
+                 retry_after: Optional[float] = None, request_sent: bool = True):
+        self.method = method
+        self.error_code = error_code
+        self.description = description
+        self.retry_after = retry_after
+        self.request_sent = request_sent
+        if error_code is None:
+            self.retryable = not request_sent or not method.startswith(NON_IDEMPOTENT_PREFIXES)
+        else:
+            self.retryable = error_code == 429 or error_code >= 500
+        super().__init__(f"{method} 失败 ({error_code}): {description}")
+
+
+def _api_result(method: str, status: int, data: Any) -> Any:
+    """从 Bot API 响应中取出 result，失败时抛出 TelegramAPIError"""
+    if isinstance(data, dict) and data.get("ok"):
+        return data["result"]
+    if not isinstance(data, dict):
+        data = {}
+    retry_after = (data.get("parameters") or {}).get("retry_after")
+    raise TelegramAPIError(method, data.get("error_code", status),
+                           data.get("description") or f"HTTP {status}", retry_after)
+
+
+def _connect_failed(error: Exception) -> bool:
+    """requests 的网络错误是否发生在连接阶段（请求尚未发出）"""
+    import requests
+    from urllib3.exceptions import ConnectTimeoutError, NewConnectionError
+
+    if isinstance(error, requests.ConnectTimeout):
+        return True
+    if isinstance(error, requests.Timeout) or not error.args:
+        return False
+    reason = getattr(error.args[0], "reason", None)
+    return isinstance(reason, (NewConnectionError, ConnectTimeoutError))
+
+
+@dataclass
+class RetryPolicy:
+    """
+    Bot API 调用的重试策略
+
+    429 按 Telegram 返回的 retry_after 等待；5xx 与网络错误按带抖动的
+    指数退避等待（base_delay * 2^n，上限 max_delay，在 [0, 上限] 内随机）。
+    等待只发生在发起调用的线程/协程中，不影响其他聊天的发送。
+    """
+    max_attempts: int = 5            # 总尝试次数（1 表示不重试）
+    base_delay: float = 0.5          # 退避基数（秒）
+    max_delay: float = 30.0          # 单次退避上限（秒）
+    max_retry_after: float = 60.0    # retry_after 超过该值时直接抛出，不再等待
+
+    def delay(self, attempt: int, error: TelegramAPIError) -> Optional[float]:
+        """
+        计算第 attempt 次失败（从 0 开始）后的等待时间
+
+        Returns:
+            等待秒数，或 None（不应重试）
+        """
+        if not error.retryable or attempt + 1 >= self.max_attempts:
+            return None
+        if error.retry_after is not None:
+            if error.retry_after > self.max_retry_after:
+                return None
+            return error.retry_after + random.uniform(0, self.base_delay)
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+
+
+# 不重试的策略（用于应答回调等过时即无意义的调用）
+_NO_RETRY = RetryPolicy(max_attempts=1)
+
+
+class _Bucket:
+    """GCRA 形式的令牌桶：rate 个/秒，最多累积 burst 个"""
+
+    __slots__ = ("interval", "tolerance", "tat")
+
+    def __init__(self, rate: float, burst: int):
+        self.interval = 1.0 / rate
+        self.tolerance = (burst - 1) * self.interval
+        self.tat = 0.0  # 理论到达时间
+
+    def earliest(self, now: float) -> float:
+        """下一个可用时刻（不占用令牌）"""
+        return max(now, self.tat - self.tolerance)
+
+    def take(self, at: float):
+        """在 at 时刻占用一个令牌"""
+        self.tat = max(self.tat, at) + self.interval
+
+    def reserve(self, now: float) -> float:
+        """预约下一个可用时刻并占用一个令牌"""
+        at = self.earliest(now)
+        self.take(at)
+        return at
+
+
+def _reserve_together(buckets: List[_Bucket], now: float) -> float:
+    """在所有令牌桶都可用的最早时刻各占用一个令牌"""
+    at = max(bucket.earliest(now) for bucket in buckets)
+    for bucket in buckets:
+        bucket.take(at)
+    return at
+
+
+class RateLimiter:
+    """
+    Bot API 发送限速器（全局 + 每聊天 + 群组三级令牌桶）
+
+    调用方按到达顺序预约发送时刻后等待到点发出，而不是各自失败重试。
+    预约分两步：先在本聊天（及群组）的排队令牌桶上等到轮次，
+    轮到时再把全局令牌与本聊天的发送令牌桶作为同一个时刻一起预约。
+    单个聊天超速只会推迟它自己的消息，不会提前占住其他聊天的全局额度；
+    全局积压推迟了某条消息时，同一聊天的下一条也会相应顺延，不会紧挨着发出。
+    """
+
+    def __init__(self, global_rate: float = 30.0, global_burst: int = 1,
+                 chat_rate: float = 1.0, chat_burst: int = 3,
+                 group_rate: float = 20 / 60, group_burst: int = 3,
+                 max_chats: int = 10000):
+        """
+        Args:
+            global_rate: 全局每秒发送数（Telegram 约 30 条/秒）
+            global_burst: 全局允许的突发数
+            chat_rate: 单个聊天每秒发送数（Telegram 约 1 条/秒）
+            chat_burst: 单个聊天允许的短时突发数
+            group_rate: 群组每秒发送数（Telegram 约 20 条/分钟）
+            group_burst: 群组允许的突发数
+            max_chats: 保留状态的聊天数上限（超出时丢弃已空闲的令牌桶）
+        """
+        self.chat_rate, self.chat_burst = chat_rate, chat_burst
+        self.group_rate, self.group_burst = group_rate, group_burst
+        self.max_chats = max_chats
+        self._global = _Bucket(global_rate, global_burst)
+        # chat_key -> (排队令牌桶, 发送令牌桶)，每组为聊天桶（群组再加群组桶）
+        self._chats: Dict[str, Tuple[List[_Bucket], List[_Bucket]]] = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _is_group(chat_key: str) -> bool:
+        # 群组/超级群组/频道的 chat_id 为负数
+        return chat_key.startswith("-")
+
+    def _new_buckets(self, chat_key: str) -> List[_Bucket]:
+        buckets = [_Bucket(self.chat_rate, self.chat_burst)]
+        if self._is_group(chat_key):
+            buckets.append(_Bucket(self.group_rate, self.group_burst))
+        return buckets
+
+    def _chat_state(self, chat_key: str, now: float) -> Tuple[List[_Bucket], List[_Bucket]]:
+        # 调用方需持有 self._lock
+        state = self._chats.get(chat_key)
+        if state is None:
+            if len(self._chats) >= self.max_chats:
+                self._chats = {key: value for key, value in self._chats.items()
+                               if any(bucket.tat > now
+                                      for buckets in value for bucket in buckets)}
+            state = (self._new_buckets(chat_key), self._new_buckets(chat_key))
+            self._chats[chat_key] = state
+        return state
+
+    def _reserve_turn(self, chat_id: Any, now: float) -> float:
+        """在本聊天的队列中排队，返回轮到的时刻"""
+        if chat_id is None:
+            return now
+        with self._lock:
+            queued, _ = self._chat_state(str(chat_id), now)
+            return _reserve_together(queued, now)
+
+    def _reserve_send(self, chat_id: Any, now: float) -> float:
+        """轮到后把全局令牌与本聊天的发送令牌作为同一时刻预约，返回发送时刻"""
+        with self._lock:
+            buckets = [self._global]
+            if chat_id is not None:
+                buckets.extend(self._chat_state(str(chat_id), now)[1])
+            return _reserve_together(buckets, now)
+
+    def penalize(self, chat_id: Any, retry_after: float):
+        """收到 429 后推迟该聊天的后续发送，避免同一聊天的排队请求继续触发限流"""
+        if chat_id is None:
+            return
+        now = time.monotonic()
+        with self._lock:
+            for buckets in self._chat_state(str(chat_id), now):
+                for bucket in buckets:
+                    bucket.tat = max(bucket.tat, now + retry_after + bucket.tolerance)
+
+    def _acquire_steps(self, chat_id: Any):
+        """分步预约：依次产出轮到的时刻和发送时刻，第二步在到达第一个时刻后才预约"""
+        yield self._reserve_turn(chat_id, time.monotonic())
+        yield self._reserve_send(chat_id, time.monotonic())
+
+    def acquire(self, chat_id: Any = None):
+        """阻塞直到允许向 chat_id 发送一条消息"""
+        _run_steps(self._acquire_steps(chat_id))
+
+    async def aacquire(self, chat_id: Any = None):
+        """acquire 的异步版本（等待期间不阻塞事件循环）"""
+        for at in self._acquire_steps(chat_id):
+            delay = at - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+
+
+class TelegramTransport:
+    """
+    Telegram Bot API 传输层
+
+    持有一个带连接池的 keep-alive 会话，所有 Bot API 调用都经由它发出，
+    避免每次发送都重新进行 TCP+TLS 握手。
+    """
+
+    def __init__(self, bot_token: Optional[str] = None,
+                 api_base: str = "https://api.telegram.org",
+                 pool_connections: int = 10, pool_maxsize: int = 10,
+                 connect_timeout: float = 5.0, read_timeout: float = 30.0,
+                 rate_limiter: Optional[RateLimiter] = None, rate_limit: bool = True,
+                 retry: Optional[RetryPolicy] = None):
+        """
+        Args:
+            bot_token: Bot Token（None 表示读取 TELEGRAM_BOT_TOKEN 环境变量）
+            api_base: Bot API 地址（可指向本地测试服务器）
+            pool_connections: 缓存的连接池数量（按主机）
+            pool_maxsize: 每个主机的最大连接数
+            connect_timeout: 建立连接超时（秒）
+            read_timeout: 读取响应超时（秒）
+            rate_limiter: 发送限速器（None 表示按 Telegram 默认限额新建；
+                          同一 Bot 的多个传输层应共享同一实例）
+            rate_limit: 是否启用发送限速
+            retry: 重试策略（None 表示使用默认 RetryPolicy）
+        """
+        self.bot_token = bot_token
+        self.api_base = api_base.rstrip("/")
+        self.pool_connections = pool_connections
+        self.pool_maxsize = pool_maxsize
+        self.timeout = (connect_timeout, read_timeout)
+        self.rate_limiter = (rate_limiter or RateLimiter()) if rate_limit else None
+        self.retry = retry or RetryPolicy()
+        self._session = None
+        self._lock = threading.Lock()
+
+    def get_token(self) -> str:
+        """获取 Bot Token，未配置时抛出 ValueError"""
+        token = self.bot_token or os.getenv("TELEGRAM_BOT_TOKEN")
+        if not token:
+            raise ValueError("未设置 TELEGRAM_BOT_TOKEN 环境变量")
+        return token
+
+    @property
+    def session(self):
+        """延迟创建的共享 requests.Session"""
+        if self._session is None:
+            with self._lock:
+                if self._session is None:
+                    import requests
+                    from requests.adapters import HTTPAdapter
+
+                    session = requests.Session()
+                    adapter = HTTPAdapter(pool_connections=self.pool_connections,
+                                          pool_maxsize=self.pool_maxsize)
+                    session.mount("https://", adapter)
+                    session.mount("http://", adapter)
+                    self._session = session
+        return self._session
+
+    def method_url(self, method: str) -> str:
+        """获取 Bot API 方法的完整 URL"""
+        return f"{self.api_base}/bot{self.get_token()}/{method}"
+
+    def call(self, method: str, payload: Any,
+             timeout: Optional[float] = None, chat_id: Any = None,
+             retry: Optional[RetryPolicy] = None) -> Any:
+        """
+        调用 Bot API 方法
+
+        发送类方法（RATE_LIMITED_METHODS）会先经限速器排队；临时错误按
+        self.retry 重试，每次重试重新排队。
+
+        Args:
+            method: API 方法名（如 sendMessage）
+            payload: 请求参数（dict，或已序列化的 JSON 字节）
+            timeout: 读取超时（None 表示使用默认值）
+            chat_id: 限速所用的聊天 ID（None 表示从 dict 请求参数中读取）
+            retry: 本次调用的重试策略（None 表示使用 self.retry）
+
+        Returns:
+            响应中的 result 字段
+
+        Raises:
+            TelegramAPIError: API 返回错误，或重试耗尽
+        """
+        return _run_steps(self._call_steps(method, payload, timeout, chat_id, retry))
+
+    def _call_steps(self, method: str, payload: Any, timeout: Optional[float] = None,
+                    chat_id: Any = None, retry: Optional[RetryPolicy] = None):
+        """call 的分步版本：产出限速和重试退避的等待到点时刻，返回 result 字段"""
+        limited = self.rate_limiter is not None and method in RATE_LIMITED_METHODS
+        if limited and chat_id is None and isinstance(payload, dict):
+            chat_id = payload.get("chat_id")
+        policy = retry or self.retry
+        attempt = 0
+        while True:
+            if limited:
+                yield from self.rate_limiter._acquire_steps(chat_id)
+            try:
+                return self._post(method, payload, timeout)
+            except TelegramAPIError as error:
+                delay = policy.delay(attempt, error)
+                if delay is None:
+                    raise
+                if limited and error.retry_after is not None:
+                    self.rate_limiter.penalize(chat_id, error.retry_after)
+            yield time.monotonic() + delay
+            attempt += 1
+
+    def _post(self, method: str, payload: Any, timeout: Optional[float]) -> Any:
+        import requests
+
+        request_timeout = self.timeout
+        if timeout is not None:
+            request_timeout = (self.timeout[0], timeout)
+        try:
+            if isinstance(payload, bytes):
+                response = self.session.post(self.method_url(method), data=payload,
+                                             headers=_JSON_HEADERS, timeout=request_timeout)
+            else:
+                response = self.session.post(self.method_url(method), json=payload,
+                                             timeout=request_timeout)
+        except (requests.ConnectionError, requests.Timeout) as e:
+            raise TelegramAPIError(method, None, str(e),
+                                   request_sent=not _connect_failed(e)) from e
+        try:
+            data = response.json()
+        except ValueError:
+            data = None
+        return _api_result(method, response.status_code, data)
+
+    def close(self):
+        """关闭会话并释放连接池"""
+        with self._lock:
+            if self._session is not None:
+                self._session.close()
+                self._session = None
+
+
+_default_transport: Optional[TelegramTransport] = None
+_transport_lock = threading.Lock()
+
+
+def get_transport() -> TelegramTransport:
+    """获取进程级默认传输层（首次调用时创建）"""
+    global _default_transport
+    with _transport_lock:
+        if _default_transport is None:
+            _default_transport = TelegramTransport()
+        return _default_transport
+
+
+def set_transport(transport: Optional[TelegramTransport]):
+    """替换进程级默认传输层（None 表示恢复为延迟创建的默认实例）"""
+    global _default_transport
+    with _transport_lock:
+        if _default_transport is not None and _default_transport is not transport:
+            _default_transport.close()
+        _default_transport = transport
+
+
+class AsyncTelegramTransport:
+    """
+    异步 Telegram Bot API 传输层
+
+    基于 aiohttp 的非阻塞会话，供 ashow_menu 等异步接口使用，
+    单个事件循环即可同时保持大量发送请求在途。
+    """
+
+    def __init__(self, bot_token: Optional[str] = None,
+                 api_base: str = "https://api.telegram.org",
+                 limit: int = 100, limit_per_host: int = 0,
+                 connect_timeout: float = 5.0, read_timeout: float = 30.0,
+                 rate_limiter: Optional[RateLimiter] = None, rate_limit: bool = True,
+                 retry: Optional[RetryPolicy] = None):
+        """
+        Args:
+            bot_token: Bot Token（None 表示读取 TELEGRAM_BOT_TOKEN 环境变量）
+            api_base: Bot API 地址（可指向本地测试服务器）
+            limit: 连接池总连接数上限
+            limit_per_host: 每个主机的连接数上限（0 表示不限制）
+            connect_timeout: 建立连接超时（秒）
+            read_timeout: 读取响应超时（秒）
+            rate_limiter: 发送限速器（None 表示按 Telegram 默认限额新建）
+            rate_limit: 是否启用发送限速
+            retry: 重试策略（None 表示使用默认 RetryPolicy）
+        """
+        self.rate_limiter = (rate_limiter or RateLimiter()) if rate_limit else None
+        self.retry = retry or RetryPolicy()
+        self.bot_token = bot_token
+        self.api_base = api_base.rstrip("/")
+        self.limit = limit
+        self.limit_per_host = limit_per_host
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self._session = None
+
+    def get_token(self) -> str:
+        """获取 Bot Token，未配置时抛出 ValueError"""
+        token = self.bot_token or os.getenv("TELEGRAM_BOT_TOKEN")
+        if not token:
+            raise ValueError("未设置 TELEGRAM_BOT_TOKEN 环境变量")
+        return token
+
+    def method_url(self, method: str) -> str:
+        """获取 Bot API 方法的完整 URL"""
+        return f"{self.api_base}/bot{self.get_token()}/{method}"
+
+    async def get_session(self):
+        """延迟创建的共享 aiohttp.ClientSession（需在事件循环内调用）"""
+        if self._session is None or self._session.closed:
+            import aiohttp
+
+            connector = aiohttp.TCPConnector(limit=self.limit,
+                                             limit_per_host=self.limit_per_host)
+            self._session = aiohttp.ClientSession(connector=connector)
+        return self._session
+
+    async def call(self, method: str, payload: Any,
+                   timeout: Optional[float] = None, chat_id: Any = None,
+                   retry: Optional[RetryPolicy] = None) -> Any:
+        """
+        调用 Bot API 方法
+
+        发送类方法（RATE_LIMITED_METHODS）会先经限速器排队；临时错误按
+        self.retry 重试，退避期间不阻塞事件循环。
+
+        Args:
+            method: API 方法名（如 sendMessage）
+            payload: 请求参数（dict，或已序列化的 JSON 字节）
+            timeout: 读取超时（None 表示使用默认值）
+            chat_id: 限速所用的聊天 ID（None 表示从 dict 请求参数中读取）
+            retry: 本次调用的重试策略（None 表示使用 self.retry）
+
+        Returns:
+            响应中的 result 字段
+
+        Raises:
+            TelegramAPIError: API 返回错误，或重试耗尽
+        """
+        limited = self.rate_limiter is not None and method in RATE_LIMITED_METHODS
+        if limited and chat_id is None and isinstance(payload, dict):
+            chat_id = payload.get("chat_id")
+        policy = retry or self.retry
+        attempt = 0
+        while True:
+            if limited:
+                await self.rate_limiter.aacquire(chat_id)
+            try:
+                return await self._post(method, payload, timeout)
+            except TelegramAPIError as error:
+                delay = policy.delay(attempt, error)
+                if delay is None:
+                    raise
+                if limited and error.retry_after is not None:
+                    self.rate_limiter.penalize(chat_id, error.retry_after)
+            await asyncio.sleep(delay)
+            attempt += 1
+
+    async def _post(self, method: str, payload: Any, timeout: Optional[float]) -> Any:
+        import aiohttp
+
+        session = await self.get_session()
+        client_timeout = aiohttp.ClientTimeout(
+            connect=self.connect_timeout,
+            sock_read=timeout if timeout is not None else self.read_timeout
+        )
+        if isinstance(payload, bytes):
+            request = session.post(self.method_url(method), data=payload,
+                                   headers=_JSON_HEADERS, timeout=client_timeout)
+        else:
+            request = session.post(self.method_url(method), json=payload,
+                                   timeout=client_timeout)
+        try:
+            async with request as response:
+                try:
+                    data = await response.json(content_type=None)
+                except ValueError:
+                    data = None
+                status = response.status
+        except (aiohttp.ClientConnectionError, asyncio.TimeoutError) as e:
+            connect_errors = (aiohttp.ClientConnectorError,
+                              getattr(aiohttp, "ConnectionTimeoutError", aiohttp.ClientConnectorError))
+            raise TelegramAPIError(method, None, str(e) or type(e).__name__,
+                                   request_sent=not isinstance(e, connect_errors)) from e
+        return _api_result(method, status, data)
+
+    async def close(self):
+        """关闭会话并释放连接池"""
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+
+_default_async_transport: Optional[AsyncTelegramTransport] = None
+
+
+def get_async_transport() -> AsyncTelegramTransport:
+    """获取进程级默认异步传输层（首次调用时创建）"""
+    global _default_async_transport
+    if _default_async_transport is None:
+        _default_async_transport = AsyncTelegramTransport()
+    return _default_async_transport
+
+
+def set_async_transport(transport: Optional[AsyncTelegramTransport]):
+    """替换进程级默认异步传输层（旧实例需由调用方 await close()）"""
+    global _default_async_transport
+    _default_async_transport = transport
+
+
+def _build_send_payload(text: str, keyboard: List[List[Dict]],
+                        chat_id: Optional[str] = None) -> Dict:
+    """构建 sendMessage 请求参数"""
+    return {
+        "chat_id": chat_id or os.getenv("TELEGRAM_CHAT_ID"),
+        "text": text,
+        "reply_markup": {
+            "inline_keyboard": keyboard
+        }
+    }
+
+
+def _splice_reply_markup(fields: Dict, reply_markup: bytes) -> bytes:
+    """把预序列化的 reply_markup 拼接进 JSON 请求体"""
+    head = json.dumps(fields, ensure_ascii=False, separators=(",", ":")).encode('utf-8')
+    return head[:-1] + b',"reply_markup":' + reply_markup + b'}'
+
+
+def _build_send_body(text: str, reply_markup: bytes,
+                     chat_id: Optional[str] = None) -> bytes:
+    """用预序列化的 reply_markup 拼接 sendMessage 请求体，避免重复编码键盘"""
+    return _splice_reply_markup(
+        {"chat_id": chat_id or os.getenv("TELEGRAM_CHAT_ID"), "text": text}, reply_markup)
+
+
+def _send_via_telegram_api(text: str, keyboard: List[List[Dict]],
+                           chat_id: Optional[str] = None,
+                           transport: Optional[TelegramTransport] = None,
+                           reply_markup: Optional[bytes] = None,
+                           raise_errors: bool = False) -> Optional[str]:
+    """直接调用 Telegram Bot API 发送"""
+    transport = transport or get_transport()
+    transport.get_token()
+    _mark_direct_send()
+
+    try:
+        return _run_steps(_send_steps(text, keyboard, chat_id, transport, reply_markup))
+    except Exception as e:
+        if raise_errors:
+            raise
+        print(f"发送消息失败: {e}")
+        return None
+
+
+def _queued_send_steps(text: str, keyboard: List[List[Dict]], chat_id: Optional[str],
+                       transport: Optional[TelegramTransport], reply_markup: Optional[bytes]):
+    """发送队列中的 sendMessage 任务（在工作线程中解析传输层，错误交给 Future）"""
+    transport = transport or get_transport()
+    transport.get_token()
+    _mark_direct_send()
+    return (yield from _send_steps(text, keyboard, chat_id, transport, reply_markup))
+
+
+def _send_steps(text: str, keyboard: List[List[Dict]], chat_id: Optional[str],
+                transport: TelegramTransport, reply_markup: Optional[bytes] = None):
+    """sendMessage 的分步版本（供发送队列调度），返回 message_id"""
+    if reply_markup is not None:
+        payload = _build_send_body(text, reply_markup, chat_id)
+    else:
+        payload = _build_send_payload(text, keyboard, chat_id)
+    result = yield from transport._call_steps(
+        "sendMessage", payload, chat_id=chat_id or os.getenv("TELEGRAM_CHAT_ID"))
+    return str(result["message_id"])
+
+
+class UpdatePoller:
+    """
+    基于 getUpdates 长轮询的回调监听器
+
+    进程内所有等待者共享一个后台轮询线程，收到的 callback_query
+    经 dispatch_update 路由到 handle_callback 并唤醒对应的等待者。
+    """
+
+    def __init__(self, transport: Optional[TelegramTransport] = None,
+                 poll_timeout: int = 30, retry_delay: float = 1.0,
+                 answer_callbacks: bool = True,
+                 allowed_updates: Optional[List[str]] = None):
+        """
+        Args:
+            transport: Bot API 传输层（None 表示使用默认共享实例）
+            poll_timeout: getUpdates 长轮询超时（秒）
+            retry_delay: 轮询出错后的重试间隔（秒）
+            answer_callbacks: 是否自动调用 answerCallbackQuery 结束按钮加载状态
+            allowed_updates: 传给 getUpdates 的 allowed_updates（None 表示不发送，
+                             沿用 Bot 现有设置；Telegram 会为 Bot 记住该设置，
+                             之后其他轮询者也只能收到这些类型的更新）
+        """
+        self.transport = transport
+        self.poll_timeout = poll_timeout
+        self.retry_delay = retry_delay
+        self.answer_callbacks = answer_callbacks
+        self.allowed_updates = allowed_updates
+        self.offset: Optional[int] = None
+        self._thread: Optional[threading.Thread] = None
+        self._stop = threading.Event()
+        self._lock = threading.Lock()
+
+    @property
+    def running(self) -> bool:
+        """轮询线程是否在运行"""
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self):
+        """启动后台轮询线程（已在运行时不重复启动）"""
+        with self._lock:
+            if self.running:
+                return
+            (self.transport or get_transport()).get_token()
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, name="telebutton-poller",
+                                            daemon=True)
+            self._thread.start()
+
+    def stop(self, timeout: Optional[float] = None):
+        """停止轮询线程（当前长轮询请求返回后退出）"""
+        self._stop.set()
+        thread = self._thread
+        if thread is not None and thread is not threading.current_thread():
+            thread.join(timeout)
+
+    def poll_once(self) -> int:
+        """
+        执行一次 getUpdates 并分发结果
+
+        Returns:
+            本次处理的 update 数量
+        """
+        transport = self.transport or get_transport()
+        payload = {"timeout": self.poll_timeout}
+        if self.allowed_updates is not None:
+            payload["allowed_updates"] = self.allowed_updates
+        if self.offset is not None:
+            payload["offset"] = self.offset
+
+        updates = transport.call("getUpdates", payload,
+                                 timeout=self.poll_timeout + 10)
+        for update in updates:
+            self.offset = update["update_id"] + 1
+            result = _dispatch_update(update)
+            if result and self.answer_callbacks:
+                self._answer(transport, result.get("callback_query_id"))
+        return len(updates)
+
+    def _answer(self, transport: TelegramTransport, callback_query_id: Optional[str]):
+        # 应答过时即无意义，只尝试一次，避免重试退避占住轮询线程
+        if not callback_query_id:
+            return
+        try:
+            transport.call("answerCallbackQuery",
+                           {"callback_query_id": callback_query_id},
+                           timeout=5, retry=_NO_RETRY)
+        except Exception as e:
+            print(f"应答回调失败: {e}")
+
+    def _run(self):
+        global _update_mode
+        while not self._stop.is_set():
+            try:
+                self.poll_once()
+            except TelegramAPIError as e:
+                if e.error_code == 409:
+                    # 已设置 webhook 或另有进程在轮询：停止轮询，改由 dispatch_update 接收
+                    print(f"停止长轮询: {e}")
+                    _update_mode = "webhook"
+                    self._stop.set()
+                    return
+                print(f"获取更新失败: {e}")
+                self._stop.wait(self.retry_delay)
+            except Exception as e:
+                print(f"获取更新失败: {e}")
+                self._stop.wait(self.retry_delay)
+
+
+_poller: Optional[UpdatePoller] = None
+
+# 更新接收方式："auto"（本进程直接通过 Bot API 发送过菜单且未检测到 webhook 时
+# 自动长轮询）、"polling"、"webhook"（只通过 dispatch_update 接收，不启动轮询）
+_update_mode = "auto"
+# 本进程是否直接通过 Bot API 发送过菜单（经 OpenClaw 发送时回调由宿主接收，不应轮询）
+_direct_send_seen = False
+
+
+def _mark_direct_send():
+    global _direct_send_seen
+    _direct_send_seen = True
+
+
+class _Waiter:
+    """单个等待者：同步等待用 threading.Event，异步等待用 asyncio.Future"""
+
+    __slots__ = ("menu_id", "chat_id", "event", "loop", "future", "result")
+
+    def __init__(self, menu_id: Optional[str] = None, chat_id: Optional[str] = None,
+                 loop: Optional[asyncio.AbstractEventLoop] = None):
+        self.menu_id = menu_id
+        self.chat_id = chat_id
+        self.result: Optional[Dict] = None
+        self.loop = loop
+        if loop is None:
+            self.event: Optional[threading.Event] = threading.Event()
+            self.future = None
+        else:
+            self.event = None
+            self.future = loop.create_future()
+
+    def resolve(self, result: Dict):
+        """交付选择结果并唤醒等待者（可在任意线程调用）"""
+        self.result = result
+        if self.event is not None:
+            self.event.set()
+        else:
+            self.loop.call_soon_threadsafe(self._set_future, result)
+
+    def _set_future(self, result: Dict):
+        if not self.future.done():
+            self.future.set_result(result)
+
+
+# 等待者表：指定 menu_id 的等待者按 (menu_id, 聊天) 索引，"任意菜单"等待者按聊天索引
+# （聊天为 None 表示任意聊天；同一份去重菜单可能同时发往多个聊天）
+_waiter_lock = threading.Lock()
+_menu_waiters: Dict[Tuple[str, Optional[str]], Deque[_Waiter]] = {}
+_chat_waiters: Dict[Optional[str], Deque[_Waiter]] = {}
+
 
+class _PendingSelections:
+    """
+    已送达但尚无等待者领取的选择
 
-@dataclass
-class ButtonMenu:
-    """按钮菜单配置"""
-    question: str
-    options: List[ButtonOption]
-    max_per_row: int = 2
-    menu_id: str = field(default_factory=lambda: str(uuid.uuid4())[:8])
-    
-    def to_dict(self) -> Dict:
-        """转换为字典"""
-        return {
-            "question": self.question,
-            "options": [opt.to_dict() for opt in self.options],
-            "max_per_row": self.max_per_row,
-            "menu_id": self.menu_id
-        }
-    
-    @classmethod
-    def from_dict(cls, data: Dict) -> 'ButtonMenu':
-        """从字典创建"""
-        options = [ButtonOption.from_dict(opt) for opt in data.get("options", [])]
-        menu = cls(
-            question=data["question"],
-            options=options,
-            max_per_row=data.get("max_per_row", 2)
-        )
-        if "menu_id" in data:
-            menu.menu_id = data["menu_id"]
-        return menu
-    
-    def find_option(self, callback: str) -> Optional[ButtonOption]:
-        """查找选项"""
-        for opt in self.options:
-            if opt.callback == callback:
-                return opt
+    按送达顺序保存，同时按菜单和按聊天建立索引，任何一种等待者的领取都是 O(1)。
+    超过 ttl 未被领取的选择作废（不会被之后的"任意菜单"等待者误领），
+    数量超过上限时丢弃最早的。调用方需持有 _waiter_lock。
+    """
+
+    def __init__(self, ttl: Optional[float] = 60.0, max_entries: Optional[int] = 1000):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        # (menu_id, 聊天) -> (选择结果, 过期时间)，按送达顺序排列
+        self._entries: 'OrderedDict[Tuple[str, Optional[str]], tuple]' = OrderedDict()
+        self._by_menu: Dict[str, 'OrderedDict[tuple, None]'] = {}
+        self._by_chat: Dict[Optional[str], 'OrderedDict[tuple, None]'] = {}
+
+    def put(self, menu_id: str, chat_key: Optional[str], result: Dict):
+        """暂存一条选择（同一菜单同一聊天只保留最新的一条）"""
+        key = (menu_id, chat_key)
+        self._take(key)
+        expires = time.monotonic() + self.ttl if self.ttl is not None else None
+        self._entries[key] = (result, expires)
+        self._by_menu.setdefault(menu_id, OrderedDict())[key] = None
+        self._by_chat.setdefault(chat_key, OrderedDict())[key] = None
+        self._expire()
+        while self.max_entries is not None and len(self._entries) > self.max_entries:
+            self._take(next(iter(self._entries)))
+
+    def claim(self, menu_id: Optional[str], chat_key: Optional[str]) -> Optional[Dict]:
+        """
+        领取最早送达的匹配选择
+
+        Args:
+            menu_id: 菜单 ID（None 表示任意菜单）
+            chat_key: 聊天（None 表示任意聊天；指定菜单时只匹配该聊天）
+        """
+        if menu_id is not None and chat_key is not None:
+            return self._take((menu_id, chat_key))
+        if menu_id is not None:
+            index = self._by_menu.get(menu_id)
+        elif chat_key is not None:
+            index = self._by_chat.get(chat_key)
+        else:
+            index = self._entries
+        while index:
+            result = self._take(next(iter(index)))
+            if result is not None:
+                return result
         return None
-    
-    def get_all_callbacks(self) -> List[str]:
-        """获取所有回调标识（包括子菜单）"""
-        callbacks = []
-        for opt in self.options:
-            callbacks.append(opt.callback)
-            if opt.sub_menu:
-                callbacks.extend(opt.sub_menu.get_all_callbacks())
-        return callbacks
+
+    def clear(self):
+        self._entries.clear()
+        self._by_menu.clear()
+        self._by_chat.clear()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def _take(self, key: Tuple[str, Optional[str]]) -> Optional[Dict]:
+        """移除一条选择，返回其结果（已过期时返回 None）"""
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            return None
+        for table, index_key in ((self._by_menu, key[0]), (self._by_chat, key[1])):
+            index = table[index_key]
+            del index[key]
+            if not index:
+                del table[index_key]
+        if entry[1] is not None and entry[1] <= time.monotonic():
+            return None
+        return entry[0]
+
+    def _expire(self):
+        now = time.monotonic()
+        while self._entries:
+            key, (_, expires) = next(iter(self._entries.items()))
+            if expires is None or expires > now:
+                break
+            self._take(key)
 
 
-def load_menu_from_file(filepath: str) -> ButtonMenu:
+# 已送达但尚无等待者领取的选择
+_pending_selections = _PendingSelections()
+
+
+def configure_pending_selections(ttl: Optional[float] = 60.0,
+                                 max_entries: Optional[int] = 1000):
     """
-    从 YAML 或 JSON 文件加载菜单配置
-    
+    配置暂存选择的有效期与数量上限
+
+    回调先于 wait_selection 到达时会被暂存，供随后的等待者领取。
+
     Args:
-        filepath: 配置文件路径 (.yaml, .yml, 或 .json)
-    
+        ttl: 暂存选择的有效期（秒，None 表示不过期）
+        max_entries: 最多暂存的选择数量（None 表示不限制；超出时丢弃最早的）
+    """
+    with _waiter_lock:
+        _pending_selections.ttl = ttl
+        _pending_selections.max_entries = max_entries
+
+
+def _chat_key(chat_id: Any) -> Optional[str]:
+    return None if chat_id is None else str(chat_id)
+
+
+def _claim_pending(waiter: _Waiter) -> Optional[Dict]:
+    """取出等待者到来之前已送达的选择（调用方需持有 _waiter_lock）"""
+    return _pending_selections.claim(waiter.menu_id, waiter.chat_id)
+
+
+def _register_waiter(waiter: _Waiter) -> Optional[Dict]:
+    """
+    登记等待者
+
     Returns:
-        ButtonMenu 实例
+        已到达的选择（此时不会登记），或 None（已登记，等待唤醒）
     """
-    import yaml
-    
-    path = Path(filepath)
-    if not path.exists():
-        raise FileNotFoundError(f"配置文件不存在: {filepath}")
-    
-    with open(path, 'r', encoding='utf-8') as f:
-        if path.suffix in ['.yaml', '.yml']:
-            data = yaml.safe_load(f)
+    with _waiter_lock:
+        result = _claim_pending(waiter)
+        if result is not None:
+            return result
+        if waiter.menu_id is not None:
+            _menu_waiters.setdefault((waiter.menu_id, waiter.chat_id), deque()).append(waiter)
         else:
-            data = json.load(f)
-    
-    return ButtonMenu.from_dict(data)
+            _chat_waiters.setdefault(waiter.chat_id, deque()).append(waiter)
+        return None
 
 
-def save_menu_to_file(menu: ButtonMenu, filepath: str):
+def _unregister_waiter(waiter: _Waiter):
+    """移除超时或取消的等待者"""
+    with _waiter_lock:
+        if waiter.menu_id is not None:
+            table, key = _menu_waiters, (waiter.menu_id, waiter.chat_id)
+        else:
+            table, key = _chat_waiters, waiter.chat_id
+        queue = table.get(key)
+        if queue is None:
+            return
+        try:
+            queue.remove(waiter)
+        except ValueError:
+            pass
+        if not queue:
+            del table[key]
+
+
+def _pop_waiter(table: Dict, key: Any) -> Optional[_Waiter]:
+    queue = table.get(key)
+    if not queue:
+        return None
+    waiter = queue.popleft()
+    if not queue:
+        del table[key]
+    return waiter
+
+
+def _deliver_selection(result: Dict, menu_id: Optional[str] = None):
+    """将选择交给恰好一个等待者；无人等待时暂存，供随后的 wait_selection 领取"""
+    menu_id = menu_id or result["menu_id"]
+    chat_key = _chat_key(result.get("chat_id"))
+    with _waiter_lock:
+        waiter = None
+        if chat_key is not None:
+            waiter = (_pop_waiter(_menu_waiters, (menu_id, chat_key))
+                      or _pop_waiter(_menu_waiters, (menu_id, None))
+                      or _pop_waiter(_chat_waiters, chat_key))
+        else:
+            waiter = _pop_waiter(_menu_waiters, (menu_id, None))
+        if waiter is None:
+            waiter = _pop_waiter(_chat_waiters, None)
+        if waiter is None:
+            _pending_selections.put(menu_id, chat_key, result)
+            return
+        waiter.resolve(result)
+
+
+def get_poller() -> UpdatePoller:
+    """获取进程级共享的 UpdatePoller"""
+    global _poller
+    with _transport_lock:
+        if _poller is None:
+            _poller = UpdatePoller()
+        return _poller
+
+
+def set_update_mode(mode: str):
     """
-    保存菜单配置到文件
-    
+    设置更新接收方式
+
     Args:
-        menu: ButtonMenu 实例
-        filepath: 目标文件路径
+        mode: "auto"（默认：本进程直接通过 Bot API 发送过菜单后才自动启动长轮询，
+              经 OpenClaw 发送时不轮询；收到 409 或外部调用 dispatch_update 后视为
+              webhook 部署）、"polling"（总是长轮询）、
+              "webhook"（只通过 dispatch_update 接收更新，不启动轮询）
     """
-    import yaml
-    
-    path = Path(filepath)
-    with open(path, 'w', encoding='utf-8') as f:
-        if path.suffix in ['.yaml', '.yml']:
-            yaml.dump(menu.to_dict(), f, allow_unicode=True, default_flow_style=False)
-        else:
-            json.dump(menu.to_dict(), f, ensure_ascii=False, indent=2)
+    global _update_mode
+    if mode not in ("auto", "polling", "webhook"):
+        raise ValueError(f"未知的更新接收方式: {mode}")
+    _update_mode = mode
+    if mode == "webhook" and _poller is not None:
+        _poller.stop(0)
 
 
-def _generate_inline_keyboard(menu: ButtonMenu) -> List[List[Dict]]:
+def dispatch_update(update: Dict) -> Optional[Dict]:
     """
-    生成 Telegram InlineKeyboard 格式
+    处理一条 Telegram Update 并唤醒等待者
+
+    用于 webhook 或 OpenClaw 转发的更新。自动模式下，外部送达更新即表示
+    部署方式为 webhook，此后等待者不再自动启动 getUpdates 长轮询。
     
     Args:
-        menu: 菜单配置
+        update: Telegram Update 对象
     
     Returns:
-        Telegram InlineKeyboardMarkup 格式
+        handle_callback 的解析结果（附带 chat_id / message_id / callback_query_id），
+        或 None（非按钮回调或无效回调）
     """
-    keyboard = []
-    row = []
-    
-    for i, option in enumerate(menu.options):
-        # 注册回调
-        callback_data = f"{menu.menu_id}:{option.callback}"
-        
-        row.append({
-            "text": option.text,
-            "callback_data": callback_data
-        })
-        
-        # 按 max_per_row 换行
-        if (i + 1) % menu.max_per_row == 0:
-            keyboard.append(row)
-            row = []
-    
-    if row:
-        keyboard.append(row)
-    
-    return keyboard
+    global _update_mode
+    if _update_mode == "auto":
+        _update_mode = "webhook"
+    return _dispatch_update(update)
 
 
-def show_menu(menu: ButtonMenu, chat_id: Optional[str] = None, 
-              use_openclaw: bool = True) -> Optional[str]:
+def _dispatch_update(update: Dict) -> Optional[Dict]:
+    """dispatch_update 的实现（UpdatePoller 直接调用，不改变更新接收方式）"""
+    query = update.get("callback_query")
+    if not query or "data" not in query:
+        return None
+
+    result = handle_callback(query["data"])
+    if not result:
+        return None
+
+    message = query.get("message") or {}
+    result["callback_query_id"] = query.get("id")
+    result["user_id"] = (query.get("from") or {}).get("id")
+    if message:
+        result["chat_id"] = message.get("chat", {}).get("id")
+        result["message_id"] = message.get("message_id")
+
+    if result.get("noop"):
+        return result
+
+    if result.get("navigation"):
+        # 翻页/返回在原消息上原地完成，不唤醒等待者；问题文字不变时只替换键盘
+        text = result["text"] if message.get("text") != result["text"] else None
+        _edit_message(result, result["reply_markup"], text)
+        return result
+
+    if _navigation_mode == "edit":
+        sub_menu = result.get("sub_menu")
+        if sub_menu is not None and result.get("message_id") is not None:
+            # 原地进入子菜单：一次 editMessageText 代替发送新消息
+            _menu_registry[sub_menu.menu_id] = sub_menu
+            _, markup = _get_keyboard(sub_menu)
+            _edit_message(result, markup, sub_menu.question)
+            result["navigation"] = True
+            return result
+        # 同一条消息走完整条路径，等待者以根菜单 ID 等待
+        _deliver_selection(result, result.get("root_menu_id"))
+        return result
+
+    _deliver_selection(result)
+    return result
+
+
+# 待发送的消息编辑：(chat_id, message_id) -> (方法名, 请求体)，同一消息只保留最新一次
+_pending_edits: Dict[Tuple[Any, Any], Tuple[str, bytes]] = {}
+# 已在发送队列中处理的消息（同一消息的编辑按顺序串行发送）
+_active_edits: set = set()
+_edit_lock = threading.Lock()
+
+
+def _edit_message(result: Dict, reply_markup: bytes, text: Optional[str] = None):
     """
-    发送按钮菜单到 Telegram
+    原地更新按钮消息（交给发送队列异步完成，不阻塞更新分发）
     
     Args:
-        menu: ButtonMenu 实例
-        chat_id: 目标聊天 ID（None 表示使用当前会话）
-        use_openclaw: 是否使用 OpenClaw 消息工具发送
-    
-    Returns:
-        message_id 或 None
+        result: 带 chat_id / message_id 的回调结果
+        reply_markup: 预序列化的新键盘
+        text: 新的消息文字（None 表示只替换键盘）
     """
-    # 注册菜单
-    _menu_registry[menu.menu_id] = menu
-    
-    # 生成键盘
-    keyboard = _generate_inline_keyboard(menu)
-    
-    if use_openclaw:
-        # 使用 OpenClaw 消息工具发送
-        return _send_via_openclaw(menu.question, keyboard, chat_id)
-    else:
-        # 直接调用 Telegram API
-        return _send_via_telegram_api(menu.question, keyboard, chat_id)
+    if result.get("chat_id") is None or result.get("message_id") is None:
+        return
+    fields = {"chat_id": result["chat_id"], "message_id": result["message_id"]}
+    if text is not None:
+        fields["text"] = text
+    method = "editMessageText" if text is not None else "editMessageReplyMarkup"
+    key = (result["chat_id"], result["message_id"])
+    with _edit_lock:
+        _pending_edits[key] = (method, _splice_reply_markup(fields, reply_markup))
+        if key in _active_edits:
+            return
+        _active_edits.add(key)
+    try:
+        get_send_queue()._submit_steps(_flush_edits, key, block=False)
+    except (queue.Full, RuntimeError) as e:
+        with _edit_lock:
+            _pending_edits.pop(key, None)
+            _active_edits.discard(key)
+        print(f"更新消息失败: 发送队列不可用 ({e!r})")
 
 
-def _send_via_openclaw(text: str, keyboard: List[List[Dict]], 
-                       chat_id: Optional[str] = None) -> Optional[str]:
-    """通过 OpenClaw 发送消息"""
-    # 实际实现会通过 OpenClaw 的 message 工具发送
-    # 这里返回模拟的 message_id
-    message_id = f"msg_{int(time.time())}"
-    
-    # 构建按钮显示文本（用于调试）
-    buttons_text = []
-    for row in keyboard:
-        row_text = " | ".join([btn["text"] for btn in row])
-        buttons_text.append(f"[{row_text}]")
-    
-    print(f"\n[Telegram] Telegram 按钮消息:\n")
-    print(f"[Text] {text}")
-    print("\n".join(buttons_text))
-    print()
-    
-    return message_id
+def _flush_edits(key: Tuple[Any, Any]):
+    """在发送队列中依次发送某条消息的编辑，连续翻页时跳过被覆盖的中间状态（分步执行）"""
+    while True:
+        with _edit_lock:
+            edit = _pending_edits.pop(key, None)
+            if edit is None:
+                _active_edits.discard(key)
+                return
+        method, body = edit
+        try:
+            yield from get_transport()._call_steps(method, body, chat_id=key[0])
+        except TelegramAPIError as e:
+            # 内容未变化（如重复点击同一页）不算失败
+            if e.error_code != 400 or "not modified" not in e.description:
+                print(f"更新消息失败: {e}")
+        except Exception as e:
+            print(f"更新消息失败: {e}")
 
 
-def _send_via_telegram_api(text: str, keyboard: List[List[Dict]],
-                           chat_id: Optional[str] = None) -> Optional[str]:
-    """直接调用 Telegram Bot API 发送"""
-    import os
-    import requests
-    
-    bot_token = os.getenv("TELEGRAM_BOT_TOKEN")
-    if not bot_token:
-        raise ValueError("未设置 TELEGRAM_BOT_TOKEN 环境变量")
-    
-    api_url = f"https://api.telegram.org/bot{bot_token}/sendMessage"
-    
-    payload = {
-        "chat_id": chat_id or os.getenv("TELEGRAM_CHAT_ID"),
-        "text": text,
-        "reply_markup": {
-            "inline_keyboard": keyboard
-        }
-    }
-    
+def _delete_message(result: Dict):
+    """删除已完成选择的按钮消息"""
+    if result.get("chat_id") is None or result.get("message_id") is None:
+        return
     try:
-        response = requests.post(api_url, json=payload, timeout=30)
-        response.raise_for_status()
-        result = response.json()
-        return str(result["result"]["message_id"])
+        get_transport().call("deleteMessage", {
+            "chat_id": result["chat_id"],
+            "message_id": result["message_id"]
+        })
     except Exception as e:
-        print(f"发送消息失败: {e}")
-        return None
+        print(f"删除消息失败: {e}")
+
+
+def _should_poll(poll: Optional[bool]) -> bool:
+    if poll is not None:
+        return poll
+    if _update_mode != "auto":
+        return _update_mode == "polling"
+    return _direct_send_seen
 
 
 def wait_selection(menu_id: Optional[str] = None, timeout: int = 300,
-                   delete_message: bool = True) -> Optional[Dict]:
+                   delete_message: bool = True,
+                   poll: Optional[bool] = None,
+                   chat_id: Optional[str] = None) -> Optional[Dict]:
     """
     等待用户选择
     
@@ -257,6 +3798,9 @@ def wait_selection(menu_id: Optional[str] = None, timeout: int = 300,
         menu_id: 菜单 ID（None 表示等待任何菜单）
         timeout: 超时时间（秒）
         delete_message: 选择后是否删除原消息
+        poll: 是否启动共享的 getUpdates 长轮询（None 表示按 set_update_mode 决定；
+              False 表示回调由 webhook/OpenClaw 通过 dispatch_update 送达）
+        chat_id: 只接收该聊天的选择（None 表示任意聊天；等待去重菜单时应指定）
     
     Returns:
         {
@@ -267,22 +3811,22 @@ def wait_selection(menu_id: Optional[str] = None, timeout: int = 300,
         }
         或 None（超时）
     """
-    # 实际实现需要监听 Telegram 回调
-    # 这里提供模拟实现
-    
-    wait_key = menu_id or "any"
-    start_time = time.time()
-    
-    print(f"[...] 等待用户选择... (超时: {timeout}秒)")
-    print("提示: 在真实环境中，这里会阻塞等待 Telegram 回调")
-    
-    # 模拟：在测试环境下返回第一个选项
-    # 实际使用时，这应该从 Telegram webhook 或轮询获取
-    
-    # TODO: 实现真实的回调监听
-    # 需要与 OpenClaw 的消息系统集成
-    
-    return None
+    if _should_poll(poll):
+        get_poller().start()
+
+    waiter = _Waiter(menu_id, _chat_key(chat_id))
+    result = _register_waiter(waiter)
+    if result is None:
+        if waiter.event.wait(timeout):
+            result = waiter.result
+        else:
+            _unregister_waiter(waiter)
+            # 超时与送达竞争时，以已送达的结果为准
+            result = waiter.result
+
+    if result and delete_message:
+        _delete_message(result)
+    return result
 
 
 def handle_callback(callback_data: str) -> Optional[Dict]:
@@ -290,38 +3834,101 @@ def handle_callback(callback_data: str) -> Optional[Dict]:
     处理 Telegram 回调数据
     
     Args:
-        callback_data: Telegram callback_query data (格式: menu_id:callback)
+        callback_data: Telegram callback_query data
+                       (格式: menu_id#下标.标签、menu_id:callback、menu_id!页码 或 ~令牌，
+                       见 encode_callback_data)
     
     Returns:
-        解析后的选择信息，或 None（无效回调）
+        解析后的选择信息，或 None（无效回调）；翻页按钮返回
+        {"navigation": True, "page", "pages", "keyboard", "reply_markup"}，
+        页码标签按钮返回 {"navigation": True, "noop": True}
     """
     try:
-        parts = callback_data.split(":", 1)
-        if len(parts) != 2:
+        decoded = decode_callback_data(callback_data)
+        if decoded is None:
             return None
         
-        menu_id, callback = parts
+        menu_id, callback, index, payload, _, page, tag, text = decoded
         
         # 查找菜单
         menu = _menu_registry.get(menu_id)
         if not menu:
             return None
         
-        # 查找选项
-        option = menu.find_option(callback)
-        if not option:
-            return None
+        # 页码标签：不翻页，只需应答回调
+        if page == _LABEL_PAGE:
+            return {"menu_id": menu_id, "text": menu.question, "navigation": True,
+                    "noop": True}
+        
+        # 翻页按钮：返回目标页的键盘
+        if page is not None:
+            page = _page_view(menu, page).page
+            keyboard, markup = _get_keyboard(menu, page)
+            return {
+                "menu_id": menu_id,
+                "text": menu.question,
+                "page": page,
+                "pages": menu.page_count,
+                "navigation": True,
+                "keyboard": keyboard,
+                "reply_markup": markup
+            }
+        
+        root = menu._tree_root or menu
+        node = None
+        if menu.provider is not None:
+            # 动态菜单：按令牌中渲染时的选项解析，不按下标回查数据源，
+            # 数据源增删行后按钮不会指向别的选项
+            if index is not None:
+                return None
+            option = menu.provider.find(callback)
+            if option is None:
+                # 所在页已不在缓存中：用令牌保存的按钮还原选项
+                if text is None:
+                    return None
+                option = ButtonOption(text=text, callback=callback)
+            path, depth = [callback], 0
+        else:
+            # 紧凑格式：按下标直接取选项，并核对渲染时的内容标签
+            if index is not None:
+                if index >= len(menu.options):
+                    return None
+                callback = menu.options[index].callback
+                if tag != _option_tag(callback):
+                    return None
+            
+            # 在所属菜单树中一次定位按钮及其完整路径；从共享注册表取回的子菜单
+            # 副本自成一棵树，再拼上随菜单保存的、从根菜单到该副本的路径
+            node = root.resolve_callback(menu_id, callback)
+            if not node:
+                return None
+            option = node.option
+            path, depth = list(root._path + node.path), node.depth + len(root._path)
         
         result = {
             "callback": callback,
             "text": option.text,
             "menu_id": menu_id,
-            "path": [callback]
+            "root_menu_id": root._root_id or root.menu_id,
+            "path": path,
+            "depth": depth
         }
         
+        # 令牌携带的数据（大体积 payload 不放入 callback_data）
+        if payload is None:
+            payload = option.payload
+        if payload is not None:
+            result["payload"] = payload
+        
         # 如果有子菜单，返回子菜单供后续展示
-        if option.sub_menu:
-            result["sub_menu"] = option.sub_menu
+        if option.has_sub_menu:
+            sub_menu = option.sub_menu
+            if sub_menu._tree_root is None and sub_menu is not root:
+                # 刚展开的子菜单：只把这一层并入根菜单的索引，不重建整棵树
+                if node is None:
+                    node = MenuTreeNode(option, menu, tuple(path), (menu_id,), depth)
+                root.tree_index().add_branch(node, sub_menu)
+            result["sub_menu"] = sub_menu
         
         return result
         
@@ -354,19 +3961,189 @@ def show_confirm(question: str, yes_text: str = "[OK] 是",
     )
     
     show_menu(menu, **kwargs)
-    return wait_selection(menu.menu_id)
+    return wait_selection(menu.menu_id, chat_id=kwargs.get("chat_id"))
+
+
+async def _asend_via_telegram_api(text: str, keyboard: List[List[Dict]],
+                                  chat_id: Optional[str] = None,
+                                  transport: Optional[AsyncTelegramTransport] = None,
+                                  reply_markup: Optional[bytes] = None,
+                                  raise_errors: bool = False) -> Optional[str]:
+    """通过异步传输层调用 Telegram Bot API 发送"""
+    transport = transport or get_async_transport()
+    transport.get_token()
+    _mark_direct_send()
+
+    if reply_markup is not None:
+        payload = _build_send_body(text, reply_markup, chat_id)
+    else:
+        payload = _build_send_payload(text, keyboard, chat_id)
+
+    try:
+        result = await transport.call("sendMessage", payload,
+                                      chat_id=chat_id or os.getenv("TELEGRAM_CHAT_ID"))
+        return str(result["message_id"])
+    except asyncio.CancelledError:
+        raise
+    except Exception as e:
+        if raise_errors:
+            raise
+        print(f"发送消息失败: {e}")
+        return None
+
+
+async def ashow_menu(menu: ButtonMenu, chat_id: Optional[str] = None,
+                     use_openclaw: bool = True,
+                     transport: Optional[AsyncTelegramTransport] = None,
+                     raise_errors: bool = False) -> Optional[str]:
+    """
+    发送按钮菜单到 Telegram（异步版本，不阻塞事件循环）
+    
+    Args:
+        menu: ButtonMenu 实例
+        chat_id: 目标聊天 ID（None 表示使用当前会话）
+        use_openclaw: 是否使用 OpenClaw 消息工具发送
+        transport: 异步传输层（None 表示使用默认共享实例）
+        raise_errors: Bot API 发送失败时抛出 TelegramAPIError（默认打印并返回 None）
+    
+    Returns:
+        message_id 或 None
+    """
+    _menu_registry[menu.menu_id] = menu
+    keyboard, markup = _get_keyboard(menu)
+
+    if use_openclaw:
+        return _send_via_openclaw(menu.question, keyboard, chat_id)
+    return await _asend_via_telegram_api(menu.question, keyboard, chat_id,
+                                         transport=transport, reply_markup=markup,
+                                         raise_errors=raise_errors)
+
+
+async def abroadcast_menu(menu: ButtonMenu, chat_ids: Iterable[Any],
+                          transport: Optional[AsyncTelegramTransport] = None,
+                          concurrency: int = 100) -> BroadcastResult:
+    """
+    向多个聊天发送同一个菜单（异步版本，见 broadcast_menu）
+    
+    Args:
+        menu: ButtonMenu 实例
+        chat_ids: 目标聊天 ID 列表
+        transport: 异步传输层（None 表示使用默认共享实例）
+        concurrency: 同时在途的发送请求数
+    
+    Returns:
+        BroadcastResult（各聊天的 message_id 与失败原因）
+    """
+    transport = transport or get_async_transport()
+    transport.get_token()
+    _mark_direct_send()
+    template = _broadcast_template(menu)
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def send(chat_id: Any) -> Any:
+        async with semaphore:
+            try:
+                result = await transport.call("sendMessage", _broadcast_body(template, chat_id),
+                                              chat_id=chat_id)
+                return str(result["message_id"])
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                return e
+
+    chat_ids = list(dict.fromkeys(chat_ids))
+    outcomes = await asyncio.gather(*(send(chat_id) for chat_id in chat_ids))
+    message_ids: Dict[Any, str] = {}
+    errors: Dict[Any, Exception] = {}
+    for chat_id, outcome in zip(chat_ids, outcomes):
+        if isinstance(outcome, Exception):
+            errors[chat_id] = outcome
+        else:
+            message_ids[chat_id] = outcome
+    return BroadcastResult(menu.menu_id, message_ids, errors)
+
+
+async def _adelete_message(result: Dict):
+    """删除已完成选择的按钮消息（异步版本）"""
+    if result.get("chat_id") is None or result.get("message_id") is None:
+        return
+    try:
+        await get_async_transport().call("deleteMessage", {
+            "chat_id": result["chat_id"],
+            "message_id": result["message_id"]
+        })
+    except asyncio.CancelledError:
+        raise
+    except Exception as e:
+        print(f"删除消息失败: {e}")
+
+
+async def await_selection(menu_id: Optional[str] = None, timeout: int = 300,
+                          delete_message: bool = True,
+                          poll: Optional[bool] = None,
+                          chat_id: Optional[str] = None) -> Optional[Dict]:
+    """
+    等待用户选择（异步版本）
+    
+    参数与返回值同 wait_selection。等待期间只占用一个 asyncio.Future，不占用线程。
+    """
+    if _should_poll(poll):
+        get_poller().start()
+
+    waiter = _Waiter(menu_id, _chat_key(chat_id), loop=asyncio.get_running_loop())
+    result = _register_waiter(waiter)
+    if result is None:
+        try:
+            result = await asyncio.wait_for(asyncio.shield(waiter.future), timeout)
+        except asyncio.TimeoutError:
+            _unregister_waiter(waiter)
+            result = waiter.result
+        except asyncio.CancelledError:
+            _unregister_waiter(waiter)
+            raise
+
+    if result and delete_message:
+        await _adelete_message(result)
+    return result
+
+
+async def ashow_confirm(question: str, yes_text: str = "[OK] 是",
+                        no_text: str = "[X] 否", **kwargs) -> Optional[Dict]:
+    """
+    快速显示确认对话框（异步版本）
+    
+    参数与返回值同 show_confirm，**kwargs 传递给 ashow_menu。
+    """
+    menu = ButtonMenu(
+        question=question,
+        options=[
+            ButtonOption(text=yes_text, callback="yes"),
+            ButtonOption(text=no_text, callback="no")
+        ],
+        max_per_row=2
+    )
+
+    await ashow_menu(menu, **kwargs)
+    return await await_selection(menu.menu_id, chat_id=kwargs.get("chat_id"))
 
 
 def clear_menu(menu_id: str):
     """清理菜单注册信息"""
-    if menu_id in _menu_registry:
-        del _menu_registry[menu_id]
+    _menu_registry.pop(menu_id)
+    _token_store.purge(menu_id)
+    with _keyboard_lock:
+        for key in [key for key in _keyboard_cache if key[0] == menu_id]:
+            del _keyboard_cache[key]
+        _token_keyboards.pop(menu_id, None)
 
 
 def clear_all_menus():
     """清理所有菜单"""
     _menu_registry.clear()
-    _pending_selections.clear()
+    _token_store.purge()
+    _clear_keyboard_cache()
+    with _waiter_lock:
+        _pending_selections.clear()
 
 
 # 便捷函数
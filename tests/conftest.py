@@ -0,0 +1,58 @@
+import sys
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "scripts"))
+sys.path.insert(0, str(Path(__file__).resolve().parent))
+
+import telebutton  # noqa: E402
+
+
+@pytest.fixture(autouse=True)
+def clean_state():
+    """每个测试前后重置进程级状态"""
+    telebutton.clear_all_menus()
+    telebutton.set_navigation_mode("message")
+    telebutton.set_update_mode("auto")
+    telebutton._direct_send_seen = False
+    yield
+    if telebutton._poller is not None:
+        telebutton._poller.stop(2)
+        telebutton._poller = None
+    telebutton.set_transport(None)
+    telebutton.clear_all_menus()
+    telebutton.set_navigation_mode("message")
+    telebutton.set_update_mode("auto")
+    telebutton._direct_send_seen = False
+    with telebutton._waiter_lock:
+        telebutton._menu_waiters.clear()
+        telebutton._chat_waiters.clear()
+
+
+@pytest.fixture
+def fake_api():
+    from fake_bot_api import FakeBotAPI
+
+    api = FakeBotAPI()
+    yield api
+    api.stop()
+
+
+@pytest.fixture
+def transport(fake_api):
+    """指向模拟服务器的默认传输层（不限速，快速重试）"""
+    pytest.importorskip("requests")
+    transport = telebutton.TelegramTransport(
+        bot_token="TEST", api_base=fake_api.url, rate_limit=False,
+        retry=telebutton.RetryPolicy(base_delay=0.01, max_delay=0.05))
+    telebutton.set_transport(transport)
+    return transport
+
+
+@pytest.fixture
+def poller(transport):
+    """使用短长轮询超时的共享 UpdatePoller"""
+    telebutton._poller = telebutton.UpdatePoller(poll_timeout=1, retry_delay=0.05)
+    telebutton.set_update_mode("polling")
+    return telebutton._poller
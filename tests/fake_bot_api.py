@@ -0,0 +1,146 @@
+"""
+本地模拟的 Telegram Bot API 服务器
+
+在后台线程中运行 http.server，记录收到的每个调用，按脚本返回响应；
+getUpdates 以长轮询方式返回通过 push_update / push_callback 放入的更新。
+"""
+
+import json
+import queue
+import threading
+import time
+from collections import defaultdict, deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Callable, Deque, Dict, List, Optional, Tuple
+
+
+class FakeBotAPI:
+    """模拟 Bot API：api_base 指向 self.url 即可对接 TelegramTransport"""
+
+    def __init__(self):
+        self.calls: List[Tuple[str, Dict]] = []
+        self._scripts: Dict[str, Deque[Any]] = defaultdict(deque)
+        self._updates: "queue.Queue[Dict]" = queue.Queue()
+        self._lock = threading.Lock()
+        self._next_message_id = 100
+        self._next_update_id = 1
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), self._handler_class())
+        self.server.daemon_threads = True
+        self._thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self._thread.start()
+
+    @property
+    def url(self) -> str:
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def script(self, method: str, *responses: Any):
+        """
+        为 method 依次预设响应
+
+        每个响应可以是 (HTTP 状态码, JSON 对象)、一个返回它们的函数(body)，
+        或 ("sleep", 秒数, 响应) 表示延迟后再返回。
+        """
+        with self._lock:
+            self._scripts[method].extend(responses)
+
+    def push_update(self, update: Dict):
+        with self._lock:
+            update.setdefault("update_id", self._next_update_id)
+            self._next_update_id = update["update_id"] + 1
+        self._updates.put(update)
+
+    def push_callback(self, data: str, chat_id: int = 1, message_id: int = 100,
+                      text: str = "", user_id: int = 7) -> Dict:
+        update = {
+            "callback_query": {
+                "id": f"cq{time.monotonic_ns()}",
+                "from": {"id": user_id},
+                "data": data,
+                "message": {"message_id": message_id, "chat": {"id": chat_id},
+                            "text": text}
+            }
+        }
+        self.push_update(update)
+        return update
+
+    def calls_to(self, method: str) -> List[Dict]:
+        with self._lock:
+            return [body for name, body in self.calls if name == method]
+
+    def wait_for_call(self, method: str, count: int = 1, timeout: float = 5.0) -> List[Dict]:
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            calls = self.calls_to(method)
+            if len(calls) >= count:
+                return calls
+            time.sleep(0.01)
+        raise AssertionError(f"{method} 调用不足 {count} 次: {self.calls_to(method)}")
+
+    def _respond(self, method: str, body: Dict) -> Tuple[int, Dict]:
+        with self._lock:
+            self.calls.append((method, body))
+            scripted = self._scripts[method].popleft() if self._scripts[method] else None
+        if scripted is not None:
+            if callable(scripted):
+                scripted = scripted(body)
+            if scripted[0] == "sleep":
+                time.sleep(scripted[1])
+                scripted = scripted[2]
+            return scripted
+        if method == "getUpdates":
+            return 200, {"ok": True, "result": self._take_updates(body)}
+        if method == "sendMessage":
+            with self._lock:
+                self._next_message_id += 1
+                message_id = self._next_message_id
+            return 200, {"ok": True, "result": {
+                "message_id": message_id, "chat": {"id": body.get("chat_id")},
+                "text": body.get("text")}}
+        return 200, {"ok": True, "result": True}
+
+    def _take_updates(self, body: Dict) -> List[Dict]:
+        offset = body.get("offset")
+        timeout = min(float(body.get("timeout", 0)), 0.5)
+        updates = []
+        try:
+            updates.append(self._updates.get(timeout=timeout))
+            while True:
+                updates.append(self._updates.get_nowait())
+        except queue.Empty:
+            pass
+        return [u for u in updates if offset is None or u["update_id"] >= offset]
+
+    def _handler_class(self) -> Callable:
+        api = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                method = self.path.rsplit("/", 1)[-1]
+                length = int(self.headers.get("Content-Length") or 0)
+                raw = self.rfile.read(length) if length else b""
+                body = json.loads(raw) if raw else {}
+                status, data = api._respond(method, body)
+                payload = json.dumps(data).encode()
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+            def log_message(self, *args):
+                pass
+
+        return Handler
+
+
+def error(code: int, description: str, retry_after: Optional[float] = None) -> Tuple[int, Dict]:
+    """构造 Bot API 错误响应"""
+    data: Dict[str, Any] = {"ok": False, "error_code": code, "description": description}
+    if retry_after is not None:
+        data["parameters"] = {"retry_after": retry_after}
+    return code, data
@@ -0,0 +1,92 @@
+import asyncio
+import threading
+
+import pytest
+
+import telebutton
+from telebutton import (ButtonMenu, ButtonOption, AsyncTelegramTransport, ashow_menu,
+                        await_selection, dispatch_update, encode_callback_data)
+
+
+def _menu(*callbacks):
+    return ButtonMenu("选择：", [ButtonOption(c.upper(), c) for c in callbacks])
+
+
+def _press(menu, index, chat_id=1):
+    return {"callback_query": {
+        "id": "cq", "data": encode_callback_data(menu, index),
+        "message": {"message_id": 100, "chat": {"id": chat_id}, "text": menu.question}
+    }}
+
+
+@pytest.fixture
+def async_transport(fake_api):
+    pytest.importorskip("aiohttp")
+    transport = AsyncTelegramTransport(bot_token="TEST", api_base=fake_api.url,
+                                       rate_limit=False)
+    telebutton.set_async_transport(transport)
+    yield transport
+    telebutton.set_async_transport(None)
+
+
+def test_await_selection_woken_from_other_thread():
+    menu = _menu("a", "b")
+    telebutton._menu_registry[menu.menu_id] = menu
+
+    async def main():
+        task = asyncio.ensure_future(await_selection(menu.menu_id, timeout=5,
+                                                     delete_message=False, poll=False))
+        await asyncio.sleep(0.05)
+        threading.Thread(target=dispatch_update, args=(_press(menu, 1),)).start()
+        return await task
+
+    assert asyncio.run(main())["callback"] == "b"
+
+
+def test_await_selection_timeout_and_cancel_unregister():
+    async def main():
+        assert await await_selection("m", timeout=0.05, poll=False) is None
+        task = asyncio.ensure_future(await_selection("m", timeout=5, poll=False))
+        await asyncio.sleep(0.05)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+
+    asyncio.run(main())
+    assert ("m", None) not in telebutton._menu_waiters
+
+
+def test_ashow_menu_and_await_selection_end_to_end(fake_api, poller, async_transport):
+    menu = _menu("a", "b")
+
+    async def main():
+        message_id = await ashow_menu(menu, chat_id="1", use_openclaw=False)
+        fake_api.push_callback(encode_callback_data(menu, 0), message_id=int(message_id))
+        result = await await_selection(menu.menu_id, timeout=5, chat_id="1")
+        await async_transport.close()
+        return message_id, result
+
+    message_id, result = asyncio.run(main())
+
+    assert result["callback"] == "a"
+    assert fake_api.calls_to("sendMessage")[0]["chat_id"] == "1"
+    assert fake_api.calls_to("deleteMessage")[0]["message_id"] == int(message_id)
+
+
+def test_ashow_confirm_waits_for_its_chat(fake_api, poller, async_transport):
+    async def main():
+        task = asyncio.ensure_future(telebutton.ashow_confirm("继续？", chat_id="2",
+                                                              use_openclaw=False))
+        sent = await asyncio.get_running_loop().run_in_executor(
+            None, fake_api.wait_for_call, "sendMessage")
+        data = sent[0]["reply_markup"]["inline_keyboard"][0][0]["callback_data"]
+        # 另一个聊天对同一菜单的回调不应被这个确认框领取
+        fake_api.push_callback(data, chat_id=3)
+        fake_api.push_callback(data, chat_id=2)
+        result = await task
+        await async_transport.close()
+        return result
+
+    result = asyncio.run(main())
+    assert result["callback"] == "yes"
+    assert result["chat_id"] == 2
@@ -0,0 +1,383 @@
+import json
+import threading
+
+import pytest
+
+import telebutton
+from telebutton import ButtonMenu, ButtonOption
+
+
+def _menu(*callbacks):
+    return ButtonMenu("选择：", [ButtonOption(c.upper(), c) for c in callbacks])
+
+
+def test_find_option_miss_does_not_rebuild(monkeypatch):
+    menu = _menu(*[f"c{i}" for i in range(100)])
+    builds = []
+    original = ButtonMenu._build_option_index
+    monkeypatch.setattr(ButtonMenu, "_build_option_index",
+                        lambda self: builds.append(1) or original(self))
+
+    assert menu.find_option("c5").callback == "c5"
+    for _ in range(50):
+        assert menu.find_option("missing") is None
+    assert len(builds) == 1
+
+
+def test_find_option_sees_appended_and_replaced_options():
+    menu = _menu("a", "b")
+    assert menu.find_option("c") is None
+
+    menu.options.append(ButtonOption("C", "c"))
+    assert menu.find_option("c").text == "C"
+
+    # 原地替换后第一次查找就能看到新选项，与之前的查找历史无关
+    menu.options[0] = ButtonOption("X", "x")
+    assert menu.find_option("x").text == "X"
+    assert menu.find_option("a") is None
+
+    del menu.options[0]
+    assert menu.find_option("x") is None
+
+
+def test_resolve_callback_miss_does_not_rebuild_tree(monkeypatch):
+    sub = _menu("x", "y")
+    root = ButtonMenu("根", [ButtonOption("A", "a"), ButtonOption("B", "b", sub_menu=sub)])
+    builds = []
+    original = telebutton.MenuTreeIndex.__init__
+
+    def counting_init(self, *args, **kwargs):
+        builds.append(1)
+        original(self, *args, **kwargs)
+
+    monkeypatch.setattr(telebutton.MenuTreeIndex, "__init__", counting_init)
+
+    assert root.resolve_callback(sub.menu_id, "x").path == ("b", "x")
+    for _ in range(50):
+        assert root.resolve_callback(sub.menu_id, "missing") is None
+        assert root.resolve_callback(root.menu_id, "missing") is None
+    assert len(builds) == 1
+
+    sub.options.append(ButtonOption("Z", "z"))
+    assert root.resolve_callback(sub.menu_id, "z").path == ("b", "z")
+    assert len(builds) == 2
+
+
+def test_reassigning_sub_menu_options_invalidates_root():
+    sub = _menu("x")
+    root = ButtonMenu("根", [ButtonOption("B", "b", sub_menu=sub)])
+    assert root.get_all_callbacks() == ["b", "x"]
+
+    sub.options = [ButtonOption("Y", "y")]
+    assert root.get_all_callbacks() == ["b", "y"]
+    assert root.resolve_callback(sub.menu_id, "y").path == ("b", "y")
+
+
+def test_get_all_callbacks_sees_in_place_changes():
+    sub = _menu("x")
+    root = ButtonMenu("根", [ButtonOption("B", "b", sub_menu=sub)])
+    assert root.get_all_callbacks() == ["b", "x"]
+
+    root.options.append(ButtonOption("C", "c"))
+    assert root.get_all_callbacks() == ["b", "x", "c"]
+    sub.options.append(ButtonOption("Z", "z"))
+    assert root.get_all_callbacks() == ["b", "x", "z", "c"]
+
+    sub.options[0] = ButtonOption("Y", "y")
+    assert root.get_all_callbacks() == ["b", "y", "z", "c"]
+
+
+def _lazy_tree(width=3, depth=3):
+    def node(level):
+        options = []
+        for i in range(width):
+            opt = {"text": f"L{level}-{i}", "callback": f"l{level}_{i}"}
+            if level < depth:
+                opt["sub_menu"] = node(level + 1)
+            options.append(opt)
+        return {"question": f"Q{level}", "options": options}
+
+    return ButtonMenu.from_dict(node(0))
+
+
+def test_tree_index_does_not_walk_unopened_branches(monkeypatch):
+    root = _lazy_tree()
+    walked = []
+    original = telebutton._raw_callbacks
+    monkeypatch.setattr(telebutton, "_raw_callbacks",
+                        lambda raw: walked.append(1) or original(raw))
+
+    root.tree_index()
+    assert walked == []
+    assert len(root.get_all_callbacks()) == 3 + 9 + 27 + 81
+    assert walked
+
+
+def test_opening_lazy_branch_extends_index_without_rebuild(monkeypatch):
+    root = _lazy_tree()
+    telebutton._menu_registry[root.menu_id] = root
+    builds = []
+    original = telebutton.MenuTreeIndex.__init__
+
+    def counting_init(self, *args, **kwargs):
+        builds.append(1)
+        original(self, *args, **kwargs)
+
+    monkeypatch.setattr(telebutton.MenuTreeIndex, "__init__", counting_init)
+
+    result = telebutton.handle_callback(telebutton.encode_callback_data(root, 1))
+    sub = result["sub_menu"]
+    telebutton._menu_registry[sub.menu_id] = sub
+    result = telebutton.handle_callback(telebutton.encode_callback_data(sub, 2))
+    deeper = result["sub_menu"]
+    telebutton._menu_registry[deeper.menu_id] = deeper
+    result = telebutton.handle_callback(telebutton.encode_callback_data(deeper, 0))
+
+    assert result["path"] == ["l0_1", "l1_2", "l2_0"]
+    assert result["root_menu_id"] == root.menu_id
+    assert len(builds) == 1
+
+
+def test_serializing_and_comparing_do_not_build_lazy_branches(tmp_path):
+    root, twin = _lazy_tree(), _lazy_tree()
+    data = root.to_dict()
+    repr(root)
+
+    assert root.options == twin.options
+    assert not any(opt.sub_menu_loaded for opt in root.options)
+    assert data["options"][0]["sub_menu"]["options"][0]["callback"] == "l1_0"
+
+    registry = telebutton.SQLiteRegistry(str(tmp_path / "menus.db"))
+    try:
+        registry[root.menu_id] = root
+        assert not any(opt.sub_menu_loaded for opt in root.options)
+        assert registry.get(root.menu_id).options[2].sub_menu.question == "Q1"
+    finally:
+        registry.close()
+
+
+def test_compiled_lazy_branch_serializes_as_dict(tmp_path):
+    path = tmp_path / "menu.json"
+    path.write_text(json.dumps(_lazy_tree(depth=2).to_dict()), encoding="utf-8")
+    telebutton.compile_menu_file(str(path))
+    menu = telebutton.load_menu_from_file(str(path))
+
+    assert isinstance(menu.options[0]._sub_menu_raw, tuple)
+    data = menu.to_dict()
+    assert not menu.options[0].sub_menu_loaded
+    assert ButtonMenu.from_dict(data).options[0].sub_menu.options[1].callback == "l1_1"
+
+
+def test_concurrent_lazy_sub_menu_access_builds_once():
+    import threading
+
+    for _ in range(20):
+        option = ButtonOption.from_dict({"text": "A", "callback": "a",
+                                         "sub_menu": {"question": "Q", "options": []}})
+        seen = []
+        barrier = threading.Barrier(8)
+
+        def access():
+            barrier.wait()
+            seen.append(option.sub_menu)
+
+        threads = [threading.Thread(target=access) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert len({id(menu) for menu in seen}) == 1
+
+
+def test_compact_press_rejected_after_options_reordered():
+    menu = _menu("deploy", "status", "delete")
+    telebutton._menu_registry[menu.menu_id] = menu
+    deploy = telebutton.encode_callback_data(menu, 0)
+    assert telebutton.handle_callback(deploy)["callback"] == "deploy"
+
+    # 同一 menu_id 下重新排序（如热重载沿用旧 ID）
+    menu.options = [menu.options[2], menu.options[1], menu.options[0]]
+
+    assert telebutton.handle_callback(deploy) is None
+    assert telebutton.handle_callback(
+        telebutton.encode_callback_data(menu, 2))["callback"] == "deploy"
+
+
+def test_compact_data_without_tag_is_rejected():
+    menu = _menu("a")
+    telebutton._menu_registry[menu.menu_id] = menu
+    assert telebutton.handle_callback(f"{menu.menu_id}#A") is None
+
+
+def test_provider_press_survives_inserted_rows():
+    rows = [f"host{i}" for i in range(6)]
+
+    def query(offset, limit):
+        return [ButtonOption(r.upper(), r) for r in rows[offset:offset + limit]]
+
+    provider = telebutton.OptionProvider(query, cache_pages=1)
+    menu = ButtonMenu("选择主机：", provider=provider, page_size=2)
+    telebutton._menu_registry[menu.menu_id] = menu
+    keyboard, _ = telebutton._get_keyboard(menu, 1)
+    data = keyboard[0][1]["callback_data"]
+
+    # 数据库在用户点击前插入新行，原下标处已是另一台主机
+    rows.insert(0, "new")
+    provider.invalidate()
+    telebutton._get_keyboard(menu, 2)
+
+    result = telebutton.handle_callback(data)
+    assert result["callback"] == "host3"
+    assert result["text"] == "HOST3"
+
+
+def test_keyboard_cache_hit_and_invalidation():
+    menu = _menu("a", "b")
+    keyboard, markup = telebutton._get_keyboard(menu)
+
+    assert telebutton._get_keyboard(menu) == (keyboard, markup)
+    assert telebutton._get_keyboard(menu)[0] is keyboard
+    assert json.loads(markup) == {"inline_keyboard": keyboard}
+
+    menu.options.append(ButtonOption("C", "c"))
+    rebuilt, _ = telebutton._get_keyboard(menu)
+    assert rebuilt is not keyboard
+    assert [b["text"] for row in rebuilt for b in row] == ["A", "B", "C"]
+
+    telebutton.clear_menu(menu.menu_id)
+    assert telebutton._get_keyboard(menu)[0] is not rebuilt
+
+
+def test_keyboard_cache_is_bounded(monkeypatch):
+    monkeypatch.setattr(telebutton, "_keyboard_cache_size", 2)
+    menus = [_menu("a") for _ in range(3)]
+    first = telebutton._get_keyboard(menus[0])[0]
+    for menu in menus[1:]:
+        telebutton._get_keyboard(menu)
+
+    assert len(telebutton._keyboard_cache) == 2
+    assert telebutton._get_keyboard(menus[0])[0] is not first
+
+
+def test_menu_content_hash_ignores_menu_id():
+    first, second = _menu("a", "b"), _menu("a", "b")
+    assert first.menu_id != second.menu_id
+    assert telebutton.menu_content_hash(first) == telebutton.menu_content_hash(second)
+    assert telebutton.menu_content_hash(first) != telebutton.menu_content_hash(_menu("a"))
+    assert len(telebutton.menu_content_hash(first)) == 12
+
+
+def test_intern_menu_keeps_a_private_copy():
+    menu = _menu("a")
+    original_id = menu.menu_id
+    shared = telebutton.intern_menu(menu)
+
+    assert shared is not menu
+    assert menu.menu_id == original_id
+    assert shared.menu_id == telebutton.menu_content_hash(menu)
+
+    # 调用方之后修改自己的菜单，不影响已共享的定义
+    menu.options.append(ButtonOption("B", "b"))
+    again = telebutton.intern_menu(_menu("a"))
+    assert again is shared
+    assert [opt.callback for opt in again.options] == ["a"]
+
+
+def test_intern_menu_rejects_hash_hit_with_other_content():
+    menu = _menu("a")
+    menu_hash = telebutton.menu_content_hash(menu)
+    telebutton._menu_registry[menu_hash] = ButtonMenu("选择：", [ButtonOption("Z", "z")],
+                                                     menu_id=menu_hash)
+
+    shared = telebutton.intern_menu(menu)
+    assert [opt.callback for opt in shared.options] == ["a"]
+    assert telebutton._menu_registry.get(menu_hash) is shared
+
+
+def test_show_interned_menu_shares_one_definition(fake_api, transport):
+    handles = [telebutton.show_interned_menu(_menu("a", "b"), chat_id=str(chat),
+                                             use_openclaw=False)
+               for chat in (1, 2)]
+
+    assert handles[0].menu_hash == handles[1].menu_hash
+    assert [h.chat_id for h in handles] == ["1", "2"]
+    assert handles[0].message_id != handles[1].message_id
+    sent = fake_api.calls_to("sendMessage")
+    assert sent[0]["reply_markup"] == sent[1]["reply_markup"]
+
+
+def test_counter_id_generator_is_unique_across_threads():
+    generator = telebutton.CounterIdGenerator()
+    ids = []
+
+    def worker():
+        ids.extend(generator() for _ in range(1000))
+
+    threads = [threading.Thread(target=worker) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert len(set(ids)) == 4000
+    assert all(i.startswith(generator.prefix) and len(i) <= 7 for i in ids)
+    assert telebutton.CounterIdGenerator(prefix="p")() == "pA"
+
+
+def test_snowflake_ids_are_unique_ordered_and_per_worker():
+    first, second = telebutton.SnowflakeIdGenerator(1), telebutton.SnowflakeIdGenerator(2)
+    ids = [first() for _ in range(5000)]
+
+    assert len(set(ids)) == 5000
+    assert ids == sorted(ids, key=telebutton._decode_id)
+    assert all(len(i) == 11 for i in ids)
+    assert second() not in ids
+    with pytest.raises(ValueError):
+        telebutton.SnowflakeIdGenerator(1024)
+
+
+def test_set_menu_id_generator():
+    previous = telebutton._menu_id_generator
+    try:
+        telebutton.set_menu_id_generator(telebutton.CounterIdGenerator(prefix="t"))
+        assert [_menu("a").menu_id for _ in range(2)] == ["tA", "tB"]
+        assert ButtonMenu("Q", menu_id="fixed").menu_id == "fixed"
+    finally:
+        telebutton.set_menu_id_generator(previous)
+
+
+def test_switching_callback_encoding_rebuilds_cached_keyboards():
+    menu = _menu("a")
+    telebutton._menu_registry[menu.menu_id] = menu
+    assert "#" in telebutton._get_keyboard(menu)[0][0][0]["callback_data"]
+
+    telebutton.set_callback_encoding("plain")
+    try:
+        data = telebutton._get_keyboard(menu)[0][0][0]["callback_data"]
+        assert data == f"{menu.menu_id}:a"
+        assert telebutton.handle_callback(data)["callback"] == "a"
+    finally:
+        telebutton.set_callback_encoding("compact")
+    assert "#" in telebutton._get_keyboard(menu)[0][0][0]["callback_data"]
+
+
+def test_oversized_callback_data_falls_back_to_token():
+    long_callback = "x" * 80
+    menu = ButtonMenu("选择：", [ButtonOption("长", long_callback)])
+    telebutton._menu_registry[menu.menu_id] = menu
+
+    telebutton.set_callback_encoding("plain")
+    try:
+        data = telebutton.encode_callback_data(menu, 0)
+    finally:
+        telebutton.set_callback_encoding("compact")
+
+    assert data.startswith("~")
+    assert len(data.encode("utf-8")) <= telebutton.CALLBACK_DATA_LIMIT
+    assert telebutton.handle_callback(data)["callback"] == long_callback
+
+    long_id = ButtonMenu("选择：", [ButtonOption("A", "a")], menu_id="m" * 70)
+    telebutton._menu_registry[long_id.menu_id] = long_id
+    data = telebutton.encode_callback_data(long_id, 0)
+    assert data.startswith("~")
+    assert telebutton.handle_callback(data)["menu_id"] == long_id.menu_id
@@ -0,0 +1,233 @@
+import threading
+import time
+
+import pytest
+
+import telebutton
+from telebutton import ButtonMenu, ButtonOption, dispatch_update, show_menu, wait_selection
+from fake_bot_api import error
+
+
+def _menu(*callbacks):
+    return ButtonMenu("选择：", [ButtonOption(c.upper(), c) for c in callbacks])
+
+
+def _press(menu, index, chat_id=1, message_id=100):
+    """模拟一条按钮回调 Update"""
+    return {"callback_query": {
+        "id": "cq", "from": {"id": 7},
+        "data": telebutton.encode_callback_data(menu, index),
+        "message": {"message_id": message_id, "chat": {"id": chat_id}, "text": menu.question}
+    }}
+
+
+def test_poller_delivers_selection_and_answers(fake_api, poller):
+    menu = _menu("a", "b")
+    message_id = show_menu(menu, chat_id="1", use_openclaw=False)
+    assert message_id is not None
+
+    fake_api.push_callback(telebutton.encode_callback_data(menu, 1), message_id=int(message_id))
+    result = wait_selection(menu.menu_id, timeout=5, chat_id="1")
+
+    assert result["callback"] == "b"
+    assert result["chat_id"] == 1
+    fake_api.wait_for_call("answerCallbackQuery")
+    deleted = fake_api.wait_for_call("deleteMessage")
+    assert deleted[0]["message_id"] == int(message_id)
+
+
+def test_answer_is_not_retried(fake_api, poller):
+    menu = _menu("a")
+    telebutton._menu_registry[menu.menu_id] = menu
+    fake_api.script("answerCallbackQuery", error(500, "Internal Server Error"))
+
+    fake_api.push_callback(telebutton.encode_callback_data(menu, 0))
+    assert wait_selection(menu.menu_id, timeout=5, delete_message=False)["callback"] == "a"
+    time.sleep(0.2)
+    assert len(fake_api.calls_to("answerCallbackQuery")) == 1
+
+
+def test_poller_stops_on_conflict(fake_api, transport):
+    fake_api.script("getUpdates", error(409, "Conflict: can't use getUpdates method "
+                                             "while webhook is active"))
+    poller = telebutton.get_poller()
+    poller.poll_timeout = 1
+    show_menu(_menu("a"), chat_id="1", use_openclaw=False)
+    assert telebutton._should_poll(None)
+
+    poller.start()
+    poller._thread.join(5)
+
+    assert not poller.running
+    assert len(fake_api.calls_to("getUpdates")) == 1
+    assert not telebutton._should_poll(None)
+
+
+def test_external_dispatch_switches_to_webhook_mode(fake_api, transport):
+    menu = _menu("a")
+    show_menu(menu, chat_id="1", use_openclaw=False)
+    assert telebutton._should_poll(None)
+
+    assert dispatch_update(_press(menu, 0))["callback"] == "a"
+
+    assert not telebutton._should_poll(None)
+    assert telebutton._poller is None or not telebutton._poller.running
+
+
+def test_webhook_mode_never_polls(fake_api, transport):
+    telebutton.set_update_mode("webhook")
+    menu = _menu("a")
+    telebutton._menu_registry[menu.menu_id] = menu
+
+    assert wait_selection(menu.menu_id, timeout=0.1) is None
+    assert fake_api.calls_to("getUpdates") == []
+
+
+def test_pending_selection_claimed_by_later_waiter():
+    menu = _menu("a", "b")
+    telebutton._menu_registry[menu.menu_id] = menu
+
+    dispatch_update(_press(menu, 1, chat_id=5))
+    result = wait_selection(menu.menu_id, timeout=0.1, delete_message=False,
+                            poll=False, chat_id="5")
+    assert result["callback"] == "b"
+
+
+def test_waiters_are_routed_by_chat():
+    menu = _menu("a", "b")
+    telebutton._menu_registry[menu.menu_id] = menu
+    results = {}
+
+    def wait(chat):
+        results[chat] = wait_selection(menu.menu_id, timeout=5, delete_message=False,
+                                       poll=False, chat_id=chat)
+
+    threads = [threading.Thread(target=wait, args=(chat,)) for chat in ("1", "2")]
+    for thread in threads:
+        thread.start()
+    time.sleep(0.1)
+    dispatch_update(_press(menu, 1, chat_id=2))
+    dispatch_update(_press(menu, 0, chat_id=1))
+    for thread in threads:
+        thread.join(5)
+
+    assert results["1"]["callback"] == "a"
+    assert results["2"]["callback"] == "b"
+
+
+def test_each_selection_wakes_one_waiter():
+    menu = _menu("a")
+    telebutton._menu_registry[menu.menu_id] = menu
+    results = []
+
+    def wait():
+        results.append(wait_selection(menu.menu_id, timeout=0.5, delete_message=False,
+                                      poll=False))
+
+    threads = [threading.Thread(target=wait) for _ in range(3)]
+    for thread in threads:
+        thread.start()
+    time.sleep(0.1)
+    dispatch_update(_press(menu, 0))
+    for thread in threads:
+        thread.join(5)
+
+    assert sum(1 for r in results if r is not None) == 1
+
+
+def test_wait_times_out():
+    started = time.monotonic()
+    assert wait_selection("missing", timeout=0.1, poll=False) is None
+    assert time.monotonic() - started < 2
+
+
+def test_expired_pending_selection_is_not_claimed():
+    menu = _menu("a")
+    telebutton._menu_registry[menu.menu_id] = menu
+    telebutton.configure_pending_selections(ttl=0.05)
+    try:
+        dispatch_update(_press(menu, 0))
+        time.sleep(0.1)
+        assert wait_selection(timeout=0.05, poll=False) is None
+    finally:
+        telebutton.configure_pending_selections()
+
+
+def test_pending_selections_are_bounded_and_indexed_by_chat():
+    pending = telebutton._PendingSelections(ttl=None, max_entries=3)
+    for chat in range(5):
+        pending.put("m", str(chat), {"chat": chat})
+
+    assert len(pending) == 3
+    assert pending.claim("m", "0") is None
+    assert pending.claim(None, "3") == {"chat": 3}
+    assert pending.claim("m", None) == {"chat": 2}
+    assert pending.claim(None, None) == {"chat": 4}
+    assert len(pending) == 0
+
+
+def _paged_menu():
+    return ButtonMenu("选择：", [ButtonOption(str(i), str(i)) for i in range(6)], page_size=2)
+
+
+def _nav_press(data, chat_id=1, message_id=100):
+    return {"callback_query": {
+        "id": "cq", "from": {"id": 7}, "data": data,
+        "message": {"message_id": message_id, "chat": {"id": chat_id}, "text": "选择："}
+    }}
+
+
+def test_page_flip_does_not_block_dispatch(fake_api, transport):
+    menu = _paged_menu()
+    telebutton._menu_registry[menu.menu_id] = menu
+    slow = (200, {"ok": True, "result": True})
+    fake_api.script("editMessageReplyMarkup", ("sleep", 1, slow))
+
+    started = time.monotonic()
+    for chat in range(3):
+        result = dispatch_update(_nav_press(telebutton.encode_page_data(menu, 1),
+                                            chat_id=chat))
+        assert result["navigation"]
+    assert time.monotonic() - started < 0.5
+    assert len(fake_api.wait_for_call("editMessageReplyMarkup", count=3)) == 3
+
+
+def test_page_label_only_answers(fake_api, poller):
+    menu = _paged_menu()
+    telebutton._menu_registry[menu.menu_id] = menu
+    keyboard, _ = telebutton._get_keyboard(menu)
+    label = keyboard[-1][0]
+
+    assert label["text"] == "1/3"
+    fake_api.push_callback(label["callback_data"])
+    poller.start()
+    fake_api.wait_for_call("answerCallbackQuery")
+    time.sleep(0.2)
+    assert fake_api.calls_to("editMessageReplyMarkup") == []
+
+
+def test_not_modified_edit_is_not_reported(fake_api, transport, capsys):
+    menu = _paged_menu()
+    telebutton._menu_registry[menu.menu_id] = menu
+    fake_api.script("editMessageReplyMarkup",
+                    error(400, "Bad Request: message is not modified"))
+
+    dispatch_update(_nav_press(telebutton.encode_page_data(menu, 0)))
+    fake_api.wait_for_call("editMessageReplyMarkup")
+    time.sleep(0.1)
+    assert "更新消息失败" not in capsys.readouterr().out
+
+
+def test_auto_mode_does_not_poll_for_openclaw_sends(fake_api, transport, monkeypatch):
+    monkeypatch.setattr(telebutton, "_send_via_openclaw", lambda *args, **kwargs: "5")
+    menu = _menu("a")
+    show_menu(menu, chat_id="1")
+
+    assert not telebutton._should_poll(None)
+    assert wait_selection(menu.menu_id, timeout=0.1) is None
+    assert fake_api.calls_to("getUpdates") == []
+
+
+def test_poller_does_not_send_sticky_allowed_updates(fake_api, poller):
+    poller.poll_once()
+    assert "allowed_updates" not in fake_api.calls_to("getUpdates")[0]
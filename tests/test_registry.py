@@ -0,0 +1,197 @@
+import time
+
+import pytest
+
+import telebutton
+from telebutton import (ButtonMenu, ButtonOption, MenuRegistry, SQLiteRegistry,
+                        SQLiteTokenStore, TokenStore, encode_callback_data, handle_callback)
+
+
+def _menu(*callbacks, **kwargs):
+    return ButtonMenu("选择：", [ButtonOption(c.upper(), c) for c in callbacks], **kwargs)
+
+
+@pytest.fixture
+def sqlite_registry(tmp_path):
+    registry = SQLiteRegistry(str(tmp_path / "menus.db"))
+    previous = telebutton.set_registry_backend(registry)
+    yield registry
+    telebutton.set_registry_backend(previous)
+    registry.close()
+
+
+def test_memory_registry_ttl():
+    registry = MenuRegistry(ttl=0.05)
+    menu = _menu("a")
+    registry[menu.menu_id] = menu
+    assert registry.get(menu.menu_id) is menu
+    time.sleep(0.1)
+    assert registry.get(menu.menu_id) is None
+    assert registry.stats()["evictions"]["expired"] == 1
+
+
+def test_memory_registry_lru_limit():
+    registry = MenuRegistry(max_menus=2)
+    first, second, third = _menu("a"), _menu("b"), _menu("c")
+    registry[first.menu_id] = first
+    registry[second.menu_id] = second
+    registry.get(first.menu_id)
+    registry[third.menu_id] = third
+
+    assert first.menu_id in registry
+    assert second.menu_id not in registry
+    assert registry.stats()["evictions"]["lru"] == 1
+
+
+def test_memory_registry_byte_budget():
+    registry = MenuRegistry(max_menus=None, max_bytes=1)
+    first, second = _menu("a"), _menu("b")
+    registry[first.menu_id] = first
+    registry[second.menu_id] = second
+
+    assert len(registry) == 1
+    assert second.menu_id in registry
+
+
+def test_menu_size_is_estimated_once_and_only_with_budget(monkeypatch):
+    calls = []
+    original = telebutton._estimate_menu_size
+    monkeypatch.setattr(telebutton, "_estimate_menu_size",
+                        lambda menu: calls.append(menu) or original(menu))
+    menu = _menu("a", "b")
+
+    registry = MenuRegistry()
+    registry[menu.menu_id] = menu
+    assert calls == []
+
+    registry = MenuRegistry(max_bytes=10 ** 6)
+    for _ in range(3):
+        registry[menu.menu_id] = menu
+    assert calls == [menu]
+    assert registry.stats()["bytes"] > 0
+
+    menu.options = menu.options + [ButtonOption("C", "c")]
+    registry[menu.menu_id] = menu
+    assert calls == [menu, menu]
+
+
+def test_token_store_evicts_least_recently_used():
+    store = TokenStore(ttl=None, max_tokens=2)
+    first, second = store.put("a"), store.put("b")
+    assert store.get(first) == "a"
+    store.put("c")
+
+    assert store.get(first) == "a"
+    assert store.get(second) is None
+
+
+def test_token_eviction_invalidates_cached_keyboard():
+    previous = telebutton.set_token_backend(TokenStore(ttl=None, max_tokens=1))
+    try:
+        menu = ButtonMenu("选择：", [ButtonOption("A", "a", payload={"n": 1})])
+        telebutton._menu_registry[menu.menu_id] = menu
+        keyboard, _ = telebutton._get_keyboard(menu)
+        assert telebutton._get_keyboard(menu)[0] is keyboard
+
+        other = ButtonMenu("选择：", [ButtonOption("B", "b", payload={"n": 2})])
+        telebutton._get_keyboard(other)
+
+        rebuilt, _ = telebutton._get_keyboard(menu)
+        assert rebuilt is not keyboard
+        assert handle_callback(rebuilt[0][0]["callback_data"])["payload"] == {"n": 1}
+    finally:
+        telebutton.set_token_backend(previous)
+
+
+def test_sqlite_token_store_shared_between_instances(sqlite_registry, tmp_path):
+    path = str(tmp_path / "menus.db")
+    previous = telebutton.set_token_backend(SQLiteTokenStore(path))
+    try:
+        menu = ButtonMenu("选择：", [ButtonOption("A", "a", payload={"n": 1})])
+        sqlite_registry[menu.menu_id] = menu
+        data = encode_callback_data(menu, 0)
+
+        # 另一个工作进程打开同一个数据库
+        telebutton.set_token_backend(SQLiteTokenStore(path))
+        result = handle_callback(data)
+
+        assert result["callback"] == "a"
+        assert result["payload"] == {"n": 1}
+        assert telebutton.get_token_store().purge(menu.menu_id) == 1
+    finally:
+        telebutton.set_token_backend(previous)
+
+
+def test_sqlite_registry_resolves_sub_menu_press(sqlite_registry, tmp_path):
+    root = ButtonMenu("根", [ButtonOption("A", "a"), ButtonOption(
+        "B", "b", sub_menu=_menu("x", "y"))])
+    sqlite_registry[root.menu_id] = root
+    sub_menu = handle_callback(encode_callback_data(root, 1))["sub_menu"]
+    sqlite_registry[sub_menu.menu_id] = sub_menu
+    data = encode_callback_data(sub_menu, 0)
+
+    telebutton.set_registry_backend(SQLiteRegistry(str(tmp_path / "menus.db")))
+    result = handle_callback(data)
+
+    assert result["path"] == ["b", "x"]
+    assert result["depth"] == 1
+    assert result["root_menu_id"] == root.menu_id
+
+
+def test_sqlite_registry_edit_navigation(sqlite_registry, tmp_path, fake_api, transport):
+    telebutton.set_navigation_mode("edit")
+    root = ButtonMenu("根", [ButtonOption("A", "a"), ButtonOption(
+        "B", "b", sub_menu=_menu("x", "y"))])
+    sqlite_registry[root.menu_id] = root
+
+    def press(data):
+        return telebutton.dispatch_update({"callback_query": {
+            "id": "cq", "data": data,
+            "message": {"message_id": 100, "chat": {"id": 1}, "text": "根"}}})
+
+    assert press(encode_callback_data(root, 1))["navigation"]
+    keyboard = fake_api.wait_for_call("editMessageText")[0]["reply_markup"]["inline_keyboard"]
+    assert keyboard[-1][0]["callback_data"] == telebutton.encode_page_data(root, 0)
+
+    # 另一个工作进程收到子菜单上的按钮
+    telebutton.set_registry_backend(SQLiteRegistry(str(tmp_path / "menus.db")))
+    press(keyboard[0][0]["callback_data"])
+    result = telebutton.wait_selection(root.menu_id, timeout=1, delete_message=False,
+                                       poll=False)
+
+    assert result["callback"] == "x"
+    assert result["path"] == ["b", "x"]
+
+
+def test_sqlite_registry_roundtrip(sqlite_registry):
+    menu = ButtonMenu("根", [ButtonOption("A", "a"), ButtonOption(
+        "B", "b", sub_menu=_menu("x", "y"))])
+    sqlite_registry[menu.menu_id] = menu
+
+    copy = sqlite_registry.get(menu.menu_id)
+    assert copy is not menu
+    assert copy.to_dict() == menu.to_dict()
+    assert len(sqlite_registry) == 1
+    assert sqlite_registry.pop(menu.menu_id).menu_id == menu.menu_id
+    assert sqlite_registry.get(menu.menu_id) is None
+
+
+def test_sqlite_registry_expiry(sqlite_registry):
+    menu = _menu("a")
+    sqlite_registry.set(menu.menu_id, menu, ttl=-1)
+    assert sqlite_registry.get(menu.menu_id) is None
+    sqlite_registry.set(menu.menu_id, menu, ttl=-1)
+    assert sqlite_registry.sweep() == 1
+
+
+def test_sqlite_registry_survives_new_instance(sqlite_registry, tmp_path):
+    menu = _menu("a", "b")
+    sqlite_registry[menu.menu_id] = menu
+    data = encode_callback_data(menu, 1)
+
+    # 另一个工作进程（或重启后的进程）打开同一个数据库
+    telebutton.set_registry_backend(SQLiteRegistry(str(tmp_path / "menus.db")))
+    result = handle_callback(data)
+
+    assert result["callback"] == "b"
+    assert result["menu_id"] == menu.menu_id
@@ -0,0 +1,94 @@
+import queue
+import threading
+import time
+
+import pytest
+
+import telebutton
+from telebutton import ButtonMenu, ButtonOption, RateLimiter, SendQueue, submit_menu
+
+
+def _menu(*callbacks):
+    return ButtonMenu("选择：", [ButtonOption(c.upper(), c) for c in callbacks])
+
+
+def test_submit_menu_returns_message_id(fake_api, transport):
+    send_queue = SendQueue(workers=2)
+    try:
+        future = submit_menu(_menu("a"), chat_id="1", use_openclaw=False,
+                             send_queue=send_queue)
+        assert future.result(timeout=5)
+    finally:
+        send_queue.shutdown()
+    assert fake_api.calls_to("sendMessage")[0]["chat_id"] == "1"
+
+
+def test_throttled_chat_does_not_hold_workers(fake_api, transport):
+    transport.rate_limiter = RateLimiter(global_rate=1000, chat_rate=2, chat_burst=1)
+    send_queue = SendQueue(workers=4)
+    try:
+        throttled = [submit_menu(_menu("a"), chat_id="111", use_openclaw=False,
+                                 send_queue=send_queue) for _ in range(5)]
+        started = time.monotonic()
+        other = submit_menu(_menu("b"), chat_id="222", use_openclaw=False,
+                            send_queue=send_queue)
+        other.result(timeout=5)
+        assert time.monotonic() - started < 0.5
+        assert not all(future.done() for future in throttled)
+        for future in throttled:
+            future.result(timeout=5)
+    finally:
+        send_queue.shutdown()
+
+
+def test_submit_applies_backpressure():
+    send_queue = SendQueue(workers=1, maxsize=1)
+    release = threading.Event()
+    try:
+        running = send_queue.submit(release.wait)
+        while send_queue.pending:  # 等工作线程取走第一个任务
+            time.sleep(0.01)
+        queued = send_queue.submit(lambda: "queued")
+
+        with pytest.raises(queue.Full):
+            send_queue.submit(lambda: None, block=False)
+        started = time.monotonic()
+        with pytest.raises(queue.Full):
+            send_queue.submit(lambda: None, timeout=0.1)
+        assert time.monotonic() - started >= 0.1 * 0.9
+
+        release.set()
+        assert running.result(timeout=5) is True
+        assert queued.result(timeout=5) == "queued"
+    finally:
+        release.set()
+        send_queue.shutdown()
+
+
+def test_shutdown_drains_delayed_jobs():
+    def steps():
+        yield time.monotonic() + 0.1
+        return "sent"
+
+    send_queue = SendQueue(workers=2)
+    plain = send_queue.submit(lambda: "plain")
+    delayed = send_queue._submit_steps(steps)
+    send_queue.shutdown(wait=True)
+
+    assert plain.result(timeout=0) == "plain"
+    assert delayed.result(timeout=0) == "sent"
+    with pytest.raises(RuntimeError):
+        send_queue.submit(lambda: None)
+
+
+def test_step_errors_are_set_on_future():
+    def steps():
+        yield time.monotonic()
+        raise telebutton.TelegramAPIError("sendMessage", 403, "Forbidden")
+
+    send_queue = SendQueue(workers=1)
+    try:
+        with pytest.raises(telebutton.TelegramAPIError):
+            send_queue._submit_steps(steps).result(timeout=5)
+    finally:
+        send_queue.shutdown()
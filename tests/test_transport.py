@@ -0,0 +1,160 @@
+import time
+
+import pytest
+
+import telebutton
+from telebutton import RateLimiter, RetryPolicy, TelegramAPIError, TelegramTransport
+from fake_bot_api import error
+
+
+def test_call_returns_result(fake_api, transport):
+    result = transport.call("sendMessage", {"chat_id": 1, "text": "hi"})
+    assert result["text"] == "hi"
+    assert fake_api.calls_to("sendMessage") == [{"chat_id": 1, "text": "hi"}]
+
+
+def test_rate_limiter_spaces_sends_per_chat():
+    limiter = RateLimiter(global_rate=1000, chat_rate=20, chat_burst=1)
+    started = time.monotonic()
+    for _ in range(5):
+        limiter.acquire("1")
+    assert time.monotonic() - started >= 4 / 20 * 0.9
+
+
+def test_rate_limiter_does_not_delay_other_chats():
+    limiter = RateLimiter(global_rate=1000, chat_rate=1, chat_burst=1)
+    limiter.acquire("1")
+    started = time.monotonic()
+    limiter.acquire("2")
+    assert time.monotonic() - started < 0.1
+
+
+def test_rate_limiter_spaces_chat_after_global_backlog():
+    limiter = RateLimiter(global_rate=20, chat_rate=5, chat_burst=1)
+    now = time.monotonic()
+    for chat in range(10):
+        limiter._reserve_send(chat, now)  # 其他聊天占住约 0.5 秒的全局额度
+    sent = []
+    for _ in range(2):
+        limiter.acquire("A")
+        sent.append(time.monotonic())
+    assert sent[0] - now >= 0.5 * 0.9
+    assert sent[1] - sent[0] >= 1 / 5 * 0.9
+
+
+def test_rate_limiter_group_bucket():
+    limiter = RateLimiter(global_rate=1000, chat_rate=1000, chat_burst=10,
+                          group_rate=10, group_burst=1)
+    started = time.monotonic()
+    for _ in range(3):
+        limiter.acquire("-100")
+    assert time.monotonic() - started >= 2 / 10 * 0.9
+
+
+def test_penalize_delays_chat():
+    limiter = RateLimiter(global_rate=1000, chat_rate=1000, chat_burst=1)
+    limiter.penalize("1", 0.2)
+    started = time.monotonic()
+    limiter.acquire("1")
+    assert time.monotonic() - started >= 0.15
+
+
+def test_connection_refused_send_is_retryable():
+    pytest.importorskip("requests")
+    transport = TelegramTransport(bot_token="TEST", api_base="http://127.0.0.1:9",
+                                  rate_limit=False, retry=RetryPolicy(max_attempts=1))
+    with pytest.raises(TelegramAPIError) as info:
+        transport.call("sendMessage", {"chat_id": 1, "text": "hi"})
+    assert not info.value.request_sent
+    assert info.value.retryable
+
+
+def test_read_timeout_on_send_is_not_retried(fake_api, transport):
+    fake_api.script("sendMessage", ("sleep", 0.5, (200, {"ok": True, "result": {}})))
+
+    with pytest.raises(TelegramAPIError) as info:
+        transport.call("sendMessage", {"chat_id": 1, "text": "hi"}, timeout=0.1)
+
+    assert info.value.request_sent
+    assert not info.value.retryable
+    assert len(fake_api.calls_to("sendMessage")) == 1
+
+
+def test_read_timeout_on_edit_is_retried(fake_api, transport):
+    fake_api.script("editMessageText", ("sleep", 0.5, (200, {"ok": True, "result": True})))
+    assert transport.call("editMessageText", {"chat_id": 1, "message_id": 2, "text": "x"},
+                          timeout=0.1)
+    assert len(fake_api.calls_to("editMessageText")) == 2
+
+
+def test_broadcast_workers_capped_at_pool_size(fake_api, transport, monkeypatch):
+    workers = []
+    original = telebutton.ThreadPoolExecutor
+
+    def executor(max_workers):
+        workers.append(max_workers)
+        return original(max_workers=max_workers)
+
+    monkeypatch.setattr(telebutton, "ThreadPoolExecutor", executor)
+    transport.pool_maxsize = 4
+    menu = telebutton.ButtonMenu("选择：", [telebutton.ButtonOption("A", "a")])
+
+    result = telebutton.broadcast_menu(menu, range(20), concurrency=32)
+
+    assert result.sent == 20
+    assert workers == [4]
+
+
+def test_retries_429_after_retry_after(fake_api, transport):
+    fake_api.script("sendMessage", error(429, "Too Many Requests", retry_after=0.2))
+
+    started = time.monotonic()
+    transport.call("sendMessage", {"chat_id": 1, "text": "hi"})
+
+    assert time.monotonic() - started >= 0.2
+    assert len(fake_api.calls_to("sendMessage")) == 2
+
+
+def test_retries_5xx_with_backoff(fake_api, transport):
+    fake_api.script("editMessageText", error(502, "Bad Gateway"), error(500, "Internal"))
+    assert transport.call("editMessageText", {"chat_id": 1, "message_id": 2, "text": "x"})
+    assert len(fake_api.calls_to("editMessageText")) == 3
+
+
+def test_permanent_error_is_not_retried(fake_api, transport):
+    fake_api.script("sendMessage", error(400, "Bad Request: chat not found"))
+
+    with pytest.raises(TelegramAPIError) as info:
+        transport.call("sendMessage", {"chat_id": 1, "text": "hi"})
+
+    assert info.value.error_code == 400
+    assert not info.value.retryable
+    assert len(fake_api.calls_to("sendMessage")) == 1
+
+
+def test_retry_after_above_limit_raises(fake_api, transport):
+    transport.retry = RetryPolicy(max_retry_after=1)
+    fake_api.script("sendMessage", error(429, "Too Many Requests", retry_after=30))
+
+    with pytest.raises(TelegramAPIError) as info:
+        transport.call("sendMessage", {"chat_id": 1, "text": "hi"})
+    assert info.value.retry_after == 30
+
+
+def test_gives_up_after_max_attempts(fake_api, transport):
+    transport.retry = RetryPolicy(max_attempts=2, base_delay=0.01)
+    fake_api.script("sendMessage", *[error(503, "Unavailable")] * 3)
+
+    with pytest.raises(TelegramAPIError):
+        transport.call("sendMessage", {"chat_id": 1, "text": "hi"})
+    assert len(fake_api.calls_to("sendMessage")) == 2
+
+
+def test_connection_refused_is_retryable():
+    pytest.importorskip("requests")
+    transport = TelegramTransport(bot_token="TEST", api_base="http://127.0.0.1:9",
+                                  rate_limit=False, retry=RetryPolicy(max_attempts=1))
+    with pytest.raises(TelegramAPIError) as info:
+        transport.call("getMe", {})
+    assert info.value.error_code is None
+    assert info.value.retryable
@@ -0,0 +1,174 @@
+import json
+import os
+
+import pytest
+
+import telebutton
+from telebutton import MenuFileWatcher, load_menu_from_file
+
+
+def _write(path, question, callbacks, mtime_bump=0):
+    path.write_text(json.dumps({
+        "question": question,
+        "options": [{"text": c.upper(), "callback": c} for c in callbacks]
+    }), encoding="utf-8")
+    if mtime_bump:
+        st = path.stat()
+        os.utime(path, ns=(st.st_atime_ns, st.st_mtime_ns + mtime_bump))
+
+
+@pytest.fixture
+def watcher():
+    watcher = MenuFileWatcher(interval=0.05, use_inotify=False)
+    yield watcher
+    watcher.stop()
+    for key in list(watcher._files):
+        watcher.unwatch(key)
+
+
+def test_watch_loads_once_and_serves_from_memory(tmp_path, watcher):
+    path = tmp_path / "menu.json"
+    _write(path, "Q1", ["a", "b"])
+
+    menu = watcher.watch(str(path))
+
+    assert menu.question == "Q1"
+    assert watcher.get(str(path)) is menu
+    assert [o.callback for o in load_menu_from_file(str(path)).options] == ["a", "b"]
+
+
+def test_check_reloads_changed_file(tmp_path, watcher):
+    path = tmp_path / "menu.json"
+    _write(path, "Q1", ["a"])
+    menu = watcher.watch(str(path))
+    watcher.stop()
+    reloaded = []
+    watcher.add_listener(lambda key, new: reloaded.append(new))
+
+    assert watcher.check() == []
+    _write(path, "Q2", ["a", "b", "c"], mtime_bump=10 ** 9)
+    assert watcher.check() == [str(path.resolve())]
+
+    current = watcher.get(str(path))
+    assert current.question == "Q2"
+    assert current.menu_id == menu.menu_id
+    assert reloaded == [current]
+
+
+def test_broken_file_keeps_previous_menu(tmp_path, watcher):
+    path = tmp_path / "menu.json"
+    _write(path, "Q1", ["a"])
+    menu = watcher.watch(str(path))
+    watcher.stop()
+
+    path.write_text("{not json", encoding="utf-8")
+    st = path.stat()
+    os.utime(path, ns=(st.st_atime_ns, st.st_mtime_ns + 10 ** 9))
+
+    assert watcher.check() == []
+    assert watcher.get(str(path)) is menu
+
+
+def test_background_thread_picks_up_changes(tmp_path, watcher):
+    path = tmp_path / "menu.json"
+    _write(path, "Q1", ["a"])
+    watcher.watch(str(path))
+
+    _write(path, "Q2", ["b"], mtime_bump=10 ** 9)
+    deadline = telebutton.time.monotonic() + 5
+    while watcher.get(str(path)).question != "Q2":
+        assert telebutton.time.monotonic() < deadline
+        telebutton.time.sleep(0.02)
+
+
+def test_load_returns_independent_copies(tmp_path):
+    path = tmp_path / "menu.json"
+    _write(path, "Q1", ["a"])
+
+    first, second = load_menu_from_file(str(path)), load_menu_from_file(str(path))
+    shared = load_menu_from_file(str(path), copy=False)
+
+    assert first is not second
+    assert first.menu_id != second.menu_id
+    assert first.options[0] is not second.options[0]
+    assert load_menu_from_file(str(path), copy=False) is shared
+
+
+def test_copies_of_watched_file_use_latest_data(tmp_path, watcher):
+    path = tmp_path / "menu.json"
+    _write(path, "Q1", ["a"])
+    shared = watcher.watch(str(path))
+    watcher.stop()
+
+    copy = load_menu_from_file(str(path))
+    assert copy is not shared and copy.menu_id != shared.menu_id
+
+    _write(path, "Q2", ["b"], mtime_bump=10 ** 9)
+    watcher.check()
+    assert load_menu_from_file(str(path)).question == "Q2"
+    assert load_menu_from_file(str(path), copy=False) is watcher.get(str(path))
+
+
+def test_reload_replaces_menu_in_sqlite_registry(tmp_path, watcher):
+    registry = telebutton.SQLiteRegistry(str(tmp_path / "menus.db"))
+    previous = telebutton.set_registry_backend(registry)
+    try:
+        path = tmp_path / "menu.json"
+        _write(path, "Q1", ["a"])
+        menu = watcher.watch(str(path))
+        watcher.stop()
+        registry[menu.menu_id] = menu
+
+        _write(path, "Q2", ["a", "b"], mtime_bump=10 ** 9)
+        watcher.check()
+
+        assert registry.get(menu.menu_id).question == "Q2"
+    finally:
+        telebutton.set_registry_backend(previous)
+        registry.close()
+
+
+def test_compiled_file_roundtrip_skips_parsing(tmp_path, monkeypatch):
+    path = tmp_path / "menu.json"
+    path.write_text(json.dumps({
+        "question": "Q1",
+        "options": [{"text": "A", "callback": "a", "payload": {"n": 1}},
+                    {"text": "B", "callback": "b", "sub_menu": {
+                        "question": "Q2", "options": [{"text": "X", "callback": "x"}]}}]
+    }), encoding="utf-8")
+    source = load_menu_from_file(str(path))
+
+    target = telebutton.compile_menu_file(str(path))
+    assert target == tmp_path / "menu.json.tbm"
+
+    def no_parse(path):
+        raise AssertionError("源文件不应被解析")
+
+    monkeypatch.setattr(telebutton, "_parse_source", no_parse)
+    telebutton._menu_file_cache.clear()
+    compiled = load_menu_from_file(str(path))
+    direct = load_menu_from_file(str(target))
+
+    def shape(menu):
+        return (menu.question, [(opt.text, opt.callback, opt.payload,
+                                 shape(opt.sub_menu) if opt.sub_menu else None)
+                                for opt in menu.options])
+
+    assert shape(compiled) == shape(direct) == shape(source)
+
+
+def test_stale_or_foreign_compiled_file_falls_back_to_source(tmp_path):
+    path = tmp_path / "menu.json"
+    _write(path, "Q1", ["a"])
+    target = telebutton.compile_menu_file(str(path))
+
+    _write(path, "Q2", ["b"], mtime_bump=10 ** 9)
+    assert load_menu_from_file(str(path)).question == "Q2"
+
+    telebutton.compile_menu_file(str(path))
+    target.write_bytes(b"TBM0" + target.read_bytes()[4:])
+    _write(path, "Q3", ["c"])
+    os.utime(target, ns=(path.stat().st_atime_ns, path.stat().st_mtime_ns + 10 ** 9))
+    assert load_menu_from_file(str(path)).question == "Q3"
+    with pytest.raises(ValueError):
+        load_menu_from_file(str(target))